@@ -0,0 +1,91 @@
+import time
+import tracemalloc
+import argparse
+import numpy as np
+import pandas as pd
+
+import opendashboards.utils.aggregate as aggregate
+import multistats
+
+
+def make_events(n_rows, days=30, n_completions=5000, missing=0.001, seed=0):
+    """Synthetic event log with zipf-distributed completions (including empty ones) and rewards which are zero 40% of the time.
+
+    Completions are categoricals, as they are when calculate_stats gets them from the interned history (see utils.decode_completions).
+    """
+    rng = np.random.default_rng(seed)
+    vocab = np.array([''] + [f'completion {i}' for i in range(n_completions)], dtype=object)
+    completions = vocab[np.minimum(rng.zipf(1.3, n_rows), len(vocab) - 1)]
+    completions[rng.random(n_rows) < missing] = None
+    return pd.DataFrame({
+        '_timestamp': pd.to_datetime(1.7e9 + np.sort(rng.random(n_rows)) * 86400 * days, unit='s'),
+        'completions': pd.Categorical(completions),
+        'rewards': np.where(rng.random(n_rows) < 0.4, 0, rng.random(n_rows)),
+        'completion_times': rng.random(n_rows),
+    })
+
+
+def timed(f, *args, **kwargs):
+    start = time.time()
+    result = f(*args, **kwargs)
+    return result, time.time() - start
+
+
+def peak_memory(f, *args, **kwargs):
+    """Peak memory allocated by f (numpy arrays and python objects), in MiB. Tracing slows python code down a lot, so f is timed separately."""
+    tracemalloc.start()
+    f(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return peak
+
+
+def vectorized_stats(df, bucket, ntop=3):
+    return pd.concat([
+        aggregate.completion_stats(df.completions, df.rewards, bucket),
+        aggregate.nonzero_stats(df.rewards, bucket, prefix='rewards_'),
+        aggregate.top_completions(df.completions, df.rewards, bucket, exclude='', ntop=ntop).unstack(),
+    ], axis=1)
+
+
+def groupby_stats(df, bucket, ntop=3):
+    # the per-bucket aggregations which calculate_stats used before they were vectorized
+    grouper = df.groupby(bucket)
+    return pd.concat([
+        grouper.completions.agg([aggregate.diversity, aggregate.successful_diversity, aggregate.success_rate]),
+        grouper.rewards.agg([aggregate.nonzero_rate, aggregate.nonzero_mean, aggregate.nonzero_std, aggregate.nonzero_median]),
+        grouper.apply(aggregate.successful_nonzero_diversity),
+        grouper.apply(aggregate.completion_top_stats, exclude='', ntop=ntop).unstack(),
+    ], axis=1)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the run stats of multistats on a synthetic event log.')
+    parser.add_argument('--rows', type=int, default=10_000_000, help='Number of events.')
+    parser.add_argument('--freq', type=str, default='h', help='Frequency to aggregate data.')
+    parser.add_argument('--chunk_size', type=int, default=100_000, help='Number of events in each chunk of calculate_stats_chunked.')
+    parser.add_argument('--no_groupby', action='store_true', help='Skip the groupby.apply baseline, which is slow for many buckets.')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    args = parse_arguments()
+    df = make_events(args.rows)
+    bucket = df._timestamp.dt.floor(args.freq)
+    print(f'{len(df)} events in {bucket.nunique()} buckets')
+
+    _, t_vectorized = timed(vectorized_stats, df, bucket)
+    print(f'vectorized aggregations: {t_vectorized:.2f}s, {peak_memory(vectorized_stats, df, bucket):.0f} MiB')
+    if not args.no_groupby:
+        _, t_groupby = timed(groupby_stats, df, bucket)
+        print(f'groupby.apply aggregations: {t_groupby:.2f}s ({t_groupby/t_vectorized:.1f}x slower)')
+
+    _, t_stats = timed(multistats.calculate_stats, df.copy(), freq=args.freq, run_id='benchmark')
+    print(f'calculate_stats: {t_stats:.2f}s, {peak_memory(multistats.calculate_stats, df.copy(), freq=args.freq, run_id="benchmark"):.0f} MiB')
+    # chunks are views of the events which are already in memory, so only the memory used to process them is counted
+    chunks = lambda: (df.iloc[i:i+args.chunk_size] for i in range(0, len(df), args.chunk_size))
+    _, t_chunked = timed(multistats.calculate_stats_chunked, chunks(), freq=args.freq, run_id='benchmark')
+    m_chunked = peak_memory(multistats.calculate_stats_chunked, chunks(), freq=args.freq, run_id='benchmark')
+    print(f'calculate_stats_chunked ({args.chunk_size} events per chunk): {t_chunked:.2f}s, {m_chunked:.0f} MiB')
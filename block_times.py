@@ -0,0 +1,124 @@
+import os
+import sqlite3
+import contextlib
+import datetime
+import threading
+import tqdm
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+
+DB_PATH = './data/metagraph/block_times.sqlite'
+
+# known block times which are used as interpolation anchors when the index has few entries
+SEED_ANCHORS = {
+    500_000: datetime.datetime(2023, 5, 29, 5, 29, 0),
+    800_000: datetime.datetime(2023, 7, 9, 21, 32, 48),
+}
+
+
+def connect(path=DB_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    con = sqlite3.connect(path)
+    con.execute('CREATE TABLE IF NOT EXISTS block_times (block INTEGER PRIMARY KEY, timestamp INTEGER NOT NULL)')
+    return con
+
+
+def load_block_times(blocks=None, path=DB_PATH):
+    """Returns a {block: timestamp_ms} dict of the indexed blocks, optionally restricted to blocks."""
+    with contextlib.closing(connect(path)) as con, con:
+        if blocks is None:
+            rows = con.execute('SELECT block, timestamp FROM block_times').fetchall()
+        else:
+            con.execute('CREATE TEMP TABLE query (block INTEGER PRIMARY KEY)')
+            con.executemany('INSERT OR IGNORE INTO query VALUES (?)', ((int(b),) for b in blocks))
+            rows = con.execute('SELECT block, timestamp FROM block_times JOIN query USING (block)').fetchall()
+    return dict(rows)
+
+
+def save_block_times(timestamps, path=DB_PATH):
+    with contextlib.closing(connect(path)) as con, con:
+        con.executemany('INSERT OR REPLACE INTO block_times VALUES (?, ?)', ((int(b), int(t)) for b, t in timestamps.items()))
+
+
+def get_block_timestamp(block, subtensor):
+
+    info = subtensor.substrate.get_block(block_number=int(block))
+    extrinsic_call = info['extrinsics'][0]['call']
+    return extrinsic_call.value_serialized['call_args'][0]['value']
+
+
+def fetch_block_times(blocks, make_subtensor, max_workers=8, batch_size=100, path=DB_PATH):
+    """Resolves blocks on chain using a thread pool, with one subtensor connection per thread.
+
+    Results are saved to the index after each batch, so an interrupted run keeps its progress. Blocks which fail are left out.
+    """
+    local = threading.local()
+
+    def fetch(block):
+        if not hasattr(local, 'subtensor'):
+            local.subtensor = make_subtensor()
+        try:
+            return block, get_block_timestamp(block, local.subtensor)
+        except Exception as e:
+            print(f'Error getting timestamp of block {block}: {e}')
+            return block, None
+
+    blocks = sorted(set(int(b) for b in blocks))
+    timestamps = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for i in tqdm.tqdm(range(0, len(blocks), batch_size), desc=f'Mapping {len(blocks)} blocks to timestamps'):
+            batch = dict(executor.map(fetch, blocks[i:i+batch_size]))
+            batch = {b: t for b, t in batch.items() if t is not None}
+            save_block_times(batch, path)
+            timestamps.update(batch)
+
+    return timestamps
+
+
+def interpolate_block_times(blocks, anchors):
+    """Piecewise-linear interpolation of timestamps (ms) between anchor blocks. Blocks outside the anchors are extrapolated from the nearest two."""
+    anchor_blocks = np.array(sorted(anchors), dtype=float)
+    anchor_times = np.array([anchors[b] for b in sorted(anchors)], dtype=float)
+    if len(anchor_blocks) < 2:
+        raise ValueError(f'At least two anchors are needed for interpolation, got {len(anchor_blocks)}')
+
+    blocks = np.asarray(blocks, dtype=float)
+    times = np.interp(blocks, anchor_blocks, anchor_times)
+
+    lo_rate = (anchor_times[1]-anchor_times[0])/(anchor_blocks[1]-anchor_blocks[0])
+    hi_rate = (anchor_times[-1]-anchor_times[-2])/(anchor_blocks[-1]-anchor_blocks[-2])
+    times = np.where(blocks < anchor_blocks[0], anchor_times[0] + lo_rate*(blocks-anchor_blocks[0]), times)
+    times = np.where(blocks > anchor_blocks[-1], anchor_times[-1] + hi_rate*(blocks-anchor_blocks[-1]), times)
+    return times.round().astype('int64')
+
+
+def seed_anchors():
+    return {block: pd.Timestamp(time).value//10**6 for block, time in SEED_ANCHORS.items()}
+
+
+def block_to_time(blocks, make_subtensor=None, max_workers=8, path=DB_PATH):
+    """Maps blocks to timestamps, looking them up in the index first and fetching misses from chain if make_subtensor is given.
+
+    Blocks which could not be resolved are interpolated between the known blocks.
+    """
+    if not isinstance(blocks, pd.Series):
+        blocks = pd.Series(blocks)
+
+    unique_blocks = set(int(b) for b in blocks.unique())
+    timestamps = load_block_times(unique_blocks, path)
+    missing = unique_blocks.difference(timestamps)
+    print(f'Found {len(timestamps)}/{len(unique_blocks)} blocks in timestamp index {path!r}')
+
+    if missing and make_subtensor is not None:
+        timestamps.update(fetch_block_times(missing, make_subtensor, max_workers=max_workers, path=path))
+        missing = missing.difference(timestamps)
+
+    if missing:
+        print(f'Interpolating timestamps of {len(missing)} unresolved blocks')
+        anchors = {**seed_anchors(), **load_block_times(path=path)}
+        missing = sorted(missing)
+        timestamps.update(zip(missing, interpolate_block_times(missing, anchors)))
+
+    return pd.to_datetime(blocks.astype('int64').map(timestamps), unit='ms')
@@ -14,6 +14,10 @@ DEFAULT_SELECTED_HOTKEYS = None
 DEFAULT_SRC = 'followup'
 DEFAULT_COMPLETION_NTOP = 10
 DEFAULT_UID_NTOP = 10
+# columns which are read for each tab
+RUN_COLS = ['_step', 'task', 'uids', 'completions']
+UID_COLS = ['uids', 'completions', 'rewards']
+COMPLETION_COLS = ['_timestamp', 'uids', 'completions', 'rewards', 'timings']
 
 # Set app config
 st.set_page_config(
@@ -63,10 +67,8 @@ with tab1:
         n_runs = len(df_runs_subset)
 
     if n_runs:
-        df = io.load_data(df_runs_subset, load=True, save=True)
-        df = inspect.clean_data(df)
-        print(f'\nNans in columns: {df.isna().sum()}')
-        df_long = inspect.explode_data(df)
+        # each view reads only the columns and events it needs from the synced histories
+        df_long = io.load_data(df_runs_subset, columns=RUN_COLS, load=True, refresh=True)
     else:
         st.info(f'You must select at least one run to load data')
         st.stop()
@@ -79,11 +81,11 @@ with tab1:
         raw_data_col1, raw_data_col2 = st.columns(2)
         use_long_checkbox = raw_data_col1.checkbox('Use long format', value=True)
         num_rows = raw_data_col2.slider('Number of rows:', min_value=1, max_value=100, value=10, key='num_rows')
-        st.dataframe(df_long.head(num_rows) if use_long_checkbox else df.head(num_rows),
+        st.dataframe(io.load_data(df_runs_subset, explode=use_long_checkbox, limit=num_rows).head(num_rows),
                      use_container_width=True)
 
 # step_types = ['all']+['augment','followup','answer']#list(df.name.unique())
-step_types = ['all']+list(df.task.unique())
+step_types = ['all']+io.load_tasks(df_runs_subset)
 
 ### UID Health ###
 # TODO: Live time - time elapsed since moving_averaged_score for selected UID was 0 (lower bound so use >Time)
@@ -95,20 +97,22 @@ with tab2:
     st.info(f"Showing UID health metrics for **{n_runs} selected runs**")
 
     uid_src = st.radio('Select task type:', step_types, horizontal=True, key='uid_src')
-    df_uid = df_long[df_long.task.str.contains(uid_src)] if uid_src != 'all' else df_long
+    df_health = io.load_health(df_runs_subset)
+    df_uid_health = df_health.loc[df_health.task == uid_src] if uid_src != 'all' else df_health
+    df_uid = io.load_data(df_runs_subset, columns=UID_COLS, tasks=[uid_src] if uid_src != 'all' else None)
         
-    metric.uids(df_uid, uid_src)
-    uids = st.multiselect('UID:', sorted(df_uid['uids'].unique()), key='uid')
+    metric.uids(df_uid_health, uid_src)
+    uids = st.multiselect('UID:', sorted(df_uid_health['uids'].unique()), key='uid')
     with st.expander(f'Show UID health data for **{n_runs} selected runs** and **{len(uids)} selected UIDs**'):
         st.markdown('#')
         st.subheader(f"UID {uid_src.title()} :violet[Health]")
         agg_uid_checkbox = st.checkbox('Aggregate UIDs', value=True)
         if agg_uid_checkbox:
-            metric.uids(df_uid, uid_src, uids)
+            metric.uids(df_uid_health, uid_src, uids)
         else:
             for uid in uids:
                 st.caption(f'UID: {uid}')
-                metric.uids(df_uid, uid_src, [uid])
+                metric.uids(df_uid_health, uid_src, [uid])
 
         st.subheader(f'Cumulative completion frequency')
 
@@ -143,7 +147,7 @@ with tab2:
         st.markdown('#')
         st.subheader(f"UID {uid_src.title()} :violet[Diversity]")
         rm_failed = st.checkbox(f'Remove failed **{uid_src}** completions', value=True)
-        plot.uid_diversty(df, rm_failed)
+        plot.uid_diversty(df_uid, rm_failed)
 
 
 ### Completions ###
@@ -156,13 +160,14 @@ with tab3:
     msg_col1, msg_col2 = st.columns(2)
     # completion_src = msg_col1.radio('Select one:', ['followup', 'answer'], horizontal=True, key='completion_src')
     completion_src = st.radio('Select task type:', step_types, horizontal=True, key='completion_src')
-    df_comp = df_long[df_long.task.str.contains(completion_src)] if completion_src != 'all' else df_long
+    df_comp = io.load_data(df_runs_subset, columns=COMPLETION_COLS, tasks=[completion_src] if completion_src != 'all' else None)
     
     completion_info.info(f"Showing **{completion_src}** completions for **{n_runs} selected runs**")
 
     completion_ntop = msg_col2.slider('Top k:', min_value=1, max_value=50, value=DEFAULT_COMPLETION_NTOP, key='completion_ntop')
 
-    completions = inspect.completions(df_long, 'completions')
+    completion_index = io.load_completion_index(df_runs_subset, tasks=[completion_src] if completion_src != 'all' else None)
+    completions = inspect.completions(completion_index)
 
     # Get completions with highest average rewards
     plot.leaderboard(
@@ -180,17 +185,23 @@ with tab3:
         st.subheader('Completion :violet[Rewards]')
 
         completion_select = st.multiselect('Completions:', completions.index, default=completions.index[:3].tolist())
-        # completion_regex = st.text_input('Completion regex:', value='', key='completion_regex')
+        completion_regex = st.text_input('Completion regex (replaces the selection):', value='', key='completion_regex')
+        # only the uses of the selected completions are looked up in the completion index
+        df_selected = inspect.completion_postings(completion_index, completion_select, completion_regex)
 
         plot.completion_rewards(
-            df_comp,
+            df_selected,
             completion_col='completions',
             reward_col='rewards',
             uid_col='uids',
             ntop=completion_ntop,
-            completions=completion_select,
+            completions=None if completion_regex else completion_select,
+            completion_regex=completion_regex or None,
+            completion_counts=completions,
         )
-        # TODO: show the UIDs which have used the selected completions
+
+        st.subheader('Completion :violet[UIDs]')
+        st.dataframe(inspect.completion_uids(df_selected), use_container_width=True)
 
 
     with st.expander(f'Show **{completion_src}** completion length data for **{n_runs} selected runs**'):
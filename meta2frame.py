@@ -1,78 +1,78 @@
-import glob
-import tqdm
-import pickle
-import os
-import datetime
-
-import torch
 import bittensor as bt
 import pandas as pd
-import plotly.express as px
-
-
-ROOT_DIR = './data/metagraph/'
 
+import meta_store
+import block_times
 
-def load_metagraphs(root_dir, netuid, block_min=0, block_max=3_000_000):
 
-    metagraphs = []
-    match_path = os.path.join(root_dir, str(netuid), '*.pkl')
-    files = glob.glob(match_path)
-    print(f'Found {len(files)} metagraphs in {match_path}')
-
-    valid_files = [path for path in files if block_min <= int(path.split('/')[-1].split('.')[0]) <= block_max]
-    pbar = tqdm.tqdm(valid_files, desc=f'Loading {len(valid_files)} metagraph snapshots')
-    for path in pbar:
-
-        with open(path, 'rb') as f:
-            metagraph = pickle.load(f)
-            metagraphs.append(metagraph)
+ROOT_DIR = './data/metagraph/'
 
-    return sorted(metagraphs, key=lambda x: x.block)
 
+def block_to_time(blocks, subtensor=None, max_workers=8):
+    if subtensor is not None:
+        # a single connection cannot be shared between threads
+        return block_times.block_to_time(blocks, make_subtensor=lambda: subtensor, max_workers=1)
 
-def get_block_timestamp(block, subtensor):
+    return block_times.block_to_time(blocks, make_subtensor=lambda: bt.subtensor(network='archive'), max_workers=max_workers)
 
-    info = subtensor.substrate.get_block(block_number=int(block))
-    extrinsic_call = info['extrinsics'][0]['call']
-    return extrinsic_call.value_serialized['call_args'][0]['value']
 
+def iter_frames(netuid, root_dir=ROOT_DIR, cols=None, block_min=0, block_max=3_000_000, blocks=None, max_workers=4, window=8):
+    """Yields per-block frames in block order, with snapshots decoded in parallel."""
+    if cols is None:
+        cols = meta_store.SNAPSHOT_COLS
 
-def block_to_time(blocks, subtensor=None):
+    # weights are stored separately and can be loaded as sparse matrices with meta_store.read_weights
+    columns = ['block','netuid','uid'] + cols + meta_store.AXON_COLS
+    for _, frame in meta_store.iter_snapshots(netuid, block_min, block_max, columns=columns, blocks=blocks, max_workers=max_workers, window=window, root_dir=root_dir):
+        yield frame
 
-    if not isinstance(blocks, pd.Series):
-        blocks = pd.Series(blocks)
 
-    if subtensor is None:
-        subtensor = bt.subtensor(network='archive')
+def make_dataframe(netuid, root_dir=ROOT_DIR, cols=None, block_min=0, block_max=3_000_000, blocks=None):
+    frames = list(iter_frames(netuid, root_dir=root_dir, cols=cols, block_min=block_min, block_max=block_max, blocks=blocks))
+    df = pd.concat(frames, ignore_index=True)
+    print(f'Loaded {len(frames)} metagraph snapshots with {len(df)} rows from store')
 
-    timestamps = {}
-    unique_blocks = set(blocks)
-    for block in tqdm.tqdm(unique_blocks, desc=f'Mapping {len(unique_blocks)} blocks to timestamps'):
-        timestamps[block] = get_block_timestamp(block, subtensor)
+    df['timestamp'] = block_to_time(df['block'])
+    return df.sort_values(by=['timestamp','block','uid'])
 
-    return blocks.map(timestamps).apply(pd.to_datetime, unit='ms')
 
+def update_dataframe(netuid, root_dir=ROOT_DIR, block_min=0, block_max=3_000_000, rebuild=False, blocks_per_part=1000):
+    """Materializes snapshots in the block range which are not yet in the metagraph dataframe, so a refresh costs O(new blocks).
+
+    Snapshots are streamed and written out every blocks_per_part blocks, so memory does not grow with the number of new blocks.
+    With rebuild, all blocks in the range are materialized again and replace the ones in the dataframe, blocks outside it are kept.
+    """
+    available = [b for b in meta_store.list_blocks(netuid, root_dir) if block_min <= b <= block_max]
+    if rebuild:
+        new_blocks = available
+    else:
+        materialized = set(meta_store.read_manifest(netuid, root_dir)['blocks'])
+        new_blocks = [b for b in available if b not in materialized]
+
+    print(f'Materializing {len(new_blocks)}/{len(available)} blocks in range {block_min}-{block_max}')
+    # parts written before coldkey rollups existed get theirs now, new parts are rolled up as they are appended
+    meta_store.build_rollups(netuid, root_dir)
+    if not new_blocks:
+        return 0
+
+    def flush(frames, first):
+        df = pd.concat(frames, ignore_index=True)
+        df['timestamp'] = block_to_time(df['block'])
+        if rebuild and first:
+            meta_store.rebuild_dataframe(df, netuid, block_min=block_min, block_max=block_max, root_dir=root_dir)
+        else:
+            meta_store.append_dataframe(df, netuid, root_dir)
 
-def make_dataframe(netuid, root_dir=ROOT_DIR, cols=None, block_min=0, block_max=3_000_000, weights=False):
-    if cols is None:
-        cols = ['stake','emission','trust','validator_trust','dividends','incentive','R', 'consensus','validator_permit']
     frames = []
-    metagraphs = load_metagraphs(root_dir, netuid, block_min, block_max)
-
-    for m in metagraphs:
-        frame = pd.DataFrame({k: getattr(m, k) for k in cols})
-        frame['block'] = m.block.item()
-        frame['netuid'] = netuid
-        frame['uid'] = range(len(frame))
-        frame['hotkey'] = [axon.hotkey for axon in m.axons]
-        frame['coldkey'] = [axon.coldkey for axon in m.axons]
-        if weights and m.W is not None:
-            # convert NxN tensor to a list of lists so it fits into the dataframe
-            frame['weights'] = [w.tolist() for w in m.W]
-
+    n_parts = 0
+    for frame in iter_frames(netuid, root_dir=root_dir, block_min=min(new_blocks), block_max=max(new_blocks), blocks=new_blocks):
         frames.append(frame)
+        if len(frames) >= blocks_per_part:
+            flush(frames, first=n_parts == 0)
+            frames = []
+            n_parts += 1
 
-    df = pd.concat(frames)
-    df['timestamp'] = block_to_time(df['block'])
-    return df.sort_values(by=['timestamp','block','uid'])
+    if frames:
+        flush(frames, first=n_parts == 0)
+
+    return len(new_blocks)
@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import random
+import asyncio
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import bittensor
+from multigraph import process
+
+
+class BackfillQueue:
+    """Durable queue of pending and failed blocks, saved next to the snapshots so that a backfill survives restarts."""
+
+    def __init__(self, netuid, root_dir='data/metagraph/'):
+        self.path = os.path.join(root_dir, str(netuid), 'backfill_queue.json')
+        self.pending = set()
+        self.failed = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                state = json.load(f)
+            self.pending = set(state['pending'])
+            self.failed = {int(block): error for block, error in state['failed'].items()}
+
+    def add(self, blocks):
+        self.pending.update(int(b) for b in blocks)
+
+    def blocks(self):
+        # previously failed blocks are retried along with the pending ones
+        return sorted(self.pending.union(self.failed), reverse=True)
+
+    def done(self, block):
+        self.pending.discard(block)
+        self.failed.pop(block, None)
+
+    def fail(self, block, error):
+        self.pending.discard(block)
+        self.failed[block] = error
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'pending': sorted(self.pending), 'failed': {str(b): e for b, e in self.failed.items()}}, f)
+        os.replace(tmp_path, self.path)
+
+
+class AdaptiveLimiter:
+    """Concurrency limit which grows by one after a full window of successes and halves on failure (AIMD)."""
+
+    def __init__(self, initial=8, minimum=1, maximum=64):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.active = 0
+        self.successes = 0
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    def success(self):
+        self.successes += 1
+        if self.successes >= self.limit:
+            self.limit = min(self.maximum, self.limit + 1)
+            self.successes = 0
+
+    def failure(self):
+        self.limit = max(self.minimum, self.limit // 2)
+        self.successes = 0
+
+
+class ThroughputStats:
+
+    def __init__(self):
+        self.start = time.time()
+        self.latencies = []
+        self.failures = 0
+
+    def summary(self):
+        elapsed = time.time() - self.start
+        latencies = np.array(self.latencies) if self.latencies else np.array([np.nan])
+        return {
+            'blocks': len(self.latencies),
+            'failures': self.failures,
+            'blocks_per_sec': len(self.latencies) / elapsed if elapsed > 0 else 0,
+            'p50_latency': float(np.nanpercentile(latencies, 50)) if self.latencies else None,
+            'p99_latency': float(np.nanpercentile(latencies, 99)) if self.latencies else None,
+        }
+
+    def __str__(self):
+        s = self.summary()
+        p50 = f'{s["p50_latency"]:.2f}s' if s['p50_latency'] is not None else '--'
+        p99 = f'{s["p99_latency"]:.2f}s' if s['p99_latency'] is not None else '--'
+        return f'{s["blocks"]} blocks ({s["failures"]} failures), {s["blocks_per_sec"]:.2f} blocks/s, p50={p50}, p99={p99}'
+
+
+async def backfill(blocks, netuid=1, network='archive', lite=True, difficulty=False, max_concurrency=32, initial_concurrency=8,
+                   retries=5, backoff=1.0, max_backoff=60.0, save_every=50, log_every=30.0, root_dir='data/metagraph/'):
+    """Fetches metagraph snapshots for blocks with bounded, adaptive concurrency and exponential-backoff retries.
+
+    Blocks which are still failing after all retries are kept in the durable queue and retried by the next backfill.
+    """
+    queue = BackfillQueue(netuid, root_dir)
+    queue.add(blocks)
+    queue.save()
+    todo = queue.blocks()
+    print(f'Backfilling {len(todo)} blocks ({len(queue.failed)} previously failed) for netuid {netuid}')
+
+    limiter = AdaptiveLimiter(initial=min(initial_concurrency, max_concurrency), maximum=max_concurrency)
+    stats = ThroughputStats()
+    local = threading.local()
+    work = asyncio.Queue()
+    for block in todo:
+        work.put_nowait((block, 0))
+
+    def fetch(block):
+        # every thread keeps its own connection, as they cannot be shared between threads
+        if not hasattr(local, 'subtensor'):
+            local.subtensor = bittensor.subtensor(network=network)
+        return process(block, netuid=netuid, lite=lite, difficulty=difficulty, subtensor=local.subtensor, raise_errors=True)
+
+    loop = asyncio.get_running_loop()
+    completed = 0
+    last_log = time.time()
+    retrying = set()
+
+    async def retry_later(block, attempt, delay):
+        await asyncio.sleep(delay)
+        work.put_nowait((block, attempt))
+        # the failed attempt is only marked done once the retry is queued, so work.join() keeps waiting for it
+        work.task_done()
+
+    async def worker(executor):
+        nonlocal completed, last_log
+        while True:
+            block, attempt = await work.get()
+            try:
+                async with limiter:
+                    tic = time.time()
+                    await loop.run_in_executor(executor, fetch, block)
+                stats.latencies.append(time.time() - tic)
+                limiter.success()
+                queue.done(block)
+            except Exception as e:
+                limiter.failure()
+                if attempt < retries:
+                    delay = min(max_backoff, backoff * 2**attempt) * (0.5 + random.random())
+                    print(f'Error processing block {block} (attempt {attempt+1}/{retries+1}), retrying in {delay:.1f}s: {e}')
+                    # requeue without blocking the worker, so other blocks continue while this one backs off
+                    task = asyncio.create_task(retry_later(block, attempt+1, delay))
+                    retrying.add(task)
+                    task.add_done_callback(retrying.discard)
+                    continue
+                stats.failures += 1
+                queue.fail(block, f'{e.__class__.__name__}: {e}')
+
+            completed += 1
+            if completed % save_every == 0:
+                queue.save()
+            if time.time() - last_log > log_every:
+                print(f'Backfill progress: {stats}, concurrency={limiter.limit}', flush=True)
+                last_log = time.time()
+            work.task_done()
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        workers = [asyncio.create_task(worker(executor)) for _ in range(max_concurrency)]
+        await work.join()
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    queue.save()
+    print(f'Backfill finished: {stats}. {len(queue.failed)} blocks failed and remain queued in {queue.path!r}')
+    return stats.summary()
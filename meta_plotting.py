@@ -2,6 +2,7 @@ import numpy as np
 import pandas as pd
 import plotly.express as px
 from plotly.subplots import make_subplots
+from meta_utils import hotkey_churn
 
 plotly_config = dict(width=800, height=600, template='plotly_white')
 
@@ -35,14 +36,22 @@ def plot_trace(df, col='emission', agg='mean', time_col='timestamp', ntop=10, ho
             ).update_traces(opacity=opacity)
     
     
-def plot_cabals(df, sel_col='coldkey', count_col='hotkey', time_col='timestamp', values=None, ntop=10, abbr=8, smooth=1, smooth_agg='mean', opacity=0.):
-    
-    if values is None:
-        values = df[sel_col].value_counts().sort_values(ascending=False).index[:ntop].tolist()
-        print(f'Automatically selected {sel_col!r} = {values!r}')
-        
-    df = df.loc[df[sel_col].isin(values)]
-    rates = df.groupby([time_col,sel_col])[count_col].nunique().reset_index()
+def plot_cabals(df, sel_col='coldkey', count_col='hotkey', time_col='timestamp', values=None, ntop=10, abbr=8, smooth=1, smooth_agg='mean', opacity=0., rollup=None):
+    """
+    Produces a plotly figure which shows the number of unique count_col per sel_col over time. When counting per coldkey, the precomputed meta_store.coldkey_rollup can be passed as rollup.
+    """
+    if rollup is not None and sel_col == 'coldkey' and f'{count_col}_nunique' in rollup.columns:
+        if values is None:
+            values = rollup.groupby(sel_col).uid_count.sum().sort_values(ascending=False).index[:ntop].tolist()
+            print(f'Automatically selected {sel_col!r} = {values!r}')
+        rates = rollup.loc[rollup[sel_col].isin(values), [time_col, sel_col, f'{count_col}_nunique']].rename(columns={f'{count_col}_nunique': count_col})
+    else:
+        if values is None:
+            values = df[sel_col].value_counts().sort_values(ascending=False).index[:ntop].tolist()
+            print(f'Automatically selected {sel_col!r} = {values!r}')
+
+        df = df.loc[df[sel_col].isin(values)]
+        rates = df.groupby([time_col,sel_col])[count_col].nunique().reset_index()
     
     # smoothing is hard
     # rates = rates.groupby(level=1).rolling(smooth, min_periods=1).agg(smooth_agg)
@@ -57,31 +66,16 @@ def plot_cabals(df, sel_col='coldkey', count_col='hotkey', time_col='timestamp',
                 **plotly_config
             ).update_traces(opacity=opacity)        
         
-def plot_churn(df, time_col='timestamp', type='changed', step=1, smooth=1, smooth_agg='mean', opacity=0.5):
+def plot_churn(df, time_col='timestamp', type='changed', step=1, smooth=1, smooth_agg='mean', opacity=0.5, churn=None):
     """
-    Produces a plotly figure which shows number of changed hotkeys in each step
+    Produces a plotly figure which shows number of changed hotkeys in each step. A precomputed meta_utils.hotkey_churn frame can be passed as churn.
     """
-    
-    def churn(s):
-        results = [{'delta':np.nan}]
-        for i, idx in enumerate(s.index[1:]):
-    
-            curr = s.loc[idx]
-            prev = s.iloc[i]
-            if type == 'changed':
-                delta = curr.symmetric_difference(prev)
-            elif type == 'added':
-                delta = curr.difference(prev)
-            elif type == 'removed':
-                delta = prev.difference(curr)
-            else:
-                raise ValueError(f'Unknown type {type!r}')
-            
-            results.append({'delta': len(delta)})
-    
-        return pd.DataFrame(results, index=s.index)
- 
-    churn_frame = churn(df.iloc[::step].groupby(['block','timestamp']).hotkey.unique().apply(set))
+    if type not in ('changed', 'added', 'removed'):
+        raise ValueError(f'Unknown type {type!r}')
+
+    if churn is None:
+        churn = hotkey_churn(df, step=step)
+    churn_frame = churn[[type]].rename(columns={type: 'delta'})
     
     return px.line(churn_frame.rolling(smooth, min_periods=1).agg(smooth_agg).reset_index(),
                    x=time_col, y='delta', 
@@ -114,25 +108,32 @@ def plot_occupancy(df, time_col='timestamp',step=1, smooth=1, smooth_agg='mean',
     
     return fig.update_layout( **plotly_config).update_traces(opacity=opacity)
 
-def plot_animation(df, x='emission_sum', y='total_stake_sum', color='emission_mean', size='hotkey_nunique', step=10, opacity=0.5):
-    
-    agg_dict = {}
-    for column_name in [x, y, color, size]:
-        column, agg_name = column_name.rsplit('_', 1)
-
-        if column not in agg_dict:
-            agg_dict[column] = [agg_name]
-        else:
-            agg_dict[column].append(agg_name)
+def plot_animation(df, x='emission_sum', y='total_stake_sum', color='emission_mean', size='hotkey_nunique', step=10, opacity=0.5, rollup=None):
+    """
+    Produces an animated scatter of coldkey aggregates over blocks. The precomputed meta_store.coldkey_rollup can be passed as rollup, in which case df is not used.
+    """
+    if rollup is not None:
+        df = rollup
     
     # select every nth block
     if step>1:
         blocks_subset = df.block.unique()[::step]
         df = df.loc[df.block.isin(blocks_subset)]
-        
-    df_agg = df.groupby(['block','timestamp','coldkey']).agg({'hotkey':'nunique', 'ip':'nunique', **agg_dict})
-    df_agg.columns = ['_'.join(col).strip() for col in df_agg.columns]
-    print(df_agg.columns)
+
+    if rollup is not None:
+        df_agg = df.set_index(['block','timestamp','coldkey'])[list(dict.fromkeys([x, y, color, size]))]
+    else:
+        agg_dict = {}
+        for column_name in [x, y, color, size]:
+            column, agg_name = column_name.rsplit('_', 1)
+
+            if column not in agg_dict:
+                agg_dict[column] = [agg_name]
+            else:
+                agg_dict[column].append(agg_name)
+
+        df_agg = df.groupby(['block','timestamp','coldkey']).agg({'hotkey':'nunique', 'ip':'nunique', **agg_dict})
+        df_agg.columns = ['_'.join(col).strip() for col in df_agg.columns]
     
     return px.scatter(df_agg.reset_index(), 
                 x=x, range_x=[-df_agg[x].max()*0.1, df_agg[x].max()*1.1],
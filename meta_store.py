@@ -0,0 +1,556 @@
+import os
+import json
+import fcntl
+import contextlib
+import glob
+import pickle
+import tqdm
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+ROOT_DIR = './data/metagraph/'
+# number of blocks in each block_range partition of the snapshot store
+PARTITION_SIZE = 10_000
+# rows of the metagraph dataframe are grouped so that block range filters can skip row groups
+BLOCKS_PER_ROW_GROUP = 10
+
+SNAPSHOT_COLS = ['stake','total_stake','ranks','emission','trust','validator_trust','dividends','incentive','consensus','validator_permit']
+AXON_COLS = ['hotkey','coldkey','ip','port']
+
+# columns and aggregates which the dashboard offers for miner and validator activity, all of which are precomputed in the coldkey rollup
+MINER_COLS = ['total_stake','incentive','emission','consensus','trust']
+VALIDATOR_COLS = ['total_stake','incentive','emission','consensus','validator_trust','dividends']
+ROLLUP_AGGS = ['mean','sum','std','max','min']
+ROLLUP_COUNTS = ['hotkey_nunique','ip_nunique']
+
+hotkey_type = pa.dictionary(pa.int32(), pa.string())
+SNAPSHOT_SCHEMA = pa.schema(
+    [('block', pa.int64()), ('netuid', pa.int32()), ('uid', pa.int32())] +
+    [(c, pa.bool_() if c == 'validator_permit' else pa.float32()) for c in SNAPSHOT_COLS] +
+    [('hotkey', hotkey_type), ('coldkey', hotkey_type), ('ip', pa.string()), ('port', pa.int32()), ('difficulty', pa.float64())]
+)
+
+
+def snapshot_dir(netuid, root_dir=ROOT_DIR):
+    return os.path.join(root_dir, str(netuid), 'snapshots')
+
+
+def partition_of(block):
+    return (int(block)//PARTITION_SIZE)*PARTITION_SIZE
+
+
+def snapshot_path(block, netuid, root_dir=ROOT_DIR):
+    return os.path.join(snapshot_dir(netuid, root_dir), f'block_range={partition_of(block)}', f'{block}.parquet')
+
+
+def metagraph_to_frame(metagraph, netuid, cols=None):
+    if cols is None:
+        cols = SNAPSHOT_COLS
+
+    frame = pd.DataFrame({k: getattr(metagraph, k) for k in cols})
+    frame.insert(0, 'uid', range(len(frame)))
+    frame.insert(0, 'netuid', netuid)
+    frame.insert(0, 'block', metagraph.block.item())
+    for c in AXON_COLS:
+        frame[c] = [getattr(axon, c) for axon in metagraph.axons]
+    frame['difficulty'] = getattr(metagraph, 'difficulty', None)
+    return frame
+
+
+def _store_dir(netuid, root_dir=ROOT_DIR, kind='snapshots'):
+    return weights_dir(netuid, root_dir) if kind == 'weights' else snapshot_dir(netuid, root_dir)
+
+
+def _catalog_paths(netuid, root_dir=ROOT_DIR, kind='snapshots'):
+    base = _store_dir(netuid, root_dir, kind)
+    return os.path.join(base, 'catalog.json'), os.path.join(base, 'catalog.log'), os.path.join(base, 'catalog.lock')
+
+
+@contextlib.contextmanager
+def _catalog_lock(netuid, root_dir=ROOT_DIR, kind='snapshots'):
+    # writers in different processes take turns, readers never need the lock
+    lock_path = _catalog_paths(netuid, root_dir, kind)[2]
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def append_catalog(entries, netuid, root_dir=ROOT_DIR, kind='snapshots'):
+    """Records snapshot locations as {block, path, rows, offset} entries. Later entries of a block replace earlier ones.
+
+    Entries are appended to a log as whole lines, so concurrent writers cost O(1) and readers never see a partial update.
+    Weight matrices have their own catalog of {block, path, rows} entries, which is used with kind='weights'.
+    """
+    if not any(os.path.exists(path) for path in _catalog_paths(netuid, root_dir, kind)[:2]):
+        # stores written before the catalog existed are scanned once, before the first entry is logged
+        read_catalog(netuid, root_dir, kind)
+    with _catalog_lock(netuid, root_dir, kind):
+        with open(_catalog_paths(netuid, root_dir, kind)[1], 'a') as f:
+            f.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+
+
+def _scan_catalog(netuid, root_dir=ROOT_DIR, kind='snapshots'):
+    # fallback for stores written before the catalog existed
+    entries = []
+    for path in glob.glob(os.path.join(_store_dir(netuid, root_dir, kind), 'block_range=*', '*.parquet')):
+        rel_path = os.path.relpath(path, _store_dir(netuid, root_dir, kind))
+        if kind == 'weights':
+            entries.append({'block': int(os.path.basename(path).split('.')[0]), 'path': rel_path, 'rows': pq.read_metadata(path).num_rows})
+        elif os.path.basename(path) == 'delta.parquet':
+            entries.extend({'block': b, 'path': rel_path, 'rows': n, 'offset': None} for b, n in zip(*_delta_blocks(path)))
+        else:
+            entries.append({'block': int(os.path.basename(path).split('.')[0]), 'path': rel_path, 'rows': pq.read_metadata(path).num_rows, 'offset': 0})
+    return entries
+
+
+def read_catalog(netuid, root_dir=ROOT_DIR, kind='snapshots'):
+    """Returns a {block: entry} dict of all snapshots (or weight matrices) in the store, without listing any directories."""
+    catalog_path, log_path, _ = _catalog_paths(netuid, root_dir, kind)
+    if not os.path.exists(catalog_path) and not os.path.exists(log_path):
+        if not os.path.exists(_store_dir(netuid, root_dir, kind)):
+            return {}
+        print(f'No {kind} catalog found for netuid {netuid}, building one from the {kind} files')
+        checkpoint_catalog(netuid, root_dir, entries=_scan_catalog(netuid, root_dir, kind), kind=kind)
+
+    catalog = {}
+    if os.path.exists(catalog_path):
+        with open(catalog_path) as f:
+            catalog = {int(block): entry for block, entry in json.load(f).items()}
+
+    if os.path.exists(log_path):
+        with open(log_path) as f:
+            for line in f:
+                if line.endswith('\n'):
+                    entry = json.loads(line)
+                    catalog[entry['block']] = entry
+
+    return catalog
+
+
+def checkpoint_catalog(netuid, root_dir=ROOT_DIR, entries=None, kind='snapshots'):
+    """Folds the catalog log into catalog.json, so that readers do not have to replay a long log."""
+    catalog_path, log_path, _ = _catalog_paths(netuid, root_dir, kind)
+    with _catalog_lock(netuid, root_dir, kind):
+        catalog = {} if entries is not None else read_catalog(netuid, root_dir, kind)
+        catalog.update({entry['block']: entry for entry in entries or []})
+        tmp_path = f'{catalog_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({str(block): entry for block, entry in sorted(catalog.items())}, f)
+        os.replace(tmp_path, catalog_path)
+        open(log_path, 'w').close()
+
+    return len(catalog)
+
+
+def write_snapshot(frame, netuid, root_dir=ROOT_DIR):
+    """Writes the frame of a single block to the snapshot store, replacing any existing snapshot of that block."""
+    block = int(frame['block'].iloc[0])
+    path = snapshot_path(block, netuid, root_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    table = pa.Table.from_pandas(frame, schema=SNAPSHOT_SCHEMA, preserve_index=False)
+    # write to a temporary file first so that readers never see a partially written snapshot
+    tmp_path = f'{path}.tmp'
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+    append_catalog([{'block': block, 'path': os.path.relpath(path, snapshot_dir(netuid, root_dir)), 'rows': table.num_rows, 'offset': 0}], netuid, root_dir)
+    return path
+
+
+def delta_path(partition, netuid, root_dir=ROOT_DIR):
+    return os.path.join(snapshot_dir(netuid, root_dir), f'block_range={partition}', 'delta.parquet')
+
+
+def _delta_blocks(path):
+    # blocks and network sizes of a delta file are kept in its metadata, as unchanged blocks have no rows
+    metadata = pq.read_schema(path).metadata
+    return json.loads(metadata[b'blocks']), json.loads(metadata[b'n'])
+
+
+def _is_delta(entry):
+    return os.path.basename(entry['path']) == 'delta.parquet'
+
+
+def list_blocks(netuid, root_dir=ROOT_DIR):
+    return sorted(read_catalog(netuid, root_dir))
+
+
+def _decode_categories(df):
+    # decode dictionary columns to plain strings, as categorical keys blow up downstream groupbys
+    for c in df.columns:
+        if isinstance(df[c].dtype, pd.CategoricalDtype):
+            df[c] = df[c].astype(str)
+    return df
+
+
+def read_delta(path, block_min=0, block_max=3_000_000, blocks=None):
+    """Rebuilds full snapshots from a delta file, by taking the most recent row of each uid at or before every block."""
+    all_blocks, ns = _delta_blocks(path)
+    target = pd.DataFrame({'block': np.repeat(all_blocks, ns), 'uid': np.concatenate([np.arange(n) for n in ns])})
+    target = target.loc[target.block.between(block_min, block_max)]
+    if blocks is not None:
+        target = target.loc[target.block.isin(blocks)]
+    if target.empty:
+        return pd.DataFrame(columns=SNAPSHOT_SCHEMA.names)
+
+    deltas = _decode_categories(pq.read_table(path, filters=[('block','<=',int(target.block.max()))]).to_pandas())
+    target = target.astype({'block': 'int64', 'uid': 'int32'}).sort_values('block')
+    frame = pd.merge_asof(target, deltas.drop(columns='block_range', errors='ignore').sort_values('block'), on='block', by='uid', direction='backward')
+    return frame[SNAPSHOT_SCHEMA.names]
+
+
+def compact_partition(partition, netuid, root_dir=ROOT_DIR, catalog=None):
+    """Rewrites all snapshots in a partition as one delta file.
+
+    The first block is a keyframe holding every row, later blocks only hold rows of uids which changed since the previous block.
+    Returns the number of rows written.
+    """
+    if catalog is None:
+        catalog = read_catalog(netuid, root_dir)
+    entries = [entry for block, entry in catalog.items() if partition_of(block) == partition]
+    block_paths = sorted(set(os.path.join(snapshot_dir(netuid, root_dir), entry['path']) for entry in entries if not _is_delta(entry)))
+    frames = [pq.read_table(path, schema=SNAPSHOT_SCHEMA).to_pandas() for path in block_paths]
+
+    path = delta_path(partition, netuid, root_dir)
+    if os.path.exists(path):
+        # snapshots written after the last compaction replace the decoded ones
+        frames.append(read_delta(path, blocks=[entry['block'] for entry in entries if _is_delta(entry)]))
+    if not frames:
+        return 0
+
+    df = _decode_categories(pd.concat(frames, ignore_index=True)).sort_values(by=['uid','block'], ignore_index=True)
+    all_blocks = sorted(df.block.unique().tolist())
+    ns = df.groupby('block').uid.max().add(1).loc[all_blocks].tolist()
+
+    # a row is kept if its uid was absent in the previous block, or if any of its values changed since then
+    prev_block = df.block.map(dict(zip(all_blocks[1:], all_blocks[:-1])))
+    values = df.drop(columns=['block','uid'])
+    prev_values = df.groupby('uid')[values.columns.tolist()].shift()
+    changed = ((values != prev_values) & ~(values.isna() & prev_values.isna())).any(axis=1)
+    changed |= df.groupby('uid').block.shift().ne(prev_block)
+
+    deltas = df.loc[changed].sort_values(by=['block','uid'])
+    table = pa.Table.from_pandas(deltas, schema=SNAPSHOT_SCHEMA, preserve_index=False)
+    table = table.replace_schema_metadata({'blocks': json.dumps([int(b) for b in all_blocks]), 'n': json.dumps([int(n) for n in ns])})
+    tmp_path = f'{path}.tmp'
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+    # point the catalog at the delta file before the per-block files go away, with the offset of each block's delta rows
+    delta_rows = deltas.groupby('block').size().reindex(all_blocks, fill_value=0)
+    offsets = delta_rows.cumsum() - delta_rows
+    rel_path = os.path.relpath(path, snapshot_dir(netuid, root_dir))
+    append_catalog([{'block': int(b), 'path': rel_path, 'rows': int(n), 'offset': int(offsets[b])} for b, n in zip(all_blocks, ns)], netuid, root_dir)
+
+    for block_path in block_paths:
+        os.remove(block_path)
+
+    print(f'Compacted {len(all_blocks)} blocks in partition {partition} to {table.num_rows}/{len(df)} rows')
+    return table.num_rows
+
+
+def compact_snapshots(netuid, before_block=None, root_dir=ROOT_DIR):
+    """Compacts every partition which has per-block snapshot files, optionally only those which end before before_block."""
+    catalog = read_catalog(netuid, root_dir)
+    partitions = sorted(set(partition_of(block) for block, entry in catalog.items() if not _is_delta(entry)))
+    if before_block is not None:
+        partitions = [p for p in partitions if p + PARTITION_SIZE <= before_block]
+
+    n_rows = sum(compact_partition(partition, netuid, root_dir, catalog) for partition in partitions)
+    checkpoint_catalog(netuid, root_dir)
+    return n_rows
+
+
+def list_partitions(netuid, block_min=0, block_max=3_000_000, root_dir=ROOT_DIR, catalog=None):
+    if catalog is None:
+        catalog = read_catalog(netuid, root_dir)
+    return sorted(set(partition_of(block) for block in catalog if block_min <= block <= block_max))
+
+
+def read_partition(partition, netuid, block_min=0, block_max=3_000_000, columns=None, blocks=None, root_dir=ROOT_DIR, catalog=None):
+    """Reads the snapshots of one partition from the files listed in the catalog."""
+    columns = columns or SNAPSHOT_SCHEMA.names
+    if catalog is None:
+        catalog = read_catalog(netuid, root_dir)
+    entries = [
+        entry for block, entry in catalog.items()
+        if partition_of(block) == partition and block_min <= block <= block_max and (blocks is None or block in blocks)
+    ]
+
+    frames = []
+    block_paths = [os.path.join(snapshot_dir(netuid, root_dir), entry['path']) for entry in entries if not _is_delta(entry)]
+    if block_paths:
+        table = ds.dataset(block_paths, schema=SNAPSHOT_SCHEMA, format='parquet').to_table(columns=columns)
+        frames.append(_decode_categories(table.to_pandas()))
+
+    delta_blocks = [entry['block'] for entry in entries if _is_delta(entry)]
+    if delta_blocks:
+        frames.append(read_delta(delta_path(partition, netuid, root_dir), blocks=delta_blocks)[columns])
+
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True).sort_values(by=['block','uid'], ignore_index=True)
+
+
+def read_snapshots(netuid, block_min=0, block_max=3_000_000, columns=None, blocks=None, root_dir=ROOT_DIR):
+    """Reads snapshots in [block_min, block_max] from the store, optionally restricted to a list of blocks. Partitions outside the range are never opened."""
+    catalog = read_catalog(netuid, root_dir)
+    blocks = set(int(b) for b in blocks) if blocks is not None else None
+    frames = [
+        read_partition(partition, netuid, block_min, block_max, columns, blocks, root_dir, catalog)
+        for partition in list_partitions(netuid, block_min, block_max, root_dir, catalog)
+    ]
+    frames = [frame for frame in frames if len(frame)]
+    if not frames:
+        return pd.DataFrame(columns=columns or SNAPSHOT_SCHEMA.names)
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def iter_snapshots(netuid, block_min=0, block_max=3_000_000, columns=None, blocks=None, max_workers=4, window=8, root_dir=ROOT_DIR):
+    """Yields (block, frame) pairs in block order, decoding partitions in a thread pool.
+
+    At most `window` partitions are decoded or waiting to be consumed at once, so memory is bounded by the window rather than the range.
+    """
+    catalog = read_catalog(netuid, root_dir)
+    blocks = set(int(b) for b in blocks) if blocks is not None else None
+    partitions = list_partitions(netuid, block_min, block_max, root_dir, catalog)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = deque()
+        for partition in partitions:
+            futures.append(executor.submit(read_partition, partition, netuid, block_min, block_max, columns, blocks, root_dir, catalog))
+            if len(futures) < window:
+                continue
+            yield from futures.popleft().result().groupby('block', sort=True)
+
+        while futures:
+            yield from futures.popleft().result().groupby('block', sort=True)
+
+
+def weights_dir(netuid, root_dir=ROOT_DIR):
+    return os.path.join(root_dir, str(netuid), 'weights')
+
+
+def write_weights(weights, block, netuid, quantize=True, root_dir=ROOT_DIR):
+    """Writes the nonzero entries of an NxN weight matrix as (block, src_uid, dst_uid, value) triplets.
+
+    With quantize, values are rounded to float16 and stored as their raw uint16 bits, as older parquet writers have no float16 type.
+    """
+    weights = np.asarray(weights, dtype=np.float32)
+    src, dst = np.nonzero(weights)
+    values = weights[src, dst]
+    if quantize:
+        values = values.astype(np.float16).view(np.uint16)
+
+    table = pa.table({
+        'block': pa.array(np.full(len(src), block), type=pa.int64()),
+        'src_uid': pa.array(src, type=pa.int32()),
+        'dst_uid': pa.array(dst, type=pa.int32()),
+        'value': pa.array(values),
+    }).replace_schema_metadata({'n': str(weights.shape[1]), 'quantized': str(quantize)})
+
+    path = os.path.join(weights_dir(netuid, root_dir), f'block_range={partition_of(block)}', f'{block}.parquet')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+    append_catalog([{'block': int(block), 'path': os.path.relpath(path, weights_dir(netuid, root_dir)), 'rows': table.num_rows}], netuid, root_dir, kind='weights')
+    return path
+
+
+def read_weights(netuid, block_min=0, block_max=3_000_000, root_dir=ROOT_DIR):
+    """Returns a {block: scipy.sparse.csr_matrix} dict of the weight matrices in [block_min, block_max], found in the weights catalog."""
+    catalog = read_catalog(netuid, root_dir, kind='weights')
+    matrices = {}
+    for block in sorted(b for b in catalog if block_min <= b <= block_max):
+        table = pq.read_table(os.path.join(weights_dir(netuid, root_dir), catalog[block]['path']))
+        metadata = table.schema.metadata
+        n = int(metadata[b'n'])
+        values = table['value'].to_numpy()
+        if metadata[b'quantized'] == b'True':
+            values = values.view(np.float16)
+        values = values.astype(np.float32)
+
+        coo = (values, (table['src_uid'].to_numpy(), table['dst_uid'].to_numpy()))
+        matrices[block] = sp.coo_matrix(coo, shape=(n, n)).tocsr()
+
+    return matrices
+
+
+def import_pickles(netuid, root_dir=ROOT_DIR, overwrite=False):
+    """One-time migration of legacy {block}.pkl metagraph snapshots into the store."""
+    files = glob.glob(os.path.join(root_dir, str(netuid), '*.pkl'))
+    existing = set() if overwrite else set(list_blocks(netuid, root_dir))
+    files = [path for path in files if int(os.path.basename(path).split('.')[0]) not in existing]
+
+    for path in tqdm.tqdm(files, desc=f'Importing {len(files)} metagraph pickles'):
+        with open(path, 'rb') as f:
+            metagraph = pickle.load(f)
+        write_snapshot(metagraph_to_frame(metagraph, netuid), netuid, root_dir)
+        weights = getattr(metagraph, 'weights', None)
+        if weights is not None and np.asarray(weights).size > 0:
+            write_weights(weights, metagraph.block.item(), netuid, root_dir=root_dir)
+
+    return len(files)
+
+
+def frame_dir(netuid, root_dir=ROOT_DIR):
+    return os.path.join(root_dir, str(netuid), 'df')
+
+
+def read_manifest(netuid, root_dir=ROOT_DIR):
+    """Returns the manifest of the metagraph dataframe, which lists the parts and the blocks materialized in them."""
+    path = os.path.join(frame_dir(netuid, root_dir), 'manifest.json')
+    if not os.path.exists(path):
+        return {'blocks': [], 'parts': []}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(manifest, netuid, root_dir=ROOT_DIR):
+    path = os.path.join(frame_dir(netuid, root_dir), 'manifest.json')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def append_dataframe(df, netuid, root_dir=ROOT_DIR):
+    """Appends the rows of newly materialized blocks to the metagraph dataframe as a new part file.
+
+    Each part is written in row groups spanning BLOCKS_PER_ROW_GROUP blocks, so block range filters can skip row groups.
+    """
+    manifest = read_manifest(netuid, root_dir)
+    duplicates = set(df['block'].unique()).intersection(manifest['blocks'])
+    if duplicates:
+        raise ValueError(f'Blocks {sorted(duplicates)} are already materialized, use rebuild_dataframe to replace them')
+
+    df = df.sort_values(by=['block','uid'])
+    block_min, block_max = int(df['block'].min()), int(df['block'].max())
+    path = os.path.join(frame_dir(netuid, root_dir), f'part-{block_min}-{block_max}-{len(manifest["parts"])}.parquet')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    rows_per_block = df.groupby('block').size().max()
+    df.to_parquet(path, index=False, row_group_size=int(rows_per_block*BLOCKS_PER_ROW_GROUP))
+
+    rollup_path = os.path.join(rollup_dir(netuid, root_dir), os.path.basename(path))
+    os.makedirs(os.path.dirname(rollup_path), exist_ok=True)
+    coldkey_rollup(df).to_parquet(rollup_path, index=False)
+
+    # the manifest is only updated once the part is complete, so a failed run never leaves blocks half materialized
+    manifest['blocks'] = sorted(set(manifest['blocks']).union(int(b) for b in df['block'].unique()))
+    manifest['parts'].append({'path': os.path.basename(path), 'block_min': block_min, 'block_max': block_max, 'rows': len(df), 'rollup': True})
+    write_manifest(manifest, netuid, root_dir)
+    return path
+
+
+def rebuild_dataframe(df, netuid, block_min=0, block_max=3_000_000, root_dir=ROOT_DIR):
+    """Replaces the blocks in [block_min, block_max] of the metagraph dataframe with df.
+
+    Parts inside the range are removed, and parts which overlap its edges are rewritten with only their blocks outside of it.
+    """
+    manifest = read_manifest(netuid, root_dir)
+    parts = []
+    for part in manifest['parts']:
+        if part['block_max'] < block_min or part['block_min'] > block_max:
+            parts.append(part)
+            continue
+
+        path = os.path.join(frame_dir(netuid, root_dir), part['path'])
+        rollup_path = os.path.join(rollup_dir(netuid, root_dir), part['path'])
+        kept = pd.read_parquet(path)
+        kept = kept.loc[(kept['block'] < block_min) | (kept['block'] > block_max)]
+        if kept.empty:
+            os.remove(path)
+            if part.get('rollup'):
+                os.remove(rollup_path)
+            continue
+
+        rows_per_block = kept.groupby('block').size().max()
+        kept.to_parquet(path, index=False, row_group_size=int(rows_per_block*BLOCKS_PER_ROW_GROUP))
+        os.makedirs(os.path.dirname(rollup_path), exist_ok=True)
+        coldkey_rollup(kept).to_parquet(rollup_path, index=False)
+        parts.append({**part, 'block_min': int(kept['block'].min()), 'block_max': int(kept['block'].max()), 'rows': len(kept), 'rollup': True})
+
+    blocks = [b for b in manifest['blocks'] if b < block_min or b > block_max]
+    write_manifest({'blocks': blocks, 'parts': parts}, netuid, root_dir)
+    return append_dataframe(df, netuid, root_dir)
+
+
+def read_dataframe(netuid, block_min=0, block_max=3_000_000, columns=None, root_dir=ROOT_DIR):
+    """Reads the metagraph dataframe for blocks in [block_min, block_max]. Only parts overlapping the range are opened."""
+    parts = [part for part in read_manifest(netuid, root_dir)['parts'] if part['block_max'] >= block_min and part['block_min'] <= block_max]
+    if not parts:
+        return pd.DataFrame(columns=columns)
+
+    paths = [os.path.join(frame_dir(netuid, root_dir), part['path']) for part in parts]
+    frames = [pd.read_parquet(path, columns=columns, filters=[('block','>=',block_min), ('block','<=',block_max)]) for path in paths]
+    return pd.concat(frames, ignore_index=True).sort_values(by=['block','uid'], ignore_index=True)
+
+
+def rollup_dir(netuid, root_dir=ROOT_DIR):
+    return os.path.join(root_dir, str(netuid), 'rollup')
+
+
+def coldkey_rollup(df):
+    """Aggregates the metagraph dataframe per (block, timestamp, type, coldkey), where type is 'miner' or 'validator'.
+
+    Columns are named {col}_{agg} for every column in MINER_COLS and VALIDATOR_COLS and every agg in ROLLUP_AGGS, plus ROLLUP_COUNTS and uid_count.
+    """
+    cols = list(dict.fromkeys(MINER_COLS + VALIDATOR_COLS))
+    # rows with unknown validator trust belong to neither type, as in the dashboard
+    types = np.select([df['validator_trust'] == 0, df['validator_trust'] > 0], ['miner', 'validator'], None)
+
+    rollup = df.assign(type=types).groupby(['block','timestamp','type','coldkey'], observed=True).agg(
+        {**{col: ROLLUP_AGGS for col in cols}, 'hotkey': 'nunique', 'ip': 'nunique', 'uid': 'count'}
+    )
+    rollup.columns = ['_'.join(col) for col in rollup.columns]
+    return rollup.reset_index()
+
+
+def build_rollups(netuid, root_dir=ROOT_DIR):
+    """Builds the coldkey rollup of dataframe parts which were materialized before rollups existed."""
+    manifest = read_manifest(netuid, root_dir)
+    missing = [part for part in manifest['parts'] if not part.get('rollup')]
+    for part in tqdm.tqdm(missing, desc='Building coldkey rollups'):
+        df = pd.read_parquet(os.path.join(frame_dir(netuid, root_dir), part['path']))
+        path = os.path.join(rollup_dir(netuid, root_dir), part['path'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        coldkey_rollup(df).to_parquet(path, index=False)
+        part['rollup'] = True
+
+    if missing:
+        write_manifest(manifest, netuid, root_dir)
+    return len(missing)
+
+
+def read_rollup(netuid, block_min=0, block_max=3_000_000, type=None, columns=None, root_dir=ROOT_DIR):
+    """Reads the coldkey rollup for blocks in [block_min, block_max], optionally for a single type ('miner' or 'validator')."""
+    parts = [part for part in read_manifest(netuid, root_dir)['parts']
+             if part.get('rollup') and part['block_max'] >= block_min and part['block_min'] <= block_max]
+    if columns is not None:
+        columns = list(dict.fromkeys(['block','timestamp','type','coldkey'] + columns))
+    if not parts:
+        return pd.DataFrame(columns=columns)
+
+    filters = [('block','>=',block_min), ('block','<=',block_max)]
+    if type is not None:
+        filters.append(('type','==',type))
+    paths = [os.path.join(rollup_dir(netuid, root_dir), part['path']) for part in parts]
+    frames = [pd.read_parquet(path, columns=columns, filters=filters) for path in paths]
+    return pd.concat(frames, ignore_index=True).sort_values(by=['block','coldkey'], ignore_index=True)
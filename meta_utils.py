@@ -1,16 +1,18 @@
-import os
 import re
-import glob
-import tqdm
+import numpy as np
 import dill as pickle
 import subprocess
 import pandas as pd
-import datetime
 from functools import lru_cache
 
-block_time_500k = datetime.datetime(2023, 5, 29, 5, 29, 0)
-block_time_800k = datetime.datetime(2023, 7, 9, 21, 32, 48)
-dt = (pd.Timestamp(block_time_800k)-pd.Timestamp(block_time_500k))/(800_000-500_000)
+import meta_store
+import block_times
+
+
+def approximate_block_time(blocks):
+    # interpolate between blocks in the timestamp index, without making any calls to chain
+    anchors = {**block_times.seed_anchors(), **block_times.load_block_times()}
+    return pd.to_datetime(block_times.interpolate_block_times(blocks, anchors), unit='ms')
 
 def run_subprocess(command='python multigraph.py', *args):
     try:
@@ -51,7 +53,7 @@ def load_metagraph(path, extra_cols=None, rm_cols=None):
 
     df = pd.DataFrame(metagraph.axons)
     df['block'] = metagraph.block.item()
-    df['timestamp'] = block_time_500k + dt*(df['block']-500_000)
+    df['timestamp'] = approximate_block_time([metagraph.block.item()])[0]
     df['difficulty'] = getattr(metagraph, 'difficulty', None)
     for c in extra_cols:
         vals = getattr(metagraph,c)
@@ -60,28 +62,46 @@ def load_metagraph(path, extra_cols=None, rm_cols=None):
     return df.drop(columns=rm_cols)
 
 @lru_cache(maxsize=16)
-def load_metagraphs(block_start, block_end, block_step=1000, datadir='data/metagraph/1/', extra_cols=None):
+def load_metagraphs(block_start, block_end, block_step=1000, netuid=1, extra_cols=None):
     
     if extra_cols is None:
         extra_cols = ['total_stake','ranks','incentive','emission','consensus','trust','validator_trust','dividends']
 
     blocks = range(block_start, block_end, block_step)
-    print(f'Loading blocks {blocks[0]}-{blocks[-1]} from {datadir}')
-    filenames = sorted(filename for filename in os.listdir(datadir) if filename.split('.')[0].isdigit() and int(filename.split('.')[0]) in blocks)
-    print(f'Found {len(filenames)} files in {datadir}')
-    
-    metagraphs = []
-    
-    pbar = tqdm.tqdm(filenames)
-    for filename in pbar:
-        pbar.set_description(f'Processing {filename}')
-
-        try:
-            metagraph = load_metagraph(os.path.join(datadir, filename), extra_cols=extra_cols, rm_cols=['protocol','placeholder1','placeholder2'])
-            
-            metagraphs.append(metagraph)
-        except Exception as e:
-            print(f'filename {filename!r} generated an exception: { e }')
-            
-    return pd.concat(metagraphs)
+    print(f'Loading blocks {blocks[0]}-{blocks[-1]} from snapshot store for netuid {netuid}')
+    columns = ['block','uid'] + meta_store.AXON_COLS + ['difficulty'] + list(extra_cols)
+    # membership in a range is O(1), so this is linear in the number of snapshots
+    available = [block for block in meta_store.list_blocks(netuid) if block in blocks]
+    print(f'Found {len(available)} snapshots')
+    df = meta_store.read_snapshots(netuid, blocks[0], blocks[-1], columns=columns, blocks=available)
+
+    df['timestamp'] = approximate_block_time(df['block']).values
+    return df
+
+
+def hotkey_churn(df, step=1):
+    """Counts hotkeys added, removed and changed (added + removed) between consecutive blocks, for all blocks in one pass.
+
+    Returns a frame indexed by (block, timestamp). The first block has no previous block, so its counts are NaN.
+    """
+    pairs = df.iloc[::step][['block','timestamp','hotkey']].drop_duplicates()
+    grouper = pairs.groupby(['block','timestamp'], sort=True)
+    block_idx = grouper.ngroup().values
+    codes, uniques = pd.factorize(pairs['hotkey'])
+
+    # a (block, hotkey) key is shared with the previous block if the same hotkey has the key of the next block there
+    keys = block_idx.astype('int64')*len(uniques) + codes
+    next_keys = (block_idx.astype('int64')+1)*len(uniques) + codes
+    shared = np.isin(keys, next_keys)
+
+    counts = np.bincount(block_idx, minlength=grouper.ngroups)
+    shared_counts = np.bincount(block_idx[shared], minlength=grouper.ngroups)
+    prev_counts = np.concatenate([[np.nan], counts[:-1]])
 
+    churn = pd.DataFrame({
+        'added': counts - shared_counts,
+        'removed': prev_counts - shared_counts,
+    }, index=grouper.size().index).astype(float)
+    churn.iloc[0] = np.nan
+    churn['changed'] = churn['added'] + churn['removed']
+    return churn
@@ -2,14 +2,13 @@ import os
 import time
 import pandas as pd
 import streamlit as st
-from meta_utils import run_subprocess, load_metagraphs
+from meta_utils import run_subprocess, load_metagraphs, hotkey_churn
+import meta_store
 # from opendashboards.assets import io, inspect, metric, plot
 import meta_plotting as plotting 
 import asyncio
 from functools import lru_cache
 
-## TODO: Read blocks from a big parquet file instead of loading all the pickles -- this is slow
-
 def get_or_create_eventloop():
     try:
         return asyncio.get_event_loop()
@@ -25,7 +24,7 @@ import bittensor
 
 netuid = 1
 datadir=f'data/metagraph/{netuid}/'
-blockfiles = sorted(int(filename.split('.')[0]) for filename in os.listdir(datadir) if filename.split('.')[0].isdigit())
+blockfiles = meta_store.list_blocks(netuid)
 DEFAULT_SRC = 'miner'
 DEFAULT_BLOCK_START = blockfiles[0]
 DEFAULT_BLOCK_END = blockfiles[-1]
@@ -132,13 +131,27 @@ with st.sidebar:
 
 with st.spinner(text=f'Loading data...'):
     # df = load_metagraphs(block_start=block_start, block_end=block_end, block_step=DEFAULT_BLOCK_STEP)
-    df = pd.read_parquet(os.path.join(datadir,'df.parquet'))
+    # cached results are keyed on the materialized parts, so they are recomputed when blocks are added or rebuilt
+    parts = tuple((part['path'], part['block_min'], part['block_max'], part['rows']) for part in meta_store.read_manifest(netuid)['parts'])
+    df = meta_store.read_dataframe(netuid, block_min=block_start, block_max=block_end)
 
 blocks = df.block.unique()
 
+@st.cache_data
+def _hotkey_churn(netuid, block_start, block_end, parts, _df):
+    # keyed on the selection and the parts rather than the frame, so the frame does not need to be hashed on every rerun
+    return hotkey_churn(_df.loc[_df.block.between(block_start, block_end)])
+
+@st.cache_data
+def _coldkey_rollup(netuid, block_start, block_end, parts):
+    return meta_store.read_rollup(netuid, block_min=block_start, block_max=block_end)
+
 df_sel = df.loc[df.block.between(block_start, block_end)].sort_values(by='block')
 miners = df_sel.loc[df_sel.validator_trust == 0]
 validators = df_sel.loc[df_sel.validator_trust > 0]
+rollup = _coldkey_rollup(netuid, block_start, block_end, parts)
+miner_rollup = rollup.loc[rollup.type == 'miner']
+validator_rollup = rollup.loc[rollup.type == 'validator']
 
 # add vertical space
 st.markdown('#')
@@ -146,8 +159,8 @@ st.markdown('#')
 
 tab1, tab2, tab3, tab4 = st.tabs(["Overview", "Miners", "Validators", "Block"])
 
-validator_choices = ['total_stake','incentive','emission','consensus','validator_trust','dividends']
-miner_choices = ['total_stake','incentive','emission','consensus','trust']
+validator_choices = meta_store.VALIDATOR_COLS
+miner_choices = meta_store.MINER_COLS
 cabal_choices = ['hotkey','ip','coldkey']
 cabal_choices.remove(color)
 
@@ -160,11 +173,13 @@ with tab1:
     st.info('**Churn** *measures the change in network participants over time*')
     
     churn_choice = st.radio('Hotkey event', ['changed','added','removed'], horizontal=True, index=0)
+    churn = _hotkey_churn(netuid, block_start, block_end, parts, df)
 
     st.plotly_chart(
-        plotting.plot_churn(df_sel, time_col=x, type=churn_choice, smooth=smooth, smooth_agg=smooth_agg, opacity=opacity),
+        plotting.plot_churn(df_sel, time_col=x, type=churn_choice, smooth=smooth, smooth_agg=smooth_agg, opacity=opacity, churn=churn),
         use_container_width=True
     )
+    st.download_button('Download churn', churn.to_csv(), file_name=f'churn_{netuid}_{block_start}_{block_end}.csv', mime='text/csv')
     
     st.markdown('#')
     st.markdown('#')
@@ -175,9 +190,8 @@ with tab1:
         use_container_width=True
     )
 
-animation_aggs = ['mean','sum','std','max','min']
-mac_choices = [f'{col}_{agg}' for col in miner_choices for agg in animation_aggs]+['hotkey_nunique','ip_nunique']
-vac_choices = [f'{col}_{agg}' for col in validator_choices for agg in animation_aggs]+['hotkey_nunique','ip_nunique']
+mac_choices = [f'{col}_{agg}' for col in miner_choices for agg in meta_store.ROLLUP_AGGS]+meta_store.ROLLUP_COUNTS
+vac_choices = [f'{col}_{agg}' for col in validator_choices for agg in meta_store.ROLLUP_AGGS]+meta_store.ROLLUP_COUNTS
 
 with tab2:
     
@@ -193,7 +207,7 @@ with tab2:
     mac_color = mac4.selectbox('**marker color**', mac_choices, index=mac_choices.index('total_stake_sum'))
 
     st.plotly_chart(
-        plotting.plot_animation(miners, x=mac_x, y=mac_y, color=mac_color, size=mac_size, opacity=opacity),
+        plotting.plot_animation(miners, x=mac_x, y=mac_y, color=mac_color, size=mac_size, opacity=opacity, rollup=miner_rollup),
         use_container_width=True
     )    
     
@@ -209,7 +223,7 @@ with tab2:
     with st.expander(f'Show **{count_col}** trends for top **{ntop}** miners'):
 
         st.plotly_chart(
-            plotting.plot_cabals(miners, time_col=x, count_col=count_col, sel_col=color, ntop=ntop, smooth=smooth, smooth_agg=smooth_agg, opacity=opacity), 
+            plotting.plot_cabals(miners, time_col=x, count_col=count_col, sel_col=color, ntop=ntop, smooth=smooth, smooth_agg=smooth_agg, opacity=opacity, rollup=miner_rollup), 
             use_container_width=True
         )
 
@@ -227,7 +241,7 @@ with tab3:
     vac_color = vac4.selectbox('**marker color**', vac_choices, index=vac_choices.index('total_stake_sum'))
     
     st.plotly_chart(
-        plotting.plot_animation(validators, x=vac_x, y=vac_y, color=vac_color, size=vac_size, opacity=opacity),
+        plotting.plot_animation(validators, x=vac_x, y=vac_y, color=vac_color, size=vac_size, opacity=opacity, rollup=validator_rollup),
         use_container_width=True
     )    
     validator_choice = st.radio('Select:', validator_choices, horizontal=True, index=0)
@@ -242,7 +256,7 @@ with tab3:
     with st.expander(f'Show **{count_col}** trends for top **{ntop}** validators'):
 
         st.plotly_chart(
-            plotting.plot_cabals(validators, time_col=x, count_col=count_col, sel_col=color, ntop=ntop, smooth=smooth, smooth_agg=smooth_agg, opacity=opacity), 
+            plotting.plot_cabals(validators, time_col=x, count_col=count_col, sel_col=color, ntop=ntop, smooth=smooth, smooth_agg=smooth_agg, opacity=opacity, rollup=validator_rollup), 
             use_container_width=True
         )
         
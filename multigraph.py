@@ -1,63 +1,126 @@
 import os
-import sys
 import argparse
 from traceback import print_exc
-import pickle
 import tqdm
-import pandas as pd
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 
-import torch
 import bittensor
-from meta_utils import load_metagraphs
-from meta2frame import make_dataframe
+import meta_store
+from meta2frame import update_dataframe
 #TODO: make line charts and other cool stuff for each metagraph snapshot
 
-def process(block, netuid=1, lite=True, difficulty=False, prune_weights=False, return_graph=False, half=True, subtensor=None):
+# connection which is opened once per worker process by init_worker and reused for every block
+_subtensor = None
+
+def init_worker(network='archive'):
+    global _subtensor
+    _subtensor = bittensor.subtensor(network=network)
+
+
+def process(block, netuid=1, lite=True, difficulty=False, return_graph=False, half=True, subtensor=None, raise_errors=False):
 
     if subtensor is None:
-        subtensor = bittensor.subtensor(network='archive')
+        subtensor = _subtensor or bittensor.subtensor(network='archive')
 
     try:
         metagraph = subtensor.metagraph(block=block, netuid=netuid, lite=lite)
         if difficulty:
             metagraph.difficulty = subtensor.difficulty(block=block, netuid=netuid)
 
+        meta_store.write_snapshot(meta_store.metagraph_to_frame(metagraph, netuid), netuid)
         if not lite:
-            if half:
-                metagraph.weights = torch.nn.Parameter(metagraph.weights.half(), requires_grad=False)
-            if prune_weights:
-                metagraph.weights = metagraph.weights[metagraph.weights.sum(axis=1) > 0]
-
-        with open(f'data/metagraph/{netuid}/{block}.pkl', 'wb') as f:
-            pickle.dump(metagraph, f)
+            # only nonzero weights are stored, so pruning empty rows happens implicitly
+            meta_store.write_weights(metagraph.weights, block, netuid, quantize=half)
 
         return metagraph if return_graph else True
 
     except Exception as e:
+        if raise_errors:
+            raise
         print(f'Error processing block {block}: {e}')
 
 
+def process_chunk(blocks, retries=0, **kwargs):
+    """Processes a contiguous run of blocks in one task, so the worker connection is reused across all of them.
+
+    Each block is tried up to retries+1 times. Returns the results of the blocks which succeeded, and the last error of each block which failed.
+    """
+    results, failed = [], {}
+    for block in blocks:
+        for attempt in range(retries + 1):
+            try:
+                results.append(process(block, raise_errors=True, **kwargs))
+                failed.pop(block, None)
+                break
+            except Exception as e:
+                failed[block] = f'{type(e).__name__}: {e}'
+                print(f'Error processing block {block} (attempt {attempt+1}/{retries+1}): {e}')
+    return results, failed
+
+
+def chunk_blocks(blocks, chunk_size):
+    return [blocks[i:i+chunk_size] for i in range(0, len(blocks), chunk_size)]
+
+
+def process_blocks(blocks, max_workers=32, chunk_size=None, network='archive', retries=0, **kwargs):
+    """Processes blocks in a process pool with one subtensor connection per worker, see process_chunk.
+
+    Returns the results of the blocks which succeeded, and the error of each block which failed. Failed blocks are also printed, and
+    blocks of a chunk whose worker crashed are all reported as failed.
+    """
+    chunk_size = chunk_size or max(1, len(blocks)//(max_workers*4))
+    chunks = chunk_blocks(blocks, chunk_size)
+    print(f'Processing {len(blocks)} blocks from {blocks[0]}-{blocks[-1]} using {max_workers} workers and {len(chunks)} chunks of {chunk_size} blocks.')
+
+    results, failed = [], {}
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker, initargs=(network,)) as executor:
+        futures = [executor.submit(process_chunk, chunk, retries=retries, **kwargs) for chunk in chunks]
+
+        with tqdm.tqdm(total=len(blocks)) as pbar:
+            for chunk, future in zip(chunks, futures):
+                try:
+                    chunk_results, chunk_failed = future.result()
+                    results.extend(chunk_results)
+                    failed.update(chunk_failed)
+                except Exception as e:
+                    print_exc()
+                    failed.update({block: f'{type(e).__name__}: {e}' for block in chunk})
+                pbar.update(len(chunk))
+                pbar.set_description(f'Processed {len(results)} blocks. Current block: {chunk[-1]}')
+
+    if failed:
+        print(f'Failed to process {len(failed)} blocks:')
+        for block, error in sorted(failed.items(), reverse=True):
+            print(f'  {block}: {error}')
+    return results, failed
+
+
 def parse_arguments():
     example_usage = """
     SN1 metagraphs for most recent 30 days without weights: python multigraph.py --lite --netuid 1 --step_size 7200 --num_blocks 30
     SN0 metagraphs for most recent 12 hours with weights:   python multigraph.py --lite --netuid 0 --step_size 300 --num_blocks 12
     """
-    parser = argparse.ArgumentParser(description=f'Process metagraphs for a given network.',
+    parser = argparse.ArgumentParser(description='Process metagraphs for a given network.',
                                      formatter_class=argparse.RawDescriptionHelpFormatter,
                                      epilog=f'\nExamples:\n{example_usage}')
     parser.add_argument('--netuid', type=int, default=1, help='Network UID to use.')
     parser.add_argument('--lite', action='store_true', help='Do not include weights.')
     parser.add_argument('--difficulty', action='store_true', help='Include difficulty in metagraph.')
-    parser.add_argument('--prune_weights', action='store_true', help='Prune weights in metagraph.')
     parser.add_argument('--return_graph', action='store_true', help='Return metagraph instead of True.')
     parser.add_argument('--no_dataframe', action='store_true', help='Do not create dataframe.')
+    parser.add_argument('--rebuild_dataframe', action='store_true', help='Rebuild the dataframe for the selected blocks instead of only adding new blocks.')
     parser.add_argument('--max_workers', type=int, default=32, help='Max workers to use.')
+    parser.add_argument('--chunk_size', type=int, default=None, help='Number of contiguous blocks per task. Defaults to about 4 tasks per worker.')
+    parser.add_argument('--network', type=str, default='archive', help='Subtensor network used by the workers.')
+    parser.add_argument('--engine', type=str, default='pool', choices=['pool','async'], help='Use a process pool, or the async engine with adaptive concurrency, retries and a durable queue of failed blocks.')
+    parser.add_argument('--retries', type=int, default=5, help='Retries per block.')
     parser.add_argument('--start_block', type=int, default=None, help='Start block.')
     parser.add_argument('--num_blocks', type=int, default=0, help='Number of blocks.')
     parser.add_argument('--end_block', type=int, default=600_000, help='End block.')
     parser.add_argument('--step_size', type=int, default=100, help='Step size.')
     parser.add_argument('--overwrite', action='store_true',help='Overwrite existing files')
+    parser.add_argument('--no_compact', action='store_true', help='Do not delta-encode complete snapshot partitions.')
+    parser.add_argument('--import_pickles', action='store_true', help='Import legacy pickled snapshots into the snapshot store.')
     return parser.parse_args()
 
 if __name__ == '__main__':
@@ -88,32 +151,27 @@ if __name__ == '__main__':
 
     datadir = f'data/metagraph/{netuid}'
     os.makedirs(datadir, exist_ok=True)
+    if args.import_pickles:
+        print(f'Imported {meta_store.import_pickles(netuid)} pickled snapshots into the snapshot store.')
     if not args.overwrite:
-        blocks = [block for block in blocks if not os.path.exists(f'data/metagraph/{netuid}/{block}.pkl')]
+        existing = set(meta_store.list_blocks(netuid))
+        blocks = [block for block in blocks if block not in existing]
 
     metagraphs = []
 
-    if len(blocks)>0:
-
-        print(f'Processing {len(blocks)} blocks from {blocks[0]}-{blocks[-1]} using {max_workers} workers.')
+    if len(blocks)>0 and args.engine == 'async':
+        import asyncio
+        from meta_backfill import backfill
 
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            futures = [
-                executor.submit(process, block, lite=args.lite, netuid=netuid, difficulty=difficulty)
-                for block in blocks
-                ]
+        stats = asyncio.run(backfill(blocks, netuid=netuid, network=args.network, lite=lite, difficulty=difficulty, max_concurrency=max_workers, retries=args.retries))
+        if not stats['blocks']:
+            raise ValueError('No blocks were successfully processed.')
 
-            success = 0
-            with tqdm.tqdm(total=len(futures)) as pbar:
-                for block, future in zip(blocks,futures):
-                    try:
-                        metagraphs.append(future.result())
-                        success += 1
-                    except Exception as e:
-                        print(f'generated an exception: {print_exc(e)}')
-                    pbar.update(1)
-                    pbar.set_description(f'Processed {success} blocks. Current block: {block}')
+    elif len(blocks)>0:
 
+        metagraphs, failed = process_blocks(blocks, max_workers=max_workers, chunk_size=args.chunk_size, network=args.network, retries=args.retries,
+                                            lite=args.lite, netuid=netuid, difficulty=difficulty)
+        success = len(metagraphs)
         if not success:
             raise ValueError('No blocks were successfully processed.')
 
@@ -127,11 +185,17 @@ if __name__ == '__main__':
         print(f'No blocks to process. Current block: {subtensor.block}')
 
 
+    if not args.no_compact:
+        # only partitions below the current one are complete, the current one keeps receiving new blocks
+        n_rows = meta_store.compact_snapshots(netuid, before_block=meta_store.partition_of(start_block))
+        print(f'Compacted snapshots to {n_rows} delta rows')
+    else:
+        meta_store.checkpoint_catalog(netuid)
+    meta_store.checkpoint_catalog(netuid, kind='weights')
+
     if not args.no_dataframe:
-        save_path = f'data/metagraph/{netuid}/df.parquet'
         blocks = range(start_block, end_block, -step_size)
-        print(f'Making a dataframe for {len(blocks)} blocks in {blocks}')
-        
-        df = make_dataframe(netuid = netuid, block_min = min(blocks), block_max = max(blocks), weights = not lite)
-        df.to_parquet(save_path)
-        print(f'Saved dataframe to {save_path!r}')
\ No newline at end of file
+        print(f'Updating dataframe for {len(blocks)} blocks in {blocks}')
+
+        n_new = update_dataframe(netuid = netuid, block_min = min(blocks), block_max = max(blocks), rebuild = args.rebuild_dataframe or args.overwrite)
+        print(f'Added {n_new} blocks to dataframe in {meta_store.frame_dir(netuid)!r}')
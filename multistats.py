@@ -1,77 +1,22 @@
 import os
-import re
+import numbers
+import shutil
 import argparse
 import tqdm
-import wandb
 import traceback
 import plotly.express as px
+import numpy as np
 import pandas as pd
+import pyarrow.feather as feather
 from concurrent.futures import ProcessPoolExecutor
 
 import opendashboards.utils.utils as utils
 import opendashboards.utils.aggregate as aggregate
+import opendashboards.utils.catalog as catalog
+import stats_store
 
 from IPython.display import display
 
-api= wandb.Api(timeout=60)
-wandb.login(anonymous="allow")
-
-def pull_wandb_runs(project='opentensor-dev/openvalidators', filters=None, min_steps=50, max_steps=100_000, ntop=10, netuid=None, summary_filters=None ):
-    # TODO: speed this up by storing older runs
-
-    all_runs = api.runs(project, filters=filters)
-    print(f'Using {ntop}/{len(all_runs)} runs with more than {min_steps} events')
-    pbar = tqdm.tqdm(all_runs)
-    runs = []
-    n_events = 0
-    successful = 0
-    for i, run in enumerate(pbar):
-
-        summary = run.summary
-        if summary_filters is not None and not summary_filters(summary):
-            continue
-        if netuid is not None and run.config.get('netuid') != netuid:
-            continue
-        step = summary.get('_step',0)
-        if step < min_steps or step > max_steps:
-            # warnings.warn(f'Skipped run `{run.name}` because it contains {step} events (<{min_steps})')
-            continue
-
-        prog_msg = f'Loading data {successful/ntop*100:.0f}% ({successful}/{ntop} runs, {n_events} events)'
-        pbar.set_description(f'{prog_msg}... **fetching** `{run.name}`')
-
-        duration = summary.get('_runtime')
-        end_time = summary.get('_timestamp')
-        # extract values for selected tags
-        rules = {'hotkey': re.compile('^[0-9a-z]{48}$',re.IGNORECASE), 'version': re.compile('^\\d\.\\d+\.\\d+$'), 'spec_version': re.compile('\\d{4}$')}
-        tags = {k: tag for k, rule in rules.items() for tag in run.tags if rule.match(tag)}
-        # include bool flag for remaining tags
-        tags.update({k: True for k in run.tags if k not in tags.keys() and k not in tags.values()})
-
-        runs.append({
-            'state': run.state,
-            'num_steps': step,
-            'num_completions': step*sum(len(v) for k, v in run.summary.items() if k.endswith('completions') and isinstance(v, list)),
-            'entity': run.entity,
-            'user': run.user.name,
-            'username': run.user.username,
-            'run_id': run.id,
-            'run_name': run.name,
-            'project': run.project,
-            'run_url': run.url,
-            'run_path': os.path.join(run.entity, run.project, run.id),
-            'start_time': pd.to_datetime(end_time-duration, unit="s"),
-            'end_time': pd.to_datetime(end_time, unit="s"),
-            'duration': pd.to_timedelta(duration, unit="s").round('s'),
-            'netuid': run.config.get('netuid'),
-            **tags
-        })
-        n_events += step
-        successful += 1
-        if successful >= ntop:
-            break
-
-    return pd.DataFrame(runs).astype({'state': 'category', 'hotkey': 'category', 'version': 'category', 'spec_version': 'category'})
 
 def plot_gantt(df_runs):
     fig = px.timeline(df_runs,
@@ -94,98 +39,146 @@ def clean_data(df):
     return df.dropna(subset=df.filter(regex='completions|rewards').columns, how='any').dropna(axis=1, how='all')
 
 def explode_data(df):
-    list_cols = utils.get_list_col_lengths(df)
-    return utils.explode_data(df, list(list_cols.keys())).apply(pd.to_numeric, errors='ignore')
-
-
-def load_data(run_id, run_path=None, load=True, save=False, explode=True):
+    list_cols = list(utils.get_list_col_lengths(df))
+    df = utils.explode_data(df, list_cols)
+    # exploded list columns hold objects, those which only hold numbers are converted to numeric dtypes
+    numeric_cols = [c for c in list_cols if df[c].dropna().map(lambda v: isinstance(v, numbers.Number)).all()]
+    df[numeric_cols] = df[numeric_cols].apply(pd.to_numeric, errors='coerce')
+    return df
+
+
+def clean_page(df):
+    # Remove rows with missing completions or rewards, which will be stuff related to weights
+    df = df.dropna(subset=df.filter(regex='completions|rewards').columns, how='any')
+    float_cols = df.filter(regex='reward|filter').columns
+    return explode_data(df).astype({c: float for c in float_cols}).fillna({c: 0 for c in float_cols})
+
+
+def sync_run(run_id, run_path=None, load=True, save=False, sync=False):
+    """Brings the synced history of a run up to date if save is set. Returns the run directory, or None if there is no synced history."""
+
+    run_dir = os.path.join('data/runs/', run_id)
+    # histories which were downloaded in one piece are converted once to the first part of the synced history, with native list columns
+    legacy_path = os.path.join('data/runs/',f'history-{run_id}.parquet')
+    if os.path.exists(legacy_path) and not utils.read_sync_state(run_dir)['parts']:
+        utils.import_history(legacy_path, run_dir)
+
+    synced = bool(utils.read_sync_state(run_dir)['parts'])
+    if save and not load and os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+        synced = False
+    if save and (sync or not synced):
+        # only the events after the last synced step are downloaded
+        result = utils.sync_history(run_path, run_dir, explode=False, transform=clean_page)
+        print(f'Synced {result["rows"]} new events from {run_path!r} with id {run_id!r}')
+        synced = bool(utils.read_sync_state(run_dir)['parts'])
+
+    return run_dir if (load or save) and synced else None
+
+
+def clean_chunk(df):
+    # filter out events with missing step length
+    df = df.loc[df.step_length.notna()]
+    # completions are kept as categoricals of the completion dictionary, the text is only looked up when it is displayed
+    df = utils.decode_completions(df)
+    df._timestamp = pd.to_datetime(df._timestamp, unit="s")
+    return df
 
-    file_path = os.path.join('data/runs/',f'history-{run_id}.parquet')
 
-    if load and os.path.exists(file_path):
-        df = pd.read_parquet(file_path)
-        # filter out events with missing step length
-        df = df.loc[df.step_length.notna()]
+def load_chunks(run_id, run_path=None, load=True, save=False, sync=False, min_timestamp=None):
+    """Yields the events of a run one row group of its synced history at a time. Runs without a synced history are loaded in one chunk."""
 
-        # detect list columns which as stored as strings
-        ignore_cols = ('moving_averaged_scores')
-        list_cols = [c for c in df.columns if c not in ignore_cols and df[c].dtype == "object" and df[c].str.startswith("[").all()]
-        # convert string representation of list to list
-        # df[list_cols] = df[list_cols].apply(lambda x: eval(x, {'__builtins__': None}) if pd.notna(x) else x)
-        try:
-            df[list_cols] = df[list_cols].fillna('').applymap(eval, na_action='ignore')
-        except ValueError as e:
-            print(f'Error loading {file_path!r} when converting columns {list_cols} to list: {e}', flush=True)
+    run_dir = sync_run(run_id, run_path, load=load, save=save, sync=sync)
+    if run_dir is None:
+        yield load_data(run_id, run_path, load=load, save=save, sync=sync, min_timestamp=min_timestamp)
+        return
 
-    else:
-        # Download the history from wandb and add metadata
-        run = api.run(run_path)
-        df = pd.DataFrame(list(run.scan_history()))
+    for df in utils.iter_history(run_dir, min_timestamp=min_timestamp):
+        df = clean_chunk(df)
+        if not df.empty:
+            yield df
 
-        # Remove rows with missing completions or rewards, which will be stuff related to weights
-        df.dropna(subset=df.filter(regex='completions|rewards').columns, how='any', inplace=True)
 
-        print(f'Downloaded {df.shape[0]} events from {run_path!r} with id {run_id!r}')
+def load_data(run_id, run_path=None, load=True, save=False, explode=True, sync=False, min_timestamp=None):
 
-        # Clean and explode dataframe
-        # overwrite object to free memory
-        float_cols = df.filter(regex='reward|filter').columns
-        df = explode_data(clean_data(df)).astype({c: float for c in float_cols}).fillna({c: 0 for c in float_cols})
+    run_dir = sync_run(run_id, run_path, load=load, save=save, sync=sync)
+    if run_dir is not None:
+        df = clean_chunk(utils.read_history(run_dir, min_timestamp=min_timestamp))
 
-        if save:
-            df.to_parquet(file_path, index=False)
+    else:
+        # Stream the history from wandb to parquet a page at a time, so memory does not grow with the length of the run
+        path = os.path.join('data/runs/', f'.history-{run_id}.parquet.tmp')
+        n_rows = utils.download_history(run_path, path, explode=False, transform=clean_page)
+        if not n_rows:
+            raise ValueError(f'No events with completions and rewards in {run_path!r}')
+        df = utils.decode_completions(pd.read_parquet(path).dropna(axis=1, how='all'))
+        os.remove(path)
+
+        print(f'Downloaded {n_rows} events from {run_path!r} with id {run_id!r}')
+        # Convert timestamp to datetime.
+        df._timestamp = pd.to_datetime(df._timestamp, unit="s")
 
-    # Convert timestamp to datetime.
-    df._timestamp = pd.to_datetime(df._timestamp, unit="s")
     return df.sort_values("_timestamp")
 
 
-def calculate_stats(df_long, freq='H', save_path=None, ntop=3 ):
-
-    df_long._timestamp = pd.to_datetime(df_long._timestamp)
-
+def prepare_events(df_long):
     # if dataframe has columns such as followup_completions and answer_completions, convert to multiple rows
     if 'completions' not in df_long.columns:
-        df_long.set_index(['_timestamp','run_id'], inplace=True)
+        df_long = df_long.set_index('_timestamp')
         df_schema = pd.concat([
             df_long[['followup_completions','followup_rewards']].rename(columns={'followup_completions':'completions', 'followup_rewards':'rewards'}),
             df_long[['answer_completions','answer_rewards']].rename(columns={'answer_completions':'completions', 'answer_rewards':'rewards'})
         ])
         df_long = df_schema.reset_index()
 
-    run_id = df_long['run_id'].iloc[0]
-    # print(f'Calculating stats for run {run_id!r} dataframe with shape {df_long.shape}')
+    # Approximate number of tokens in each completion, counting the words of each unique completion only once
+    codes, uniques = pd.factorize(df_long['completions'])
+    num_tokens = (pd.Series(np.asarray(uniques, dtype=object)).astype(str).str.split().str.len() / 0.75).round().values
+    df_long['completion_num_tokens'] = np.where(codes >= 0, num_tokens[codes] if len(num_tokens) else np.nan, np.nan)
+
+    # Calculate tokens per second
+    if 'completion_times' in df_long.columns:
+        df_long['tokens_per_sec'] = df_long['completion_num_tokens']/(df_long['completion_times']+1e-6)
 
+    return df_long
 
-    # Approximate number of tokens in each completion
-    df_long['completion_num_tokens'] = (df_long['completions'].astype(str).str.split().str.len() / 0.75).round()
+
+def calculate_stats(df_long, freq='h', save_path=None, ntop=3, run_id=None):
+
+    df_long._timestamp = pd.to_datetime(df_long._timestamp)
+    if run_id is None:
+        run_id = df_long['run_id'].iloc[0]
+    df_long = prepare_events(df_long)
+
+    # print(f'Calculating stats for run {run_id!r} dataframe with shape {df_long.shape}')
 
     # TODO: use named aggregations
-    reward_aggs = ['sum','mean','std','median','max',aggregate.nonzero_rate, aggregate.nonzero_mean, aggregate.nonzero_std, aggregate.nonzero_median]
+    reward_cols = [k for k in df_long.filter(regex='reward') if df_long[k].nunique() > 1]
     aggs = {
-        'completions': ['nunique','count', aggregate.diversity, aggregate.successful_diversity, aggregate.success_rate],
+        'completions': ['nunique','count'],
         'completion_num_tokens': ['mean', 'std', 'median', 'max'],
-        **{k: reward_aggs for k in df_long.filter(regex='reward') if df_long[k].nunique() > 1}
+        **{k: ['sum','mean','std','median','max'] for k in reward_cols}
     }
 
-    # Calculate tokens per second
     if 'completion_times' in df_long.columns:
-        df_long['tokens_per_sec'] = df_long['completion_num_tokens']/(df_long['completion_times']+1e-6)
         aggs.update({
             'completion_times': ['mean','std','median','min','max'],
             'tokens_per_sec': ['mean','std','median','max'],
         })
 
-    grouper = df_long.groupby(pd.Grouper(key='_timestamp', axis=0, freq=freq))
+    grouper = df_long.groupby(pd.Grouper(key='_timestamp', freq=freq))
     # carry out main aggregations
     stats = grouper.agg(aggs)
-    # carry out multi-column aggregations using apply
-    diversity = grouper.apply(aggregate.successful_nonzero_diversity)
-    # carry out top completions aggregations using apply
-    top_completions = grouper.apply(aggregate.completion_top_stats, exclude='', ntop=ntop).unstack()
+    # assign each event to its time bucket, so that the remaining aggregations are vectorized over all buckets at once
+    bucket = stats.index[stats.index.searchsorted(df_long['_timestamp'], side='right') - 1]
+    # carry out diversity and nonzero reward aggregations
+    diversity = aggregate.completion_stats(df_long['completions'], df_long['rewards'], bucket)
+    nonzero = [aggregate.nonzero_stats(df_long[k], bucket, prefix=f'{k}_') for k in reward_cols]
+    # carry out top completions aggregations
+    top_completions = aggregate.top_completions(df_long['completions'], df_long['rewards'], bucket, exclude='', ntop=ntop).unstack()
     
     # combine all aggregations, which have the same index
-    stats = pd.concat([stats, diversity, top_completions], axis=1)
+    stats = pd.concat([stats, diversity, *nonzero, top_completions], axis=1).rename_axis('_timestamp')
     
     # flatten multiindex columns
     stats.columns = ['_'.join([str(cc) for cc in c]) if isinstance(c, tuple) else str(c) for c in stats.columns]
@@ -198,33 +191,134 @@ def calculate_stats(df_long, freq='H', save_path=None, ntop=3 ):
 
 
 
-def process(run, load=True, save=False, load_stats=True, freq='H', ntop=3):
+def calculate_partials(df_long, freq='min'):
+    """Mergeable partial aggregates of the events in each time bucket, which are rolled up into coarser tiers by stats_store."""
+
+    df_long._timestamp = pd.to_datetime(df_long._timestamp)
+    df_long = prepare_events(df_long)
+
+    bucket = df_long['_timestamp'].dt.floor(freq)
+    numeric_cols = [c for c in ['completion_num_tokens', 'completion_times', 'tokens_per_sec'] if c in df_long.columns]
+    numeric_cols += [k for k in df_long.filter(regex='reward')]
+    partials = pd.concat([
+        aggregate.completion_partials(df_long['completions'], df_long['rewards'], bucket),
+        *[aggregate.numeric_partials(df_long[c], bucket, c) for c in numeric_cols],
+    ], axis=1)
+    return partials.rename_axis('_timestamp').reset_index()
+
+
+def calculate_stats_chunked(chunks, freq='h', save_path=None, ntop=3, run_id=None, min_timestamp=None, on_partials=None, completions_path=utils.COMPLETIONS_PATH):
+    """Chunked version of calculate_stats for runs which do not fit in memory.
+
+    Each chunk of events (e.g. a row group from load_chunks) is reduced to minute partials, which are merged into partial state per
+    time bucket and finalized at the end. Only mergeable stats are available, so medians are missing and unique counts are estimates.
+    The minute partials of each chunk are also passed to on_partials, e.g. a stats_store.RollupWriter.
+    """
+    states = []
+    for chunk in chunks:
+        partials = calculate_partials(chunk.copy())
+        if on_partials is not None:
+            on_partials(partials)
+        if min_timestamp is not None:
+            partials = partials.loc[partials['_timestamp'] >= min_timestamp]
+        # buckets which span two chunks are merged again at the end
+        states.append(aggregate.merge_partials(partials.assign(_timestamp=partials['_timestamp'].dt.floor(freq)), ['_timestamp']).reset_index())
+
+    if not states:
+        return pd.DataFrame(columns=['_timestamp', 'run_id'])
+
+    state = aggregate.merge_partials(pd.concat(states, ignore_index=True), ['_timestamp'])
+    dictionary = utils.read_completion_dictionary(completions_path)
+    texts = pd.Series(dictionary['text'].values, index=dictionary['hash'].values)
+    stats = aggregate.finalize_partials(state, ntop=ntop, texts=texts).reset_index().assign(run_id=run_id)
+
+    if save_path:
+        stats.to_csv(save_path, index=False)
+
+    return stats
+
+
+def read_frame(path, columns=None):
+    # uncompressed feather files are memory-mapped, so readers only page in the columns they use
+    return feather.read_table(path, columns=columns, memory_map=True).to_pandas()
+
+
+def write_frame(df, path):
+    feather.write_feather(df.reset_index(drop=True), path, compression='uncompressed')
+
+
+def process(run, load=True, save=False, load_stats=True, freq='h', ntop=3, repull_unfinished=False, chunked=False):
+    """Calculates the stats of a run and writes them to a feather file. Only the path is returned, so that the stats are not sent between processes.
+
+    In chunked mode the synced history is read one row group at a time, see calculate_stats_chunked.
+    """
 
     try:
 
-        stats_path = f'data/aggs/stats-{run["run_id"]}.csv'
-        if load_stats and os.path.exists(stats_path):
+        stats_path = f'data/aggs/stats-{run["run_id"]}.feather'
+        # stats which were saved as csv are converted once
+        csv_path = f'data/aggs/stats-{run["run_id"]}.csv'
+        if os.path.exists(csv_path) and not os.path.exists(stats_path):
+            write_frame(pd.read_csv(csv_path, parse_dates=['_timestamp']), stats_path)
+            os.remove(csv_path)
+
+        sync = repull_unfinished and run['state'] == 'running'
+        stats = read_frame(stats_path) if load_stats and os.path.exists(stats_path) else None
+        # the rollup store recomputes every tier from the start of its last daily bucket
+        rollup_since = stats_store.resume_timestamp(run['run_id']) if load_stats else None
+        if stats is not None and rollup_since is not None and not sync:
             print(f'Loaded stats file {stats_path!r}')
-            return pd.read_csv(stats_path)
+            return stats_path
 
-        # Load data and add extra columns from wandb run
-        df_long = load_data(run_id=run['run_id'],
+        # new events can only change the last (possibly incomplete) time bucket and the ones after it
+        since = stats['_timestamp'].max() if stats is not None else None
+        min_since = min(since, rollup_since) if since is not None and rollup_since is not None else None
+
+        # run metadata is kept in data/wandb.csv and joined on run_id, rather than copied onto every event
+        load_args = dict(run_id=run['run_id'],
                     run_path=run['run_path'],
                     load=load,
                     save=save,
-                    # save = (run['state'] != 'running') & run['end_time']
-                    ).assign(**run.to_dict())
-        assert isinstance(df_long, pd.DataFrame), f'Expected dataframe, but got {type(df_long)}'
-
-        # Get and save stats
-        return calculate_stats(df_long, freq=freq, save_path=stats_path, ntop=ntop)
+                    sync=sync,
+                    min_timestamp=min_since.timestamp() if min_since is not None else None,
+                    )
+        if chunked:
+            # the rollups are updated as the chunks go by, so that only one day of minute partials is kept in memory
+            rollups = stats_store.RollupWriter(run['run_id'], since=rollup_since)
+            new_stats = calculate_stats_chunked(load_chunks(**load_args), freq=freq, ntop=ntop, run_id=run['run_id'], min_timestamp=since, on_partials=rollups.add)
+            rollups.close()
+            if new_stats.empty:
+                return stats_path if stats is not None else None
+        else:
+            df_long = load_data(**load_args)
+            assert isinstance(df_long, pd.DataFrame), f'Expected dataframe, but got {type(df_long)}'
+            if df_long.empty:
+                return stats_path if stats is not None else None
+
+            # Update the minute, hour and day rollups
+            events = df_long.loc[df_long['_timestamp'] >= rollup_since] if rollup_since is not None else df_long
+            if not events.empty:
+                stats_store.update_run(calculate_partials(events.copy()), run['run_id'], since=rollup_since)
+
+            # Get and save stats
+            if since is not None:
+                df_long = df_long.loc[df_long['_timestamp'] >= since]
+            new_stats = calculate_stats(df_long, freq=freq, ntop=ntop, run_id=run['run_id'])
+
+        if stats is not None:
+            print(f'Recomputed {len(new_stats)} time buckets of {stats_path!r} since {since}')
+            new_stats = pd.concat([stats.loc[stats['_timestamp'] < since], new_stats], ignore_index=True)
+
+        write_frame(new_stats, stats_path)
+        return stats_path
 
     except Exception as e:
         print(f'Error processing run {run["run_id"]!r}:\t{e.__class__.__name__}: {e}',flush=True)
         print(traceback.format_exc())
 
-def line_chart(df, col, title=None):
+def line_chart(path, col, title=None):
     title = title or col.replace('_',' ').title()
+    df = read_frame(path, columns=['_timestamp','run_id',col])
     fig = px.line(df.astype({'_timestamp':str}),
             x='_timestamp', y=col,
             line_group='run_id',
@@ -243,6 +337,7 @@ def parse_arguments():
     parser = argparse.ArgumentParser(description='Process wandb validator runs for a given netuid.')
     parser.add_argument('--load_runs',action='store_true', help='Load runs from file.')
     parser.add_argument('--repull_unfinished',action='store_true', help='Re-pull runs that were running when downloaded and saved.')
+    parser.add_argument('--migrate_caches',action='store_true', help='Convert old CSV and parquet history caches to synced histories with native list columns.')
     parser.add_argument('--netuid', type=int, default=None, help='Network UID to use.')
     parser.add_argument('--ntop', type=int, default=1000, help='Number of runs to process.')
     parser.add_argument('--min_steps', type=int, default=100, help='Minimum number of steps to include.')
@@ -251,19 +346,22 @@ def parse_arguments():
     parser.add_argument('--no_save',action='store_true', help='Prevent saving data to file.')
     parser.add_argument('--no_load',action='store_true', help='Prevent loading downloaded data from file.')
     parser.add_argument('--no_load_stats',action='store_true', help='Prevent loading stats data from file.')
-    parser.add_argument('--freq', type=str, default='H', help='Frequency to aggregate data.')
+    parser.add_argument('--freq', type=str, default='h', help='Frequency to aggregate data.')
     parser.add_argument('--completions_ntop', type=int, default=3, help='Number of top completions to include in stats.')
+    parser.add_argument('--chunked',action='store_true', help='Read run histories one row group at a time, for runs which do not fit in memory.')
 
     return parser.parse_args()
 
 
 if __name__ == '__main__':
 
-    # TODO: flag to overwrite runs that were running when downloaded and saved: check if file date is older than run end time.
-
     args = parse_arguments()
     print(args)
 
+    if args.migrate_caches:
+        n_migrated = utils.migrate_history_caches('data/')
+        print(f'Migrated {n_migrated} history caches')
+
     filters = None# {"tags": {"$in": [f'1.1.{i}' for i in range(10)]}}
     # filters={'tags': {'$in': ['5F4tQyWrhfGVcNhoqeiNsR6KjD4wMZ2kfhLj4oHYuyHbZAc3']}} # Is foundation validator
     if args.load_runs and os.path.exists('data/wandb.csv'):
@@ -271,11 +369,8 @@ if __name__ == '__main__':
         assert len(df_runs) >= args.ntop, f'Loaded {len(df_runs)} runs, but expected at least {args.ntop}'
         df_runs = df_runs.iloc[:args.ntop]
     else:
-        df_runs = pull_wandb_runs(ntop=args.ntop,
-                                min_steps=args.min_steps,
-                                netuid=args.netuid,
-                                filters=filters
-                                )#summary_filters=lambda s: s.get('augment_prompt'))
+        df_catalog = catalog.refresh_catalog('opentensor-dev/openvalidators', filters=filters)
+        df_runs = catalog.select_runs(df_catalog, min_steps=args.min_steps, max_steps=100_000, netuid=args.netuid, ntop=args.ntop)
         df_runs.to_csv('data/wandb.csv', index=False)
 
 
@@ -295,7 +390,9 @@ if __name__ == '__main__':
                             save=not args.no_save,
                             load_stats=not args.no_load_stats,
                             freq=args.freq,
-                            ntop=args.completions_ntop
+                            ntop=args.completions_ntop,
+                            repull_unfinished=args.repull_unfinished,
+                            chunked=args.chunked
                     )
                    for _, run in df_runs.iterrows()
                    ]
@@ -306,7 +403,8 @@ if __name__ == '__main__':
             for future in futures:
                 try:
                     result = future.result()
-                    results.append(result)
+                    if result is not None:
+                        results.append(result)
                 except Exception as e:
                     print(f'-----------------------------\nWorker generated an exception in "process" function:\n{e.__class__.__name__}: {e}\n-----------------------------\n',flush=True)
                 pbar.update(1)
@@ -316,10 +414,11 @@ if __name__ == '__main__':
     print(f'Processed {len(results)} runs.',flush=True)
 
    # Concatenate the results into a single dataframe
-    df = pd.concat(results, ignore_index=True).sort_values(['_timestamp','run_id'], ignore_index=True)
+    df = pd.concat([read_frame(path) for path in results], ignore_index=True).sort_values(['_timestamp','run_id'], ignore_index=True)
 
     df.to_csv('data/processed.csv', index=False)
-    print(f'Saved {df.shape[0]} rows to data/processed.csv')
+    write_frame(df, 'data/processed.feather')
+    print(f'Saved {df.shape[0]} rows to data/processed.csv and data/processed.feather')
 
     display(df)
     print(f'Unique values in columns:')
@@ -330,7 +429,8 @@ if __name__ == '__main__':
 
         cols = df.set_index(['run_id','_timestamp']).columns
         with ProcessPoolExecutor(max_workers=min(args.max_workers, len(cols))) as executor:
-            futures = [executor.submit(line_chart, df, c) for c in cols]
+            # workers memory-map the processed stats and read only the column they plot
+            futures = [executor.submit(line_chart, 'data/processed.feather', c) for c in cols]
 
             # Use tqdm to add a progress bar
             results = []
@@ -1,33 +1,35 @@
 
 import streamlit as st
 import pandas as pd
-import opendashboards.utils.utils as utils
-
-def clean_data(df):
-    task_map = {
-        'question-answering': 'QA',
-        'summarization': 'Summarization',
-        'date-based question answering': 'Date QA',
-        'math': 'Math'
-    }
-    df['task'] = df.task.map(task_map)
-    return df.dropna(subset=df.filter(regex='completions|rewards').columns, how='any')
-
-@st.cache_data
-def explode_data(df):
-    list_cols = utils.get_list_col_lengths(df)
-    try:
-        return utils.explode_data(df, list(list_cols.keys())).apply(pd.to_numeric, errors='ignore')
-    except Exception as e:
-        st.error(f'Error exploding data with columns')
-        st.write(list_cols)
-        st.exception(e)
-        st.dataframe(df)
-        st.stop()
-
-@st.cache_data
-def completions(df_long, col):
-    return df_long[col].value_counts()
+import opendashboards.utils.query as query
+
+# display names of the task types, other task types are not listed
+TASK_NAMES = {
+    'question-answering': 'QA',
+    'summarization': 'Summarization',
+    'date-based question answering': 'Date QA',
+    'math': 'Math'
+}
+
+def completions(completion_index):
+    # counts are read from the offsets of the completion indexes, without a pass over the events
+    counts = query.completion_counts(completion_index)
+    return counts[counts > 0]
+
+
+def completion_postings(completion_index, completions=None, regex=None):
+    return query.lookup_completions(completion_index, completions=completions, regex=regex or None)
+
+
+def completion_uids(df_postings):
+    """UIDs which have used each completion, with the number of uses, their rewards and when they were first and last seen."""
+    return df_postings.groupby(['completions', 'uids'], observed=True).agg(
+        uses=('rewards', 'size'),
+        reward_mean=('rewards', 'mean'),
+        runs=('run_id', 'nunique'),
+        first_seen=('_timestamp', 'min'),
+        last_seen=('_timestamp', 'max'),
+    ).reset_index().sort_values('uses', ascending=False, ignore_index=True)
 
 
 def run_event_data(df_runs, df, selected_runs):
@@ -1,9 +1,12 @@
 import os
-import re
 import pandas as pd
 import streamlit as st
 
 import  opendashboards.utils.utils as utils
+import opendashboards.utils.catalog as catalog
+import opendashboards.utils.query as query
+import opendashboards.utils.aggregate as aggregate
+from opendashboards.assets import inspect
 
 from pandas.api.types import (
     is_categorical_dtype,
@@ -15,108 +18,185 @@ from pandas.api.types import (
 
 @st.cache_data
 def load_runs(project, filters, min_steps=10):
-    runs = []
-    n_events = 0
-    successful = 0
     progress = st.progress(0, 'Fetching runs from wandb')
-    msg = st.empty()
-
-    all_runs = utils.get_runs(project, filters, api_key=st.secrets['WANDB_API_KEY'])
-    for i, run in enumerate(all_runs):
-        
-        summary = run.summary
-        step = summary.get('_step',-1) + 1
-        if step < min_steps:
-            msg.warning(f'Skipped run `{run.name}` because it contains {step} events (<{min_steps})')
-            continue
-        
-        prog_msg = f'Loading data {i/len(all_runs)*100:.0f}% ({successful}/{len(all_runs)} runs, {n_events} events)'
-        progress.progress(i/len(all_runs),f'{prog_msg}... **fetching** `{run.name}`')
-        
-        duration = summary.get('_runtime')
-        end_time = summary.get('_timestamp')
-        # extract values for selected tags
-        rules = {'hotkey': re.compile('^[0-9a-z]{48}$',re.IGNORECASE), 'version': re.compile('^\\d\.\\d+\.\\d+$'), 'spec_version': re.compile('\\d{4}$')}
-        tags = {k: tag for k, rule in rules.items() for tag in run.tags if rule.match(tag)}
-        # include bool flag for remaining tags
-        tags.update({k: k in run.tags for k in ('mock','disable_set_weights')})
-
-        runs.append({
-            'state': run.state,
-            'num_steps': step,
-            'num_completions': step*sum(len(v) for k, v in run.summary.items() if k.endswith('completions') and isinstance(v, list)),
-            'entity': run.entity,
-            'run_id': run.id,
-            'run_name': run.name,
-            'project': run.project,
-            'url': run.url,
-            'run_path': os.path.join(run.entity, run.project, run.id),
-            'start_time': pd.to_datetime(end_time-duration, unit="s"),
-            'end_time': pd.to_datetime(end_time, unit="s"),
-            'duration': pd.to_timedelta(duration, unit="s").round('s'),
-            **tags
-        })
-        n_events += step
-        successful += 1
-
+    # only runs which are new or were updated since the last refresh are fetched, the rest comes from the persisted catalog
+    df_catalog = catalog.refresh_catalog(project, filters, api_key=st.secrets['WANDB_API_KEY'], progress=progress.progress)
     progress.empty()
-    msg.empty()
-    frame = pd.DataFrame(runs)
-    mappings = {'state': 'category', 'hotkey': 'category', 'version': 'category', 'spec_version': 'category'}
-    return frame.astype({k:v for k,v in mappings.items() if k in frame.columns})
 
+    skipped = df_catalog.loc[df_catalog.num_steps < min_steps]
+    if not skipped.empty:
+        st.warning(f'Skipped {len(skipped)} runs because they contain fewer than {min_steps} events')
+    return catalog.select_runs(df_catalog, min_steps=min_steps).reset_index(drop=True)
 
-@st.cache_data
-def load_data(selected_runs, load=True, save=False):
 
-    frames = []
-    n_events = 0
-    successful = 0
-    progress = st.progress(0, 'Loading data')
-    info = st.empty()
-    if not os.path.exists('data/'):
-        os.makedirs('data/')
-    for i, idx in enumerate(selected_runs.index):
-        run = selected_runs.loc[idx]
-        prog_msg = f'Loading data {i/len(selected_runs)*100:.0f}% ({successful}/{len(selected_runs)} runs, {n_events} events)'
+# memory budget of the per-run events which are cached by load_data, shared by all sessions
+RUN_CACHE_BYTES = 512 * 2**20
+# seconds after which a run is checked again, so that new events of running runs are synced
+SYNC_TTL = 600
 
-        file_path = os.path.join('data',f'history-{run.run_id}.csv')
 
-        if load and os.path.exists(file_path):
-            progress.progress(i/len(selected_runs),f'{prog_msg}... **reading** `{file_path}`')
-            try:
-                df = utils.load_data(file_path)
-            except Exception as e:
-                info.warning(f'Failed to load history from `{file_path}`')
-                st.exception(e)
-                continue
-        else:
-            progress.progress(i/len(selected_runs),f'{prog_msg}... **downloading** `{run.run_path}`')
-            try:
-                # Download the history from wandb and add metadata
-                df = utils.download_data(run.run_path).assign(**run.to_dict())
-
-                print(f'Downloaded {df.shape[0]} events from `{run.run_path}`. Columns: {df.columns}')
-                df.info()
-                
-                if save and run.state != 'running':
-                    df.to_csv(file_path, index=False)
-                    # st.info(f'Saved history to {file_path}')
-            except Exception as e:
-                info.warning(f'Failed to download history for `{run.run_path}`')
-                st.exception(e)
-                continue
-
-        frames.append(df)
-        n_events += df.shape[0]
-        successful += 1
+@st.cache_data(show_spinner=False, ttl=SYNC_TTL)
+def sync_run(run_id, run_path, state, load=True, refresh=False):
+    """Makes sure the history of a run is synced to `data/history/{run_id}`, and returns its directory.
+
+    The cached history is used when load is set, except for running runs when refresh is set, which are synced first.
+    Runs without a cached history are always synced to disk, since the events are only read from the cache by `load_data`.
+    The check is cached for `SYNC_TTL` seconds, so a running run is synced again at most that often.
+    """
+    file_path = os.path.join('data',f'history-{run_id}.csv')
+    run_dir = os.path.join('data', 'history', run_id)
+
+    if os.path.exists(file_path):
+        # old CSV caches are converted once to a synced history with native list columns
+        utils.import_history(file_path, run_dir)
+
+    if not (load and utils.read_sync_state(run_dir)['parts'] and not (refresh and state == 'running')):
+        # only events after the last synced step are downloaded
+        result = utils.sync_history(run_path, run_dir, explode=False)
+        print(f'Synced {result["rows"]} new events from `{run_path}` to `{run_dir}`')
+    return run_dir
+
+
+def sync_runs(selected_runs, load=True, refresh=False):
+    """Syncs the history of each selected run, see `sync_run`, and returns the directories by run id. Runs which fail are skipped."""
+    run_dirs = {}
+    progress = st.progress(0, 'Syncing data')
+    info = st.empty()
+    for i, run in enumerate(selected_runs.itertuples()):
+        progress.progress(i/len(selected_runs), f'Syncing data {i/len(selected_runs)*100:.0f}% ({len(run_dirs)}/{len(selected_runs)} runs)... `{run.run_path}`')
+        try:
+            run_dirs[run.run_id] = sync_run(run.run_id, run.run_path, run.state, load=load, refresh=refresh)
+        except Exception as e:
+            info.warning(f'Failed to sync history for `{run.run_path}`')
+            st.exception(e)
 
     progress.empty()
-    if not frames:
+    if not run_dirs:
         info.error('No data loaded')
         st.stop()
-    # Remove rows which contain chain weights as it messes up schema
-    return pd.concat(frames)
+    return run_dirs
+
+
+@st.cache_resource
+def run_cache():
+    return query.FrameCache(RUN_CACHE_BYTES)
+
+
+def raw_task_names(tasks):
+    return None if tasks is None else [k for k, v in inspect.TASK_NAMES.items() if v in tasks]
+
+
+def _cache_key(run_id, run_dir, kind, **filters):
+    # lists are not hashable, and the order of the filter values does not change the result
+    filters = tuple((k, tuple(sorted(v)) if isinstance(v, (list, set)) else v) for k, v in filters.items())
+    return (run_id, utils.read_sync_state(run_dir)['last_step'], kind, filters)
+
+
+def run_events(run_id, run_dir, **filters):
+    """Events of a run from `query.scan_run`, cached by the run id, its last synced step and the filters."""
+    cache = run_cache()
+    key = _cache_key(run_id, run_dir, 'events', **filters)
+    df = cache.get(key)
+    if df is None:
+        df = query.scan_run(run_dir, **filters)
+        cache.put(key, df)
+    return df
+
+
+def load_data(selected_runs, columns=None, tasks=None, uids=None, start=None, end=None, explode=True, limit=None, load=True, refresh=False):
+    """Reads only the events and columns of the selected runs which are needed, see `query.scan_run`.
+
+    The events of each run are cached by the run id, its last synced step and the query, so changing the selection only reads
+    the runs which were added. Task types are given by their display names in `inspect.TASK_NAMES`. Events without completions
+    or rewards are removed, and the hotkey of each run is joined from the run table. Histories are read from `data/history`,
+    where runs which were not synced yet are written first (see `sync_run`).
+    """
+    run_dirs = sync_runs(selected_runs, load=load, refresh=refresh)
+    filters = dict(columns=columns, tasks=raw_task_names(tasks), uids=uids, start=start, end=end, explode=explode, limit=limit, required=('completions', 'rewards'))
+    frames = {run_id: run_events(run_id, run_dir, **filters) for run_id, run_dir in run_dirs.items()}
+
+    df = query.finalize_events(frames, explode=explode)
+    if 'task' in df.columns:
+        df['task'] = df.task.map(inspect.TASK_NAMES)
+    if 'hotkey' in selected_runs.columns:
+        df['hotkey'] = df.run_id.map(selected_runs.set_index('run_id').hotkey)
+    return df
+
+
+def run_health(run_id, run_dir):
+    """Health table of one run, see `load_health`. Events are scanned one task at a time, and only the nsfw scores of that
+    task are read, which are kept as `nsfw_scores` so that the scores of all tasks merge into one column.
+    """
+    empty = pd.DataFrame(columns=['task', 'uids', 'run_id'])
+    # runs which were just started can have no synced events yet
+    dataset = query.history_dataset(run_dir)
+    if dataset is None:
+        return empty
+
+    names = dataset.schema.names
+    tasks = query.distinct_values({run_id: run_dir}, 'task') if 'task' in names else [None]
+    frames = []
+    for task in tasks:
+        score_col = next((c for c in (f'{task}_nsfw_scores', 'nsfw_scores') if c in names), None)
+        columns = ['uids', 'completions', 'rewards'] + ([score_col] if score_col else [])
+        events = query.scan_run(run_dir, columns=columns, tasks=None if task is None else [task], required=('completions', 'rewards'))
+        if events is None or events.empty:
+            continue
+        events = query.finalize_events({run_id: events}).rename(columns={score_col: 'nsfw_scores'})
+        events['task'] = inspect.TASK_NAMES.get(task)
+        frames.append(aggregate.health_partials(events).reset_index())
+
+    if not frames:
+        return empty
+    return pd.concat(frames, ignore_index=True).assign(run_id=run_id)
+
+
+def load_health(selected_runs, load=True, refresh=False):
+    """Health table of the selected runs, with partial aggregates of the completions, rewards and nsfw scores of every run,
+    task and uid (see `aggregate.health_partials`). UID metrics of any subset are found by merging its rows instead of
+    rescanning events. The table of each run is computed once from its events and cached like them. Runs are synced to disk
+    like in `load_data`.
+    """
+    run_dirs = sync_runs(selected_runs, load=load, refresh=refresh)
+    cache = run_cache()
+    frames = []
+    for run_id, run_dir in run_dirs.items():
+        key = _cache_key(run_id, run_dir, 'health')
+        health = cache.get(key)
+        if health is None:
+            health = run_health(run_id, run_dir)
+            cache.put(key, health)
+        frames.append(health)
+    return pd.concat(frames, ignore_index=True)
+
+
+def load_completion_index(selected_runs, tasks=None, load=True, refresh=False):
+    """Inverted indexes from completion to the uid, time and reward of every use in the selected runs, by run id (see
+    `query.CompletionIndex`). The index of each run is built once from its events and cached like them.
+    """
+    run_dirs = sync_runs(selected_runs, load=load, refresh=refresh)
+    filters = dict(columns=['_timestamp', 'uids', 'completions', 'rewards'], tasks=raw_task_names(tasks), required=('completions', 'rewards'))
+    cache = run_cache()
+    indexes = {}
+    for run_id, run_dir in run_dirs.items():
+        key = _cache_key(run_id, run_dir, 'completion_index', **filters)
+        indexes[run_id] = cache.get(key)
+        if indexes[run_id] is None:
+            indexes[run_id] = query.CompletionIndex(query.scan_run(run_dir, **filters))
+            cache.put(key, indexes[run_id])
+    return indexes
+
+
+@st.cache_data(show_spinner=False)
+def run_tasks(run_dir, last_step):
+    return query.distinct_values({run_dir: run_dir}, 'task')
+
+
+def load_tasks(selected_runs, load=True, refresh=False):
+    """Display names of the task types in the selected runs, reading only the task column of runs which changed."""
+    run_dirs = sync_runs(selected_runs, load=load, refresh=refresh)
+    tasks = {task for run_dir in run_dirs.values() for task in run_tasks(run_dir, utils.read_sync_state(run_dir)['last_step'])}
+    return [name for task, name in inspect.TASK_NAMES.items() if task in tasks]
 
 
 def filter_dataframe(df: pd.DataFrame, demo_selection=None) -> pd.DataFrame:
@@ -1,6 +1,7 @@
 import time
 import pandas as pd
 import streamlit as st
+import opendashboards.utils.aggregate as aggregate
 
 def fmt(number):
     units = ['', 'k', 'M', 'B']
@@ -57,22 +58,27 @@ def runs(df_long):
 
 
 @st.cache_data
-def uids(df_long, src, uids=None):
+def uids(df_health, src, uids=None):
 
-    nsfw_col = f'{src}_nsfw_scores'
+    # the health table holds the nsfw scores of every task in one column
+    nsfw_col = 'nsfw_scores'
 
     if uids:
-        df_long = df_long.loc[df_long['uids'].isin(uids)]
+        df_health = df_health.loc[df_health['uids'].isin(uids)]
+
+    # the health table holds mergeable partials of every run, task and uid, so metrics of any subset only merge its rows
+    total = aggregate.finalize_partials(aggregate.merge_partials(df_health.assign(total=0), 'total')).iloc[0]
+    per_uid = aggregate.finalize_partials(aggregate.merge_partials(df_health, 'uids'))
 
     col1, col2, col3, col4 = st.columns(4)
     col1.metric(
         label="Success %",
-        value=f'{df_long.loc[df_long["completions"].str.len() > 0].shape[0]/df_long.shape[0] * 100:.1f}',
+        value=f'{total["completions_success_rate"] * 100:.1f}',
         help='Number of successful completions divided by total number of events'
     )
     col2.metric(
         label="Diversity %",
-        value=f'{df_long["completions"].nunique()/df_long.shape[0] * 100:.1f}',
+        value=f'{total["completions_diversity"] * 100:.1f}',
         help='Number of unique completions divided by total number of events'
     )
     # uniqueness can be expressed as the average number of unique completions per uid divided by all unique completions
@@ -80,12 +86,12 @@ def uids(df_long, src, uids=None):
 
     col3.metric(
         label="Uniqueness %",
-        value=f'{df_long.groupby("uids")["completions"].nunique().mean()/df_long["completions"].nunique() * 100:.1f}',
+        value=f'{per_uid["completions_nunique"].mean()/total["completions_nunique"] * 100:.1f}',
         help='Average number of unique completions per uid divided by all unique completions'
     )
     col4.metric(
         label="Toxicity %",
-        value=f'{df_long[nsfw_col].mean() * 100:.1f}' if nsfw_col in df_long.columns else '--',
+        value=f'{total[f"{nsfw_col}_mean"] * 100:.1f}' if f'{nsfw_col}_mean' in total.index else '--',
         help='Average toxicity score of all events'
     )
     st.markdown('----')
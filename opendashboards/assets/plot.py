@@ -31,7 +31,7 @@ def leaderboard(df, ntop, group_on, agg_col, agg, alias=False):
     )
 
 # @st.cache_data
-def completion_rewards(df, completion_col, reward_col, uid_col, ntop, completions=None, completion_regex=None):
+def completion_rewards(df, completion_col, reward_col, uid_col, ntop, completions=None, completion_regex=None, completion_counts=None):
     return st.plotly_chart(
         plotting.plot_completion_rewards(
             df,
@@ -40,7 +40,8 @@ def completion_rewards(df, completion_col, reward_col, uid_col, ntop, completion
             uid_col=uid_col,
             ntop=ntop,
             completions=completions,
-            completion_regex=completion_regex
+            completion_regex=completion_regex,
+            completion_counts=completion_counts
         ),
         use_container_width=True
     )
@@ -1,5 +1,8 @@
+import numpy as np
 import pandas as pd
 
+from opendashboards.utils.utils import completion_hashes
+
 def diversity(x):
     return x.nunique()/len(x) if len(x)>0 else 0
 
@@ -49,4 +52,356 @@ def nonzero_std(x):
     return x[x>0].std()
 
 def nonzero_median(x):
-    return x[x>0].median()
\ No newline at end of file
+    return x[x>0].median()
+
+# Vectorized versions of the aggregations above, which compute a metric for every group (e.g. time bucket) in one pass.
+# bucket holds the group key of each row and all inputs are aligned arrays or series of the same length.
+# Buckets and completions are reduced to integer codes first, so that counting is done with bincount and integer hashing.
+# Completions which are categoricals (see utils.decode_completions) are factorized from their codes without touching the text.
+
+def _codes(values):
+    codes, uniques = pd.factorize(np.asarray(values), sort=True)
+    return codes.astype('int64'), uniques
+
+# largest number of (bucket, code) pairs which are counted in a dense table rather than hashed
+DENSE_PAIRS = 2**26
+
+def _nunique(bucket, codes, mask, nbuckets):
+    # count distinct (bucket, code) pairs in each bucket
+    ncodes = codes.max() + 1 if len(codes) else 1
+    pairs = bucket[mask] * ncodes + codes[mask]
+    if nbuckets * ncodes <= DENSE_PAIRS:
+        seen = np.zeros(nbuckets * ncodes, dtype=bool)
+        seen[pairs] = True
+        return seen.reshape(nbuckets, ncodes).sum(axis=1)
+    return np.bincount(pd.unique(pairs) // ncodes, minlength=nbuckets)
+
+def _pair_stats(pairs, x, npairs):
+    # size, mean and std of x for each distinct pair, counted with bincount in a dense table when there are few possible pairs
+    if npairs <= DENSE_PAIRS:
+        keys, inverse = None, pairs
+    else:
+        inverse, keys = pd.factorize(pairs)
+        npairs = len(keys)
+    size = np.bincount(inverse, minlength=npairs)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.bincount(inverse, weights=x, minlength=npairs) / size
+        # the squared deviations from the mean are summed in a second pass, which is as accurate as groupby.std
+        std = np.sqrt(np.bincount(inverse, weights=(x - mean[inverse])**2, minlength=npairs) / (size - 1))
+    std[size < 2] = np.nan
+    present = np.flatnonzero(size)
+    return (present if keys is None else keys[present]), size[present], mean[present], std[present]
+
+def completion_stats(completions, rewards, bucket):
+    """Diversity and success rate of completions in each bucket, equivalent to diversity, successful_diversity,
+    success_rate and successful_nonzero_diversity.
+    """
+    bucket, keys = _codes(bucket)
+    codes, uniques = pd.factorize(completions)
+    codes = codes.astype('int64')
+    # missing completions are not counted as unique values, but count as non-empty like in _nonempty
+    valid = codes >= 0
+    nonempty = ~np.isin(codes, np.flatnonzero(uniques == ''))
+    nonzero = nonempty & (np.asarray(rewards) > 0)
+
+    nbuckets = len(keys)
+    count = np.bincount(bucket, minlength=nbuckets)
+    nonempty_count = np.bincount(bucket[nonempty], minlength=nbuckets)
+    nonzero_count = np.bincount(bucket[nonzero], minlength=nbuckets)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return pd.DataFrame({
+            'completions_diversity': _nunique(bucket, codes, valid, nbuckets) / count,
+            'completions_successful_diversity': np.where(nonempty_count > 0, _nunique(bucket, codes, valid & nonempty, nbuckets) / nonempty_count, 0),
+            'completions_success_rate': nonempty_count / count,
+            'completions_successful_nonzero_diversity': np.where(nonzero_count > 0, _nunique(bucket, codes, valid & nonzero, nbuckets) / nonzero_count, 0),
+        }, index=keys)
+
+def nonzero_stats(x, bucket, prefix=''):
+    """Rate, mean, std and median of the positive values in each bucket, equivalent to the nonzero_* functions."""
+    bucket, keys = _codes(bucket)
+    x = pd.Series(np.asarray(x, dtype=float))
+    positive = x.where(x > 0).groupby(bucket)
+    return pd.DataFrame({
+        f'{prefix}nonzero_rate': np.bincount(bucket, weights=x > 0, minlength=len(keys)) / np.bincount(bucket, minlength=len(keys)),
+        f'{prefix}nonzero_mean': positive.mean().values,
+        f'{prefix}nonzero_std': positive.std().values,
+        f'{prefix}nonzero_median': positive.median().values,
+    }, index=keys)
+
+def top_completions(completions, rewards, bucket, exclude=None, ntop=1):
+    """The ntop most frequent completions in each bucket with their frequency and reward mean and std, equivalent to completion_top_stats.
+
+    Returns a frame indexed by (bucket, rank). Ties in frequency are broken by first appearance.
+    """
+    bucket, keys = _codes(bucket)
+    codes, uniques = pd.factorize(completions)
+    codes = codes.astype('int64')
+    mask = codes >= 0
+    if exclude is not None:
+        mask &= ~np.isin(codes, np.flatnonzero(uniques == exclude))
+
+    ncodes = max(len(uniques), 1)
+    pairs, size, mean, std = _pair_stats(bucket[mask] * ncodes + codes[mask], np.asarray(rewards, dtype=float)[mask], len(keys) * ncodes)
+    pair_bucket, pair_code = pairs // ncodes, pairs % ncodes
+
+    order = np.lexsort((pair_code, -size, pair_bucket))
+    rank = pd.Series(pair_bucket[order]).groupby(pair_bucket[order]).cumcount().values
+    top = order[rank < ntop]
+
+    return pd.DataFrame({
+        'completions_top': np.asarray(uniques)[pair_code[top]],
+        'completions_freq': size[top],
+        'completions_reward_mean': mean[top],
+        'completions_reward_std': std[top],
+    }, index=pd.MultiIndex.from_arrays([keys[pair_bucket[top]], rank[rank < ntop]]))
+
+# Mergeable partial aggregates, which are computed per time bucket and can be combined into coarser buckets without the raw events.
+# Partial columns are named {col}__{part} and the suffix decides how they are merged: counts and sums are added, min and max are
+# taken, HyperLogLog sketches (bytes of uint8 registers) are merged by taking the maximum of each register, and Space-Saving
+# sketches of the most frequent completions (bytes of SPACE_SAVING_DTYPE entries) are merged with space_saving_merge.
+
+HLL_PRECISION = 12
+SPACE_SAVING_SIZE = 64
+# health tables hold a row for every uid, so their sketches are smaller
+HEALTH_HLL_PRECISION = 10
+# completions are identified by the hash of the completion dictionary, so their text can be looked up there
+SPACE_SAVING_DTYPE = np.dtype([('hash', '<i8'), ('count', '<i8'), ('error', '<i8'), ('n', '<i8'), ('reward_sum', '<f8'), ('reward_sumsq', '<f8')])
+MERGE_RULES = {'count': 'sum', 'sum': 'sum', 'sumsq': 'sum', 'pos_count': 'sum', 'pos_sum': 'sum', 'pos_sumsq': 'sum',
+               'nonempty': 'sum', 'nonzero': 'sum', 'min': 'min', 'max': 'max'}
+
+def _hashes(values):
+    # stable 64 bit hashes, computed once per unique value
+    codes, uniques = pd.factorize(values)
+    hashes = completion_hashes(uniques)
+    return codes.astype('int64'), uniques, hashes[codes] if len(hashes) else np.zeros(len(codes), dtype='int64')
+
+def hll_registers(hashes, bucket, nbuckets, p=HLL_PRECISION):
+    """HyperLogLog registers of the hashes in each bucket, as a (nbuckets, 2**p) uint8 array."""
+    hashes = np.asarray(hashes, dtype='int64').view('uint64')
+    index = (hashes >> np.uint64(64 - p)).astype('int64')
+    # rank of the first set bit in the next 32 bits, which is exact in float64
+    rest = ((hashes << np.uint64(p)) >> np.uint64(32)).astype('float64')
+    rank = np.where(rest > 0, 33 - np.frexp(rest)[1], 33).astype('uint8')
+
+    registers = np.zeros((nbuckets, 2**p), dtype='uint8')
+    if len(hashes):
+        cells = pd.Series(rank).groupby(np.asarray(bucket) * 2**p + index).max()
+        registers.flat[cells.index.values] = cells.values
+    return registers
+
+def hll_count(registers):
+    """Estimated number of distinct values of each row of HyperLogLog registers, with the small range correction."""
+    registers = np.atleast_2d(registers)
+    m = registers.shape[1]
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m**2 / np.power(2.0, -registers.astype('float64')).sum(axis=1)
+    zeros = (registers == 0).sum(axis=1)
+    with np.errstate(divide='ignore'):
+        small = m * np.log(m / zeros)
+    return np.where((estimate <= 2.5 * m) & (zeros > 0), small, estimate)
+
+def _to_registers(sketches):
+    return np.stack([np.frombuffer(s, dtype='uint8') for s in sketches]) if len(sketches) else np.zeros((0, 2**HLL_PRECISION), dtype='uint8')
+
+def _to_entries(sketches):
+    return [np.frombuffer(s, dtype=SPACE_SAVING_DTYPE) for s in sketches]
+
+def _space_saving_select(entries, group, k):
+    # keeps the k entries with the highest counts in each group, ties are broken by hash so results do not depend on order
+    order = np.lexsort((entries['hash'], -entries['count'], group))
+    rank = pd.Series(group[order]).groupby(group[order]).cumcount().values
+    keep = order[rank < k]
+    return entries[keep], group[keep]
+
+def _split_groups(entries, group, ngroups):
+    bounds = np.searchsorted(group, np.arange(1, ngroups))
+    return [e.tobytes() for e in np.split(entries, bounds)]
+
+def space_saving(hashes, rewards, bucket, nbuckets, k=SPACE_SAVING_SIZE):
+    """Space-Saving sketches of the k most frequent hashes in each bucket, with the count, number and sum and sum of squares of rewards
+    of each of them. Counts within a bucket are exact, so every dropped hash is at most as frequent as the least frequent kept one.
+    """
+    hashes = np.asarray(hashes, dtype='int64')
+    rewards = pd.Series(np.asarray(rewards, dtype=float))
+    pairs = pd.DataFrame({'count': 1, 'reward': rewards.values, 'reward_sq': rewards.values**2}).groupby([np.asarray(bucket), hashes]).agg(
+        count=('count', 'size'), n=('reward', 'count'), reward_sum=('reward', 'sum'), reward_sumsq=('reward_sq', 'sum'))
+
+    entries = np.zeros(len(pairs), dtype=SPACE_SAVING_DTYPE)
+    entries['hash'] = pairs.index.get_level_values(1)
+    for field in ['count', 'n', 'reward_sum', 'reward_sumsq']:
+        entries[field] = pairs[field].values
+    entries, group = _space_saving_select(entries, pairs.index.get_level_values(0).values.astype('int64'), k)
+    return _split_groups(entries, group, nbuckets)
+
+def space_saving_merge(sketches, group, ngroups, k=SPACE_SAVING_SIZE):
+    """Merges Space-Saving sketches which have the same group. A hash which is missing from a full sketch may have been dropped from it,
+    so it is counted with the smallest count of that sketch, which is also added to its error. Counts are therefore upper bounds and
+    count - error are lower bounds of the true frequencies.
+    """
+    entries = _to_entries(sketches)
+    sizes = np.array([len(e) for e in entries])
+    floors = np.array([e['count'].min() if len(e) >= k else 0 for e in entries], dtype='int64')
+    group = np.asarray(group, dtype='int64')
+    total_floor = np.bincount(group, weights=floors, minlength=ngroups).astype('int64')
+
+    entries = np.concatenate(entries) if len(entries) else np.zeros(0, dtype=SPACE_SAVING_DTYPE)
+    entry_group = np.repeat(group, sizes)
+    sums = pd.DataFrame({f: entries[f] for f in ['count', 'error', 'n', 'reward_sum', 'reward_sumsq']}).assign(
+        floor=np.repeat(floors, sizes)).groupby([entry_group, entries['hash']]).sum()
+
+    merged = np.zeros(len(sums), dtype=SPACE_SAVING_DTYPE)
+    merged_group = sums.index.get_level_values(0).values.astype('int64')
+    missing_floor = total_floor[merged_group] - sums['floor'].values
+    merged['hash'] = sums.index.get_level_values(1)
+    merged['count'] = sums['count'].values + missing_floor
+    merged['error'] = sums['error'].values + missing_floor
+    for field in ['n', 'reward_sum', 'reward_sumsq']:
+        merged[field] = sums[field].values
+    merged, merged_group = _space_saving_select(merged, merged_group, k)
+    return _split_groups(merged, merged_group, ngroups)
+
+def space_saving_top(sketches, ntop=3, exclude=None, texts=None, col='completions'):
+    """Top ntop completions of each Space-Saving sketch, with their estimated frequency and reward mean and std, named like the
+    columns of calculate_stats. Completions are shown as text if texts (a Series of text indexed by hash) is given.
+    """
+    exclude_hashes = completion_hashes([exclude]) if exclude is not None else np.array([], dtype='int64')
+    columns = {}
+    for rank in range(ntop):
+        columns.update({f'{col}_top_{rank}': [], f'{col}_freq_{rank}': [], f'{col}_reward_mean_{rank}': [], f'{col}_reward_std_{rank}': []})
+
+    for entries in _to_entries(sketches):
+        entries = entries[~np.isin(entries['hash'], exclude_hashes)]
+        entries = entries[np.lexsort((entries['hash'], -entries['count']))][:ntop]
+        for rank in range(ntop):
+            if rank < len(entries):
+                e = entries[rank]
+                n, s, ss = e['n'], e['reward_sum'], e['reward_sumsq']
+                top = texts.get(e['hash'], e['hash']) if texts is not None else e['hash']
+                values = [top, e['count'], s / n if n > 0 else np.nan, np.sqrt(max(ss - s**2 / n, 0) / (n - 1)) if n > 1 else np.nan]
+            else:
+                values = [None, np.nan, np.nan, np.nan]
+            for name, value in zip(['top', 'freq', 'reward_mean', 'reward_std'], values):
+                columns[f'{col}_{name}_{rank}'].append(value)
+    return pd.DataFrame(columns)
+
+def numeric_partials(x, bucket, col):
+    """Count, sum, sum of squares, min and max of the values (and of the positive values) of col in each bucket. NaNs are skipped."""
+    bucket, keys = _codes(bucket)
+    x = pd.Series(np.asarray(x, dtype=float))
+    valid = x.notna().values
+    pos = x.where(x > 0)
+    groups, pos_groups = x.groupby(bucket), pos.groupby(bucket)
+    return pd.DataFrame({
+        f'{col}__count': np.bincount(bucket[valid], minlength=len(keys)),
+        f'{col}__sum': groups.sum().values,
+        f'{col}__sumsq': (x**2).groupby(bucket).sum().values,
+        f'{col}__min': groups.min().values,
+        f'{col}__max': groups.max().values,
+        f'{col}__pos_count': pos_groups.count().values,
+        f'{col}__pos_sum': pos_groups.sum().values,
+        f'{col}__pos_sumsq': (pos**2).groupby(bucket).sum().values,
+    }, index=keys)
+
+def completion_partials(completions, rewards, bucket, col='completions', p=HLL_PRECISION, topk=True):
+    """Counts and HyperLogLog sketches of all, non-empty, and non-empty rewarded completions in each bucket, from which
+    completion_stats can be estimated for any merge of buckets, and a Space-Saving sketch of the most frequent completions.
+    """
+    bucket, keys = _codes(bucket)
+    codes, uniques, hashes = _hashes(completions)
+    # like in completion_stats, missing completions count as non-empty but not as unique values
+    valid = codes >= 0
+    nonempty = ~np.isin(codes, np.flatnonzero(uniques == ''))
+    nonzero = nonempty & (np.asarray(rewards, dtype=float) > 0)
+
+    nbuckets = len(keys)
+    partials = {f'{col}__count': np.bincount(bucket, minlength=nbuckets),
+                f'{col}__nonempty': np.bincount(bucket[nonempty], minlength=nbuckets),
+                f'{col}__nonzero': np.bincount(bucket[nonzero], minlength=nbuckets)}
+    for name, mask in [('hll', valid), ('nonempty_hll', valid & nonempty), ('nonzero_hll', valid & nonzero)]:
+        partials[f'{col}__{name}'] = [r.tobytes() for r in hll_registers(hashes[mask], bucket[mask], nbuckets, p)]
+    if topk:
+        partials[f'{col}__topk'] = space_saving(hashes[valid], np.asarray(rewards, dtype=float)[valid], bucket[valid], nbuckets)
+    return pd.DataFrame(partials, index=keys)
+
+def health_partials(df, keys=('task', 'uids'), completion_col='completions', reward_col='rewards', p=HEALTH_HLL_PRECISION):
+    """Partial aggregates of the completions, rewards and nsfw scores of each group of keys (e.g. task and uid), from which the
+    health metrics of any set of groups follow with merge_partials and finalize_partials. Groups with missing keys are kept.
+    """
+    groups = df.groupby(list(keys), observed=True, dropna=False, sort=True)
+    bucket = groups.ngroup().values
+    frames = [completion_partials(df[completion_col], df[reward_col], bucket, col=completion_col, p=p, topk=False)]
+    for col in [reward_col, *(c for c in df.columns if c.endswith('nsfw_scores'))]:
+        frames.append(numeric_partials(df[col], bucket, col))
+    partials = pd.concat(frames, axis=1)
+    partials.index = groups.size().index
+    return partials
+
+def merge_partials(partials, keys):
+    """Merges the rows of a frame of partial aggregates which have the same keys (e.g. a coarser time bucket and run_id)."""
+    rules = {c: MERGE_RULES[c.split('__', 1)[1]] for c in partials.columns if '__' in c and not c.endswith(('hll', 'topk'))}
+    groups = partials.groupby(keys, sort=True)
+    merged = groups.agg(rules)
+
+    # sketches of groups with a single row are kept as they are, only the others are decoded and merged
+    group = groups.ngroup().values
+    sizes = np.bincount(group, minlength=len(merged))
+    single = sizes[group] == 1
+    multi = np.flatnonzero(~single)
+    order = multi[np.argsort(group[multi], kind='stable')]
+    starts = np.flatnonzero(np.r_[True, np.diff(group[order]) > 0]) if len(order) else order
+    multi_groups = np.unique(group[multi])
+    for c in partials.columns:
+        if not c.endswith(('hll', 'topk')):
+            continue
+        values = np.empty(len(merged), dtype=object)
+        values[group[single]] = partials[c].values[single]
+        if len(multi):
+            if c.endswith('hll'):
+                registers = np.maximum.reduceat(_to_registers(partials[c].values[order]), starts, axis=0)
+                values[multi_groups] = [r.tobytes() for r in registers]
+            else:
+                values[multi_groups] = space_saving_merge(partials[c].values[multi], np.searchsorted(multi_groups, group[multi]), len(multi_groups))
+        merged[c] = values
+    return merged
+
+def finalize_partials(partials, ntop=3, texts=None):
+    """Converts partial aggregates to the stats they summarize, named like the columns of multistats.calculate_stats.
+
+    Medians are not mergeable and are left out. Unique counts are HyperLogLog estimates and the ntop most frequent non-empty
+    completions are Space-Saving estimates, shown as text if texts (a Series of text indexed by hash) is given.
+    """
+    stats = {}
+    for col in dict.fromkeys(c.split('__', 1)[0] for c in partials.columns if '__' in c):
+        if f'{col}__hll' in partials.columns:
+            count = partials[f'{col}__count'].values
+            nonempty, nonzero = partials[f'{col}__nonempty'].values, partials[f'{col}__nonzero'].values
+            nunique = {name: hll_count(_to_registers(partials[f'{col}__{name}'].values)) for name in ['hll', 'nonempty_hll', 'nonzero_hll']}
+            with np.errstate(divide='ignore', invalid='ignore'):
+                stats.update({
+                    f'{col}_count': count,
+                    f'{col}_nunique': nunique['hll'].round(),
+                    f'{col}_diversity': nunique['hll'] / count,
+                    f'{col}_successful_diversity': np.where(nonempty > 0, nunique['nonempty_hll'] / nonempty, 0),
+                    f'{col}_success_rate': nonempty / count,
+                    f'{col}_successful_nonzero_diversity': np.where(nonzero > 0, nunique['nonzero_hll'] / nonzero, 0),
+                })
+            if f'{col}__topk' in partials.columns:
+                top = space_saving_top(partials[f'{col}__topk'].values, ntop=ntop, exclude='', texts=texts, col=col)
+                stats.update({c: top[c].values for c in top.columns})
+            continue
+
+        n, s, ss = (partials[f'{col}__{k}'].values for k in ['count', 'sum', 'sumsq'])
+        pn, ps, pss = (partials[f'{col}__{k}'].values for k in ['pos_count', 'pos_sum', 'pos_sumsq'])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stats.update({
+                f'{col}_sum': s,
+                f'{col}_mean': np.where(n > 0, s / n, np.nan),
+                f'{col}_std': np.where(n > 1, np.sqrt(np.maximum(ss - s**2 / n, 0) / (n - 1)), np.nan),
+                f'{col}_min': partials[f'{col}__min'].values,
+                f'{col}_max': partials[f'{col}__max'].values,
+                f'{col}_nonzero_rate': np.where(n > 0, pn / n, np.nan),
+                f'{col}_nonzero_mean': np.where(pn > 0, ps / pn, np.nan),
+                f'{col}_nonzero_std': np.where(pn > 1, np.sqrt(np.maximum(pss - ps**2 / pn, 0) / (pn - 1)), np.nan),
+            })
+    return pd.DataFrame(stats, index=partials.index)
@@ -0,0 +1,146 @@
+import os
+import re
+import tqdm
+import wandb
+import pandas as pd
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Callable
+
+CATALOG_DIR = "data/catalog/"
+
+# tags which identify the validator, compiled once rather than for every run on every refresh
+TAG_RULES = {
+    "hotkey": re.compile("^[0-9a-z]{48}$", re.IGNORECASE),
+    "version": re.compile(r"^\d\.\d+\.\d+$"),
+    "spec_version": re.compile(r"\d{4}$"),
+}
+# tags which are always included as boolean columns, the other tags get one when a run has them. All tags are also kept in the `tags` column
+FLAG_TAGS = ("mock", "disable_set_weights")
+CATEGORY_COLS = ("state", "hotkey", "version", "spec_version")
+
+
+def catalog_path(project: str, catalog_dir: str = CATALOG_DIR) -> str:
+    return os.path.join(catalog_dir, f"{project.replace('/', '--')}.parquet")
+
+
+def _updated_at(run) -> str:
+    # newer wandb versions only list the heartbeat of a run unless its full data is loaded
+    attrs = getattr(run, "_attrs", {})
+    return attrs.get("updatedAt") or attrs.get("heartbeatAt")
+
+
+def run_record(run) -> Dict[str, Any]:
+    """Extracts the catalog record of a run. This reads the summary, config and user of the run, which can each be an HTTP request."""
+    summary = run.summary
+    step = summary.get("_step", -1) + 1
+    duration = summary.get("_runtime")
+    end_time = summary.get("_timestamp")
+    tags = {k: tag for k, rule in TAG_RULES.items() for tag in run.tags if rule.match(tag)}
+    tags.update({k: k in run.tags for k in FLAG_TAGS})
+    # include bool flag for remaining tags
+    tags.update({k: True for k in run.tags if k not in tags.keys() and k not in tags.values()})
+
+    return {
+        "state": run.state,
+        "num_steps": step,
+        "num_completions": step * sum(len(v) for k, v in summary.items() if k.endswith("completions") and isinstance(v, list)),
+        "entity": run.entity,
+        "user": run.user.name,
+        "username": run.user.username,
+        "run_id": run.id,
+        "run_name": run.name,
+        "project": run.project,
+        "url": run.url,
+        "run_path": os.path.join(run.entity, run.project, run.id),
+        "start_time": pd.to_datetime(end_time - duration, unit="s") if end_time is not None and duration is not None else pd.NaT,
+        "end_time": pd.to_datetime(end_time, unit="s") if end_time is not None else pd.NaT,
+        "duration": pd.to_timedelta(duration, unit="s").round("s") if duration is not None else pd.NaT,
+        "netuid": run.config.get("netuid"),
+        "tags": ",".join(run.tags),
+        "updated_at": _updated_at(run),
+        **tags,
+    }
+
+
+def _fill_tag_flags(catalog: pd.DataFrame) -> pd.DataFrame:
+    # runs without a tag have no value in its boolean column
+    for c in catalog.columns:
+        values = catalog[c].dropna()
+        if len(values) and catalog[c].isna().any() and values.map(type).eq(bool).all():
+            catalog[c] = catalog[c].fillna(False).astype(bool)
+    return catalog
+
+
+def read_catalog(project: str, catalog_dir: str = CATALOG_DIR) -> pd.DataFrame:
+    """Reads the persisted run catalog of a project, or an empty frame if there is none."""
+    path = catalog_path(project, catalog_dir)
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=["run_id", "updated_at"])
+    return pd.read_parquet(path)
+
+
+def write_catalog(catalog: pd.DataFrame, project: str, catalog_dir: str = CATALOG_DIR):
+    path = catalog_path(project, catalog_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    catalog = catalog.astype({k: str for k in CATEGORY_COLS if k in catalog.columns})
+    catalog.to_parquet(f"{path}.tmp", index=False)
+    os.replace(f"{path}.tmp", path)
+
+
+def refresh_catalog(project: str, filters: Dict[str, Any] = None, max_workers: int = 16, api_key: str = None, timeout: float = 60, catalog_dir: str = CATALOG_DIR, progress: Callable = None) -> pd.DataFrame:
+    """Lists the runs of a project and returns their catalog records, in listing order.
+
+    Only runs which are new or whose `updatedAt` (or heartbeat) changed since the last refresh are fetched, in a bounded thread pool.
+    The records of all runs seen so far are persisted, so changing the filters does not refetch known runs.
+
+    Args:
+        project (str): Name of the project, e.g. 'opentensor-dev/openvalidators'.
+        filters (Dict[str, Any], optional): Optional run filters for wandb api. Defaults to None.
+        max_workers (int, optional): Number of runs which are fetched at the same time. Defaults to 16.
+        api_key (str, optional): Wandb api key. Defaults to None.
+        timeout (float, optional): Timeout for wandb api. Defaults to 60.
+        catalog_dir (str, optional): Directory of the persisted catalogs. Defaults to CATALOG_DIR.
+        progress (Callable, optional): Called with the fraction of fetched runs and a message, e.g. to update a progress bar.
+
+    Returns:
+        pd.DataFrame: Catalog records of the listed runs.
+    """
+    api = wandb.Api(api_key=api_key, timeout=timeout)
+    wandb.login(anonymous="allow")
+
+    catalog = read_catalog(project, catalog_dir)
+    known = dict(zip(catalog["run_id"], catalog["updated_at"]))
+
+    # listing is paginated and cheap, the heavy fields are only loaded for runs which changed
+    runs = list(api.runs(project, filters=filters))
+    stale = [run for run in runs if run.id not in known or known[run.id] != _updated_at(run)]
+    print(f"Listed {len(runs)} runs of {project!r}, fetching {len(stale)} new or updated runs")
+
+    records = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for i, record in enumerate(tqdm.tqdm(executor.map(run_record, stale), total=len(stale), desc="Fetching runs", unit="run")):
+            records.append(record)
+            if progress is not None:
+                progress((i + 1) / len(stale), f"Fetched {i+1}/{len(stale)} new or updated runs")
+
+    if records:
+        fetched = pd.DataFrame(records)
+        kept = catalog.loc[~catalog["run_id"].isin(fetched["run_id"])]
+        catalog = _fill_tag_flags(pd.concat([kept, fetched], ignore_index=True) if len(kept) else fetched)
+        write_catalog(catalog, project, catalog_dir)
+
+    listed = catalog.set_index("run_id").loc[[run.id for run in runs]].reset_index()
+    return listed.astype({k: "category" for k in CATEGORY_COLS if k in listed.columns})
+
+
+def select_runs(catalog: pd.DataFrame, min_steps: int = 0, max_steps: int = None, netuid: int = None, ntop: int = None) -> pd.DataFrame:
+    """Selects runs from a catalog by their number of steps and netuid, keeping at most the first ntop of them."""
+    mask = catalog["num_steps"] >= min_steps
+    if max_steps is not None:
+        mask &= catalog["num_steps"] <= max_steps
+    if netuid is not None:
+        mask &= catalog["netuid"] == netuid
+    selected = catalog.loc[mask]
+    print(f"Selected {len(selected) if ntop is None else min(ntop, len(selected))}/{len(catalog)} runs with at least {min_steps} events")
+    return selected.iloc[:ntop] if ntop is not None else selected
@@ -161,7 +161,7 @@ def plot_completion_rates(
 
     period = df[time_col].dt.to_period(time_interval)
 
-    counts = df.groupby([msg_col, period]).size()
+    counts = df.groupby([msg_col, period], observed=True).size()
     top_counts = counts.loc[completions].reset_index().rename(columns={0: "Size"})
     top_counts["Completion ID"] = top_counts[msg_col].map({k: f"{i}" for i, k in enumerate(completions, start=1)})
 
@@ -186,6 +186,7 @@ def plot_completion_rewards(
     ntop: int = 3,
     completions: List[str] = None,
     completion_regex: str = None,
+    completion_counts: pd.Series = None,
 ) -> go.Figure:
     """Plot completion rewards. Useful for tracking common completions and their rewards.
 
@@ -198,6 +199,8 @@ def plot_completion_rewards(
         ntop (int, optional): Number of completions to plot. Defaults to 20.
         completions (List[str], optional): List of completions to plot. Defaults to None.
         completion_regex (str, optional): Regex to match completions. Defaults to None.
+        completion_counts (pd.Series, optional): Number of uses of every completion, e.g. from a completion index, in which case df
+            only needs to hold the events of the plotted completions. Defaults to None (counted from df).
 
     """
 
@@ -206,7 +209,8 @@ def plot_completion_rewards(
         .explode(column=[msg_col, uid_col, reward_col])
         .rename(columns={uid_col: "UID"})
     )
-    completion_counts = df[msg_col].value_counts()
+    if completion_counts is None:
+        completion_counts = df[msg_col].value_counts()
 
     if completions is None:
         if completion_regex is not None:
@@ -264,7 +268,7 @@ def plot_leaderboard(
     """
     df = df[[group_on, agg_col]].explode(column=[group_on, agg_col])
 
-    rankings = df.groupby(group_on)[agg_col].agg(agg).sort_values(ascending=False).head(ntop).astype(float)
+    rankings = df.groupby(group_on, observed=True)[agg_col].agg(agg).sort_values(ascending=False).head(ntop).astype(float)
     if alias:
         index = rankings.index.map({name: str(i) for i, name in enumerate(rankings.index)})
     else:
@@ -0,0 +1,311 @@
+import os
+import threading
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from typing import List, Dict, Iterable
+from collections import OrderedDict
+from pandas.api.types import is_list_like, is_numeric_dtype
+
+from opendashboards.utils.utils import read_sync_state, read_history_schema, completion_texts, completion_ids, match_completions, intern_completions, decode_completions, COMPLETION_COLS, COMPLETIONS_PATH
+
+
+def history_dataset(run_dir: str) -> ds.Dataset:
+    """Opens the parts of a synced run history as one dataset. Nothing is read until the dataset is scanned.
+
+    Parts are read with the columns of all parts (see `utils.read_history_schema`), columns which a part does not have are null.
+    """
+    parts = [os.path.join(run_dir, part) for part in read_sync_state(run_dir)["parts"]]
+    if not parts:
+        return None
+    return ds.dataset(parts, format="parquet", schema=read_history_schema(run_dir))
+
+
+def _filter_expression(schema: pa.Schema, tasks: Iterable[str] = None, start: pd.Timestamp = None, end: pd.Timestamp = None, required: Iterable[str] = ()) -> ds.Expression:
+    # timestamps are stored as unix seconds, the filter is pushed down to the parquet row group statistics
+    expr = ds.scalar(True)
+    if start is not None:
+        expr &= ds.field("_timestamp") >= (pd.Timestamp(start) - pd.Timestamp(0)).total_seconds()
+    if end is not None:
+        expr &= ds.field("_timestamp") < (pd.Timestamp(end) - pd.Timestamp(0)).total_seconds()
+    if tasks is not None and "task" in schema.names:
+        expr &= ds.field("task").isin(list(tasks))
+    for c in required:
+        if c in schema.names:
+            expr &= ds.field(c).is_valid()
+    return expr
+
+
+def _flatten_like(values: pa.Array, lengths: np.ndarray) -> pa.Array:
+    # flattens a list column whose non-null lists have the given lengths, null lists become that many null elements
+    flat = pc.list_flatten(values)
+    if values.null_count == 0:
+        return flat
+    valid = values.is_valid().to_numpy(zero_copy_only=False)
+    parents = pc.list_parent_indices(values).to_numpy()
+    out_starts = np.cumsum(lengths) - lengths
+    flat_starts = np.cumsum(np.where(valid, lengths, 0)) - np.where(valid, lengths, 0)
+    indices = np.full(lengths.sum(), -1, dtype="int64")
+    indices[out_starts[parents] + np.arange(len(flat)) - flat_starts[parents]] = np.arange(len(flat))
+    return flat.take(pa.array(indices, mask=indices < 0))
+
+
+def explode_table(table: pa.Table, ref_col: str = "uids") -> pa.Table:
+    """Explodes the list columns of a table so that each list element is a separate row, like `utils.explode_data` but without
+    leaving Arrow. Rows where `ref_col` is null are removed. List columns which are only set on some events (e.g. the scores of
+    one task) are null on the others, and list columns whose lengths differ from `ref_col` are dropped.
+    """
+    list_cols = [f.name for f in table.schema if pa.types.is_list(f.type) or pa.types.is_large_list(f.type)]
+    if ref_col not in list_cols:
+        return table
+
+    table = table.filter(pc.is_valid(table[ref_col])).combine_chunks()
+    lengths = pc.list_value_length(table[ref_col]).to_numpy(zero_copy_only=False).astype("int64")
+    varying = []
+    for c in list_cols:
+        # null lists are not compared, they are filled with nulls when flattened
+        other = pc.list_value_length(table[c]).to_numpy(zero_copy_only=False)
+        valid = table[c].is_valid().to_numpy(zero_copy_only=False)
+        if (other[valid] != lengths[valid]).any():
+            varying.append(c)
+    if varying:
+        print(f"Dropping list columns {varying} whose lengths differ from {ref_col!r}")
+
+    parents = pc.list_parent_indices(table[ref_col])
+    columns = {}
+    for c in table.column_names:
+        if c in varying:
+            continue
+        values = pa.concat_arrays(table[c].chunks) if table[c].num_chunks else pa.array([], table[c].type)
+        columns[c] = _flatten_like(values, lengths) if c in list_cols else values.take(parents)
+    return pa.table(columns)
+
+
+def scan_run(
+    run_dir: str,
+    columns: List[str] = None,
+    tasks: Iterable[str] = None,
+    uids: Iterable[int] = None,
+    start: pd.Timestamp = None,
+    end: pd.Timestamp = None,
+    explode: bool = True,
+    limit: int = None,
+    required: Iterable[str] = (),
+) -> pd.DataFrame:
+    """Reads only the events and columns of a synced run history which match the filters.
+
+    Columns, task types and the time range are pushed down into the parquet scan, so row groups and columns which are not
+    needed are never read. UIDs are held in list columns, so they are filtered after exploding in Arrow. Completions are kept
+    as ids, so that the events of several runs can be combined before they are decoded by `finalize_events`.
+
+    Args:
+        run_dir (str): Directory of the run history.
+        columns (List[str], optional): Columns to read, columns which are missing in the run are skipped. Defaults to None (all columns).
+        tasks (Iterable[str], optional): Task types to keep, as stored in the history. Defaults to None (all tasks).
+        uids (Iterable[int], optional): UIDs to keep. Requires explode. Defaults to None (all UIDs).
+        start (pd.Timestamp, optional): Keep events at or after this time. Defaults to None.
+        end (pd.Timestamp, optional): Keep events before this time. Defaults to None.
+        explode (bool, optional): Explode list columns. Defaults to True.
+        limit (int, optional): Maximum number of events to read, before exploding. Defaults to None.
+        required (Iterable[str], optional): Columns which must not be null, e.g. to drop events without completions. Defaults to ().
+
+    Returns:
+        pd.DataFrame: Matching events, or None if the run has no synced history.
+    """
+    if uids is not None and not explode:
+        raise ValueError("uids can only be filtered when list columns are exploded")
+
+    dataset = history_dataset(run_dir)
+    if dataset is None:
+        return None
+
+    names = dataset.schema.names
+    # uids are needed to explode and filter even if they are not requested
+    cols = names if columns is None else [c for c in dict.fromkeys([*columns, *(["uids"] if explode else [])]) if c in names]
+    expr = _filter_expression(dataset.schema, tasks, start, end, required)
+    table = dataset.head(limit, columns=cols, filter=expr) if limit else dataset.to_table(columns=cols, filter=expr)
+
+    if explode:
+        table = explode_table(table)
+        if uids is not None and "uids" in table.column_names:
+            table = table.filter(pc.is_in(table["uids"], value_set=pa.array(list(uids), type=table.schema.field("uids").type)))
+        if columns is not None and "uids" not in columns:
+            table = table.select([c for c in table.column_names if c != "uids"])
+
+    df = table.to_pandas()
+    if "_timestamp" in df.columns:
+        df["_timestamp"] = pd.to_datetime(df["_timestamp"], unit="s")
+    return df
+
+
+def finalize_events(frames: Dict[str, pd.DataFrame], explode: bool = True, completions_path: str = COMPLETIONS_PATH) -> pd.DataFrame:
+    """Combines the events of several runs from `scan_run` into one frame with a `run_id` column and decodes their completions.
+
+    Exploded completions become categoricals of the completion dictionary, and unexploded completions lists of texts.
+    """
+    frames = {run_id: df for run_id, df in frames.items() if df is not None}
+    if not frames:
+        return pd.DataFrame(columns=["run_id"])
+
+    # runs can have different schemas, so they are only combined once converted
+    df = pd.concat([df.assign(run_id=run_id) for run_id, df in frames.items()], ignore_index=True)
+    df["run_id"] = df["run_id"].astype("category")
+    if explode:
+        return decode_completions(df, completions_path)
+
+    # unexploded completions are lists of ids, and only the texts of the ids which are used are looked up for display
+    for c in df.columns:
+        values = df[c].dropna()
+        if not COMPLETION_COLS.search(c) or values.empty or not is_list_like(values.iloc[0]) or np.asarray(values.iloc[0]).dtype.kind != "i":
+            continue
+        ids = np.unique(np.concatenate([np.asarray(v, dtype="int64") for v in values]))
+        texts = pd.Series(completion_texts(ids, completions_path), index=ids)
+        df[c] = df[c].map(lambda v: texts.reindex(np.asarray(v, dtype="int64")).tolist(), na_action="ignore")
+    return df
+
+
+def scan_events(run_dirs: Dict[str, str], explode: bool = True, completions_path: str = COMPLETIONS_PATH, **filters) -> pd.DataFrame:
+    """Reads the matching events of several run histories, see `scan_run` for the filters.
+
+    Args:
+        run_dirs (Dict[str, str]): Directories of the run histories, by run id.
+        explode (bool, optional): Explode list columns. Defaults to True.
+        completions_path (str, optional): Path of the completion dictionary. Defaults to COMPLETIONS_PATH.
+
+    Returns:
+        pd.DataFrame: Matching events, with a `run_id` column.
+    """
+    frames = {run_id: scan_run(run_dir, explode=explode, **filters) for run_id, run_dir in run_dirs.items()}
+    return finalize_events(frames, explode=explode, completions_path=completions_path)
+
+
+class CompletionIndex:
+    """Inverted index from completion id to the events of a run which used it.
+
+    Postings are the exploded events sorted by completion id, and the postings of `ids[i]` are the rows
+    `offsets[i]:offsets[i+1]` (CSR layout). Looking up k completions is a binary search over the distinct ids, so it does
+    not depend on the number of events, and the number of uses of every completion is read from the offsets.
+    Ids are those of the completion dictionary, so the indexes of different runs can be combined.
+
+    Args:
+        events (pd.DataFrame): Exploded events from `scan_run`, with completion ids and the columns to keep in the postings. Runs
+            without synced events (None) or without completions have an empty index.
+        col (str, optional): Completion column. Defaults to 'completions'.
+        completions_path (str, optional): Path of the completion dictionary, used if completions are stored as text. Defaults to COMPLETIONS_PATH.
+    """
+
+    def __init__(self, events: pd.DataFrame, col: str = "completions", completions_path: str = COMPLETIONS_PATH):
+        if events is None or col not in events.columns:
+            events = pd.DataFrame({col: pd.Series(dtype="int64")})
+        values = events[col]
+        ids = values.fillna(-1).to_numpy(dtype="int64") if is_numeric_dtype(values) else intern_completions(values, completions_path).astype("int64")
+        valid = np.flatnonzero(ids >= 0)
+        order = valid[np.argsort(ids[valid], kind="stable")]
+
+        self.ids, starts = np.unique(ids[order], return_index=True)
+        self.offsets = np.append(starts, len(order))
+        self.postings = events.drop(columns=col).iloc[order].reset_index(drop=True)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.postings.memory_usage(deep=True).sum()) + self.ids.nbytes + self.offsets.nbytes
+
+    def counts(self) -> pd.Series:
+        """Number of uses of each completion id."""
+        return pd.Series(np.diff(self.offsets), index=self.ids)
+
+    def lookup(self, ids: Iterable[int]) -> pd.DataFrame:
+        """Postings of the given completion ids, with a `completions` column holding the id. Unknown ids are skipped."""
+        ids = np.asarray(ids, dtype="int64")
+        pos = np.searchsorted(self.ids, ids)
+        found = pos < len(self.ids)
+        found[found] = self.ids[pos[found]] == ids[found]
+        pos, ids = pos[found], ids[found]
+
+        lengths = self.offsets[pos + 1] - self.offsets[pos]
+        # rows of consecutive ranges, without a python loop over the ids
+        rows = np.repeat(self.offsets[pos] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return self.postings.iloc[rows].assign(completions=np.repeat(ids, lengths)).reset_index(drop=True)
+
+
+def completion_counts(indexes: Dict[str, CompletionIndex], completions_path: str = COMPLETIONS_PATH) -> pd.Series:
+    """Number of uses of each completion in several indexes, indexed by completion text and sorted by count."""
+    counts = pd.concat([index.counts() for index in indexes.values()]) if indexes else pd.Series(dtype="int64")
+    counts = counts.groupby(level=0).sum().sort_values(ascending=False, kind="stable")
+    counts.index = completion_texts(counts.index.values, completions_path)
+    return counts
+
+
+def lookup_completions(indexes: Dict[str, CompletionIndex], completions: Iterable[str] = None, regex: str = None, completions_path: str = COMPLETIONS_PATH) -> pd.DataFrame:
+    """Postings of completions in several indexes, with a `run_id` column and completions as text.
+
+    Completions are selected by their text, which is looked up by its hash, or by a regex which is matched against the
+    distinct completions of the indexes in a scan of the completion dictionary rather than against every event.
+    """
+    if regex:
+        ids = np.concatenate([index.ids for index in indexes.values()]) if indexes else np.array([], dtype="int64")
+        ids = match_completions(ids, regex, completions_path)
+    else:
+        ids = completion_ids(list(completions or []), completions_path)
+        ids = ids[ids >= 0]
+
+    frames = [index.lookup(ids).assign(run_id=run_id) for run_id, index in indexes.items()]
+    if not frames:
+        return pd.DataFrame(columns=["completions", "run_id"])
+    df = pd.concat(frames, ignore_index=True)
+    df["completions"] = pd.Categorical(completion_texts(df["completions"].values, completions_path))
+    df["run_id"] = df["run_id"].astype("category")
+    return df
+
+
+class FrameCache:
+    """Least recently used cache of frames (or completion indexes), which evicts the oldest once their total memory exceeds a budget.
+
+    Cached frames are shared, so they must not be modified by the caller.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.frames = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.frames:
+                return None
+            self.frames.move_to_end(key)
+            return self.frames[key][0]
+
+    def put(self, key, frame: pd.DataFrame):
+        if frame is None:
+            size = 0
+        elif isinstance(frame, pd.DataFrame):
+            size = int(frame.memory_usage(deep=True).sum())
+        else:
+            size = frame.nbytes
+        with self.lock:
+            if key in self.frames:
+                self.nbytes -= self.frames.pop(key)[1]
+            if size > self.max_bytes:
+                print(f"Not caching frame of {size/2**20:.0f} MB, which exceeds the budget of {self.max_bytes/2**20:.0f} MB")
+                return
+            self.frames[key] = (frame, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self.frames.popitem(last=False)
+                self.nbytes -= evicted
+
+
+def distinct_values(run_dirs: Dict[str, str], column: str) -> List:
+    """Returns the distinct values of a column across run histories, reading only that column."""
+    values = set()
+    for run_dir in run_dirs.values():
+        dataset = history_dataset(run_dir)
+        if dataset is None or column not in dataset.schema.names:
+            continue
+        values.update(pc.unique(dataset.to_table(columns=[column])[column]).to_pylist())
+    return sorted(v for v in values if v is not None)
@@ -17,69 +17,31 @@
 
 import os
 import re
+import ast
+import glob
+import json
+import fcntl
+import hashlib
+import contextlib
 import tqdm
 import wandb
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 
 from traceback import format_exc
-from pandas.api.types import is_list_like
+from pandas.api.types import is_list_like, is_bool_dtype, is_numeric_dtype, is_string_dtype
 
-from typing import List, Dict, Any, Union
-
-
-def pull_wandb_runs(project='openvalidators', filters=None, min_steps=50, ntop=10, summary_filters=None ):
-    all_runs = get_runs(project, filters)
-    print(f'Using {ntop}/{len(all_runs)} runs with more than {min_steps} events')
-    pbar = tqdm.tqdm(all_runs)
-    runs = []
-    n_events = 0
-    successful = 0
-    for i, run in enumerate(pbar):
-
-        summary = run.summary
-        if summary_filters is not None and not summary_filters(summary):
-            continue
-        step = summary.get('_step',0)
-        if step < min_steps:
-            # warnings.warn(f'Skipped run `{run.name}` because it contains {step} events (<{min_steps})')
-            continue
-
-        prog_msg = f'Loading data {i/len(all_runs)*100:.0f}% ({successful}/{len(all_runs)} runs, {n_events} events)'
-        pbar.set_description(f'{prog_msg}... **fetching** `{run.name}`')
-
-        duration = summary.get('_runtime')
-        end_time = summary.get('_timestamp')
-        # extract values for selected tags
-        rules = {'hotkey': re.compile('^[0-9a-z]{48}$',re.IGNORECASE), 'version': re.compile('^\\d\.\\d+\.\\d+$'), 'spec_version': re.compile('\\d{4}$')}
-        tags = {k: tag for k, rule in rules.items() for tag in run.tags if rule.match(tag)}
-        # include bool flag for remaining tags
-        tags.update({k: True for k in run.tags if k not in tags.keys() and k not in tags.values()})
-
-        runs.append({
-            'state': run.state,
-            'num_steps': step,
-            'num_completions': step*sum(len(v) for k, v in run.summary.items() if k.endswith('completions') and isinstance(v, list)),
-            'entity': run.entity,
-            'user': run.user.name,
-            'username': run.user.username,
-            'run_id': run.id,
-            'run_name': run.name,
-            'project': run.project,
-            'run_url': run.url,
-            'run_path': os.path.join(run.entity, run.project, run.id),
-            'start_time': pd.to_datetime(end_time-duration, unit="s"),
-            'end_time': pd.to_datetime(end_time, unit="s"),
-            'duration': pd.to_timedelta(duration, unit="s").round('s'),
-            **tags
-        })
-        n_events += step
-        successful += 1
-        if successful >= ntop:
-            break
-
-    cat_cols = ['state', 'hotkey', 'version', 'spec_version']
-    return pd.DataFrame(runs).astype({k: 'category' for k in cat_cols if k in runs[0]})
+from typing import List, Dict, Any, Union, Iterable, Callable
 
+# columns which are always integer valued, all other numeric columns are stored as floats
+INT_COLS = ("_step", "uids")
+# completion columns are stored as int32 ids into the completion dictionary
+COMPLETION_COLS = re.compile("completions$")
+COMPLETIONS_PATH = "data/completions/"
 
 
 def get_runs(project: str = "openvalidators", filters: Dict[str, Any] = None, return_paths: bool = False, api_key: str = None) -> List:
@@ -140,18 +102,562 @@ def download_data(run_path: Union[str, List] = None, timeout: float = 600, api_k
     return df
 
 
+def completion_hashes(texts: Iterable[str]) -> np.ndarray:
+    """64 bit content hashes, which identify completions across runs and machines."""
+    return np.array([int.from_bytes(hashlib.blake2b(str(t).encode(), digest_size=8).digest(), "little", signed=True) for t in texts], dtype="int64")
+
+
+@contextlib.contextmanager
+def _dictionary_lock(path: str):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "dictionary.lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _dictionary_parts(path: str = COMPLETIONS_PATH) -> List[str]:
+    # parts are named by their first id, so sorting by it gives the ids in order
+    return sorted(glob.glob(os.path.join(path, "part-*.parquet")), key=lambda p: int(os.path.basename(p)[5:-8]))
+
+
+def read_completion_dictionary(path: str = COMPLETIONS_PATH) -> pd.DataFrame:
+    """Reads the completion dictionary, which holds the id, content hash and text of every completion seen so far.
+
+    Ids are assigned in order of first appearance and never change, so the text of id i is at row i. The dictionary is stored
+    as append-only parts named by their first id.
+    """
+    parts = _dictionary_parts(path)
+    if not parts:
+        return pd.DataFrame({"id": pd.Series(dtype="int32"), "hash": pd.Series(dtype="int64"), "text": pd.Series(dtype=object)})
+    return pd.concat([pd.read_parquet(p) for p in parts], ignore_index=True)
+
+
+_hash_indexes = {}
+
+
+def _hash_index(path: str = COMPLETIONS_PATH) -> Dict[int, int]:
+    """Map from content hash to id of every completion in the dictionary. Only the id and hash columns are read, once per part:
+    the index is kept between calls and extended with the parts which were added since it was last read.
+    """
+    parts = _dictionary_parts(path)
+    cached_parts, index = _hash_indexes.get(path, ([], None))
+    if index is None or parts[:len(cached_parts)] != cached_parts:
+        cached_parts, index = [], {}
+
+    for part in parts[len(cached_parts):]:
+        table = pq.read_table(part, columns=["id", "hash"])
+        index.update(zip(table["hash"].to_numpy().tolist(), table["id"].to_numpy().tolist()))
+    _hash_indexes[path] = (parts, index)
+    return index
+
+
+def completion_texts(ids: Iterable[int], path: str = COMPLETIONS_PATH) -> np.ndarray:
+    """Texts of completion ids, in the same order. Only the dictionary parts whose id range holds one of the ids are opened, and
+    only the rows of those ids are read from them.
+    """
+    ids = np.asarray(ids, dtype="int64")
+    uniques, inverse = np.unique(ids, return_inverse=True)
+    texts = np.full(len(uniques), None, dtype=object)
+    parts = _dictionary_parts(path)
+    if not parts or not len(uniques):
+        return texts[inverse].reshape(ids.shape)
+
+    firsts = np.array([int(os.path.basename(p)[5:-8]) for p in parts])
+    which = np.searchsorted(firsts, uniques, side="right") - 1
+    for i in np.unique(which[which >= 0]):
+        selected = which == i
+        table = pq.read_table(parts[i], columns=["id", "text"], filters=[("id", "in", uniques[selected].tolist())])
+        found = pd.Series(table["text"].to_numpy(zero_copy_only=False), index=table["id"].to_numpy())
+        texts[selected] = found.reindex(uniques[selected]).values
+    return texts[inverse].reshape(ids.shape)
+
+
+def completion_ids(texts: Iterable[str], path: str = COMPLETIONS_PATH) -> np.ndarray:
+    """Ids of completion texts, or -1 for texts which are not in the dictionary. Texts are looked up by their hash, without
+    reading any texts of the dictionary.
+    """
+    index = _hash_index(path)
+    return np.array([index.get(h, -1) for h in completion_hashes(texts).tolist()], dtype="int64")
+
+
+def match_completions(ids: Iterable[int], regex: str, path: str = COMPLETIONS_PATH) -> np.ndarray:
+    """Ids among the given ones whose text matches a regex. The regex is matched in a scan of the dictionary parts which hold the
+    ids, so the texts are never loaded all at once.
+    """
+    ids = np.unique(np.asarray(ids, dtype="int64"))
+    parts = _dictionary_parts(path)
+    if not parts or not len(ids):
+        return np.array([], dtype="int64")
+
+    dataset = ds.dataset(parts, format="parquet")
+    expr = ds.field("id").isin(ids.tolist()) & pc.match_substring_regex(ds.field("text"), pattern=regex)
+    return np.sort(dataset.to_table(columns=["id"], filter=expr)["id"].to_numpy().astype("int64"))
+
+
+def intern_completions(values: Iterable[str], path: str = COMPLETIONS_PATH) -> np.ndarray:
+    """Maps completion texts to their int32 ids in the completion dictionary, adding texts which are not in it yet.
+
+    Missing values are mapped to -1. Only the unique texts are hashed and looked up in the hash index of the dictionary, and the
+    dictionary is locked while new texts are added.
+    """
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    hashes = completion_hashes(uniques)
+
+    with _dictionary_lock(path):
+        index = _hash_index(path)
+        ids = np.array([index.get(h, -1) for h in hashes.tolist()], dtype="int64")
+        new = ids < 0
+        if new.any():
+            # new texts can repeat a hash only if they are equal, and factorize already removed those
+            first = len(index)
+            ids[new] = np.arange(first, first + new.sum())
+            added = pd.DataFrame({"id": ids[new].astype("int32"), "hash": hashes[new], "text": np.asarray(uniques, dtype=object)[new]})
+            part = os.path.join(path, f"part-{first}.parquet")
+            added.to_parquet(f"{part}.tmp", index=False)
+            os.replace(f"{part}.tmp", part)
+            # the part which was just written is added to the index without reading it back
+            index.update(zip(hashes[new].tolist(), ids[new].tolist()))
+            _hash_indexes[path] = (_hash_indexes[path][0] + [part], index)
+
+    ids = ids.astype("int32")
+    return np.where(codes >= 0, ids[codes], -1).astype("int32") if len(codes) else np.array([], dtype="int32")
+
+
+def _intern_column(series: pd.Series, path: str = COMPLETIONS_PATH) -> pd.Series:
+    # completion columns still hold lists when histories are not exploded, and are missing in events without completions
+    is_list = series.apply(is_list_like).values
+    if not is_list.any():
+        return pd.Series(intern_completions(series, path), index=series.index)
+
+    lists = series[is_list]
+    ids = intern_completions([v for values in lists for v in values], path)
+    parts = iter(np.split(ids, np.cumsum(lists.apply(len).values)[:-1]))
+    return pd.Series([next(parts) if l else None for l in is_list], index=series.index)
+
+
+def decode_completions(df: pd.DataFrame, path: str = COMPLETIONS_PATH) -> pd.DataFrame:
+    """Converts completion columns to categoricals of their completion texts, so that groupby, value_counts, nunique and isin
+    work on integer codes and the text is only looked up for display. Categories keep the order of the completion ids.
+
+    Only the texts of the ids in a column are looked up. Columns of histories which were stored before completions were
+    interned hold texts, which are interned first.
+    """
+    for c in df.columns:
+        if not COMPLETION_COLS.search(c) or isinstance(df[c].dtype, pd.CategoricalDtype):
+            continue
+        ids = df[c].fillna(-1).values if is_numeric_dtype(df[c]) else intern_completions(df[c], path)
+        uniques, codes = np.unique(np.asarray(ids, dtype="int32"), return_inverse=True)
+        # missing completions are -1, which sorts first
+        if len(uniques) and uniques[0] < 0:
+            uniques, codes = uniques[1:], codes - 1
+        texts = completion_texts(uniques, path)
+        df[c] = pd.Categorical.from_codes(codes.reshape(-1), categories=texts)
+    return df
+
+
+def _conform_table(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    # columns which are missing are filled with nulls, the others are cast to the type they are stored as
+    columns = []
+    for field in schema:
+        if field.name not in table.column_names:
+            columns.append(pa.chunked_array([pa.nulls(table.num_rows, field.type)]))
+            continue
+        try:
+            columns.append(table[field.name].cast(field.type))
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+            raise ValueError(f"Column {field.name!r} of type {table.schema.field(field.name).type} cannot be stored as {field.type}") from e
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def _page_table(df: pd.DataFrame, schema: pa.Schema = None) -> pa.Table:
+    """Converts a page of history to an Arrow table with stable column types.
+
+    Numeric columns are stored as float64 (except the integer columns in `INT_COLS`) and empty columns as strings, so that later pages can be cast to the
+    schema of the first page. Columns which are missing in a page are filled with nulls, and columns which are new are added to the end of the schema.
+    """
+    df = df.copy()
+    for c in df.columns:
+        if df[c].dtype == "object":
+            try:
+                df[c] = pd.to_numeric(df[c])
+            except (ValueError, TypeError):
+                pass
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    fields = []
+    for field in table.schema:
+        # unexploded list columns keep their lists, with the same value types as when exploded
+        is_list = pa.types.is_list(field.type)
+        value_type = field.type.value_type if is_list else field.type
+        if field.name in INT_COLS or COMPLETION_COLS.search(field.name) and pa.types.is_integer(value_type):
+            value_type = pa.int64() if field.name in INT_COLS else pa.int32()
+            field = field.with_type(pa.list_(value_type) if is_list else value_type)
+        elif pa.types.is_null(field.type):
+            # empty columns which are already stored keep their type, nulls can be cast to any type
+            if schema is None or field.name not in schema.names:
+                field = field.with_type(pa.string())
+        elif is_numeric_dtype(df[field.name]) and not is_bool_dtype(df[field.name]):
+            field = field.with_type(pa.float64())
+        fields.append(field)
+    table = table.cast(pa.schema(fields))
+    if schema is None:
+        return table
+
+    new_fields = [field for field in table.schema if field.name not in schema.names]
+    if new_fields:
+        print(f"Adding columns {[field.name for field in new_fields]} to the schema")
+    return _conform_table(table, pa.schema(list(schema) + new_fields))
+
+
+def _widen_file(writer: pq.ParquetWriter, file_path: str, schema: pa.Schema) -> pq.ParquetWriter:
+    # a parquet file has one schema, so the pages written so far are copied one row group at a time to a file with the wider one
+    writer.close()
+    os.replace(file_path, f"{file_path}.narrow")
+    narrow = pq.ParquetFile(f"{file_path}.narrow")
+    writer = pq.ParquetWriter(file_path, schema)
+    for i in range(narrow.num_row_groups):
+        writer.write_table(_conform_table(narrow.read_row_group(i), schema))
+    os.remove(f"{file_path}.narrow")
+    return writer
+
+
+def _explode_page(df: pd.DataFrame, schema: pa.Schema = None) -> pd.DataFrame:
+    """Explodes the list columns of a page alongside `uids` (or the first list column).
+
+    Columns which are already stored are exploded if they are stored as scalars and kept as lists otherwise, so the column types do not
+    depend on the events in a page. New columns are exploded if they have the same length as `uids` in every event. Events where a column
+    which is exploded is missing, or has a different length than `uids`, get a list of nulls.
+    """
+    is_list = {c: df[c].apply(is_list_like) for c in df.columns}
+    list_cols = [c for c, mask in is_list.items() if mask.any() and (mask | df[c].isna()).all()]
+    if schema is not None:
+        list_cols = [c for c in list_cols if c not in schema.names or not pa.types.is_list(schema.field(c).type)]
+    if not list_cols:
+        return df
+
+    lengths = {c: df[c].apply(lambda v: len(v) if is_list_like(v) else -1) for c in list_cols}
+    ref = "uids" if "uids" in list_cols else list_cols[0]
+    explode_cols = []
+    for c in list_cols:
+        valid = lengths[c] >= 0
+        if schema is not None and c in schema.names or (lengths[c][valid] == lengths[ref][valid]).all():
+            explode_cols.append(c)
+        else:
+            print(f"Column {c!r} is kept as lists, its lengths differ from {ref!r}")
+
+    # events without the reference column take the length of their first exploded list
+    ref_lengths = lengths[ref].copy()
+    for c in explode_cols:
+        ref_lengths = ref_lengths.where(ref_lengths >= 0, lengths[c])
+
+    df = df.copy()
+    for c in explode_cols:
+        mismatch = (lengths[c] != ref_lengths) & (ref_lengths >= 0)
+        if (mismatch & is_list[c]).any():
+            print(f"Column {c!r} is set to nulls in {(mismatch & is_list[c]).sum()} events, its lengths differ from {ref!r}")
+        if mismatch.any():
+            df[c] = [[None] * n if m else v for v, n, m in zip(df[c], ref_lengths, mismatch)]
+    return df.explode(column=explode_cols)
+
+
+def _is_text(type: pa.DataType) -> bool:
+    if pa.types.is_list(type) or pa.types.is_large_list(type):
+        type = type.value_type
+    return pa.types.is_string(type) or pa.types.is_large_string(type)
+
+
+def write_part(df: pd.DataFrame, file_path: str, completions_path: str = COMPLETIONS_PATH) -> pa.Schema:
+    """Writes a dataframe of history as one parquet part, with completions interned and the column types of `_page_table`.
+
+    The part is written to a temporary file first, so it can replace the file it was read from. Returns the schema of the part.
+    """
+    df = df.copy()
+    for c in df.columns:
+        if COMPLETION_COLS.search(c) and _is_text(pa.array(df[c], from_pandas=True).type):
+            df[c] = _intern_column(df[c], completions_path)
+    table = _page_table(df)
+    pq.write_table(table, f"{file_path}.tmp")
+    os.replace(f"{file_path}.tmp", file_path)
+    return table.schema
+
+
+def write_history(events: Iterable[Dict], file_path: str, page_size: int = 1000, explode: bool = True, transform: Callable = None, schema: pa.Schema = None, completions_path: str = COMPLETIONS_PATH) -> int:
+    """Writes history events to a parquet file one page at a time, so memory is bounded by the page size rather than the run length.
+
+    Args:
+        events (Iterable[Dict]): History events, e.g. from `run.scan_history()` or a recorded history.
+        file_path (str): Path of the parquet file.
+        page_size (int, optional): Number of events in each page. Defaults to 1000.
+        explode (bool, optional): Explode list columns of each page. Defaults to True.
+        transform (Callable, optional): Function applied to the dataframe of each page before it is exploded. Defaults to None.
+        schema (pa.Schema, optional): Schema to cast pages to, e.g. of the earlier parts of the same history. Defaults to the schema of the first page.
+            Columns which are not in it are added to the schema of the file.
+        completions_path (str, optional): Completion dictionary which completion columns are interned into. If None, completions are stored as text.
+
+    Returns:
+        int: Number of rows written.
+    """
+    writer = None
+    n_rows = 0
+    page = []
+
+    def flush(page):
+        nonlocal writer, n_rows
+        df = pd.DataFrame(page)
+        if transform is not None:
+            df = transform(df)
+        if explode:
+            df = _explode_page(df, writer.schema if writer is not None else schema)
+        if df.empty:
+            return
+        if completions_path is not None:
+            for c in df.columns:
+                if COMPLETION_COLS.search(c):
+                    df[c] = _intern_column(df[c], completions_path)
+
+        table = _page_table(df, writer.schema if writer is not None else schema)
+        if writer is None:
+            writer = pq.ParquetWriter(file_path, table.schema)
+        elif table.schema != writer.schema:
+            writer = _widen_file(writer, file_path, table.schema)
+        writer.write_table(table)
+        n_rows += table.num_rows
+
+    try:
+        for event in events:
+            page.append(event)
+            if len(page) >= page_size:
+                flush(page)
+                page = []
+        if page:
+            flush(page)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return n_rows
+
+
+def download_history(run_path: str, file_path: str, page_size: int = 1000, explode: bool = True, transform: Callable = None, timeout: float = 600, api_key: str = None) -> int:
+    """Streams the history of a run from wandb to a parquet file. See `write_history`.
+
+    Args:
+        run_path (str): Path to run.
+        file_path (str): Path of the parquet file.
+        page_size (int, optional): Number of events fetched and written at a time. Defaults to 1000.
+        explode (bool, optional): Explode list columns. Defaults to True.
+        transform (Callable, optional): Function applied to the dataframe of each page before it is exploded. Defaults to None.
+        timeout (float, optional): Timeout for wandb api. Defaults to 600.
+
+    Returns:
+        int: Number of rows written.
+    """
+    api = wandb.Api(api_key=api_key, timeout=timeout)
+    wandb.login(anonymous="allow")
+
+    run = api.run(run_path)
+    return write_history(run.scan_history(page_size=page_size), file_path, page_size=page_size, explode=explode, transform=transform)
+
+
+def read_sync_state(run_dir: str) -> Dict:
+    """Reads the sync checkpoint of a run history, which holds the last synced `_step` and the parts of the history."""
+    path = os.path.join(run_dir, "sync.json")
+    if not os.path.exists(path):
+        return {"last_step": -1, "parts": []}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def read_history_schema(run_dir: str) -> pa.Schema:
+    """Schema of a synced run history, with the columns of all of its parts. Returns None if nothing was synced yet."""
+    schemas = [pq.read_schema(os.path.join(run_dir, part)).remove_metadata() for part in read_sync_state(run_dir)["parts"]]
+    return pa.unify_schemas(schemas) if schemas else None
+
+
+def write_sync_state(state: Dict, run_dir: str):
+    path = os.path.join(run_dir, "sync.json")
+    os.makedirs(run_dir, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def append_history(events: Iterable[Dict], run_dir: str, page_size: int = 1000, explode: bool = True, transform: Callable = None) -> Dict:
+    """Appends the events after the sync checkpoint of a run history as a new part, and advances the checkpoint.
+
+    The checkpoint is only written once the part is complete, so an interrupted sync is simply repeated.
+
+    Args:
+        events (Iterable[Dict]): History events in step order, e.g. from `run.scan_history()` or a recorded history.
+        run_dir (str): Directory of the run history.
+        page_size (int, optional): Number of events in each page. Defaults to 1000.
+        explode (bool, optional): Explode list columns. Defaults to True.
+        transform (Callable, optional): Function applied to the dataframe of each page before it is exploded. Defaults to None.
+
+    Returns:
+        Dict: Number of new rows, and the first step and first timestamp of the new events (None if there were none).
+    """
+    state = read_sync_state(run_dir)
+    os.makedirs(run_dir, exist_ok=True)
+    last_step = state["last_step"]
+    first_step = first_timestamp = None
+
+    def new_events():
+        nonlocal last_step, first_step, first_timestamp
+        for event in events:
+            step = event.get("_step")
+            if step is not None and step <= state["last_step"]:
+                continue
+            if first_step is None:
+                first_step, first_timestamp = step, event.get("_timestamp")
+            if step is not None:
+                last_step = max(last_step, step)
+            yield event
+
+    if state["parts"]:
+        # caches imported before completions were interned hold texts, which later ids would be cast to
+        first_part = os.path.join(run_dir, state["parts"][0])
+        if any(COMPLETION_COLS.search(f.name) and _is_text(f.type) for f in pq.read_schema(first_part)):
+            write_part(pd.read_parquet(first_part), first_part)
+    # new parts are cast to the types of the earlier ones, so that all parts can be read together
+    schema = read_history_schema(run_dir)
+    tmp_path = os.path.join(run_dir, "part.parquet.tmp")
+    n_rows = write_history(new_events(), tmp_path, page_size=page_size, explode=explode, transform=transform, schema=schema)
+    if n_rows:
+        part = f"part-{first_step}-{last_step}.parquet"
+        os.replace(tmp_path, os.path.join(run_dir, part))
+        state["parts"].append(part)
+
+    state["last_step"] = last_step
+    write_sync_state(state, run_dir)
+    return {"rows": n_rows, "first_step": first_step, "first_timestamp": first_timestamp}
+
+
+def sync_history(run_path: str, run_dir: str, page_size: int = 1000, explode: bool = True, transform: Callable = None, timeout: float = 600, api_key: str = None) -> Dict:
+    """Downloads only the events of a run which come after its sync checkpoint. See `append_history`.
+
+    Args:
+        run_path (str): Path to run.
+        run_dir (str): Directory of the run history.
+        page_size (int, optional): Number of events fetched and written at a time. Defaults to 1000.
+        explode (bool, optional): Explode list columns. Defaults to True.
+        transform (Callable, optional): Function applied to the dataframe of each page before it is exploded. Defaults to None.
+        timeout (float, optional): Timeout for wandb api. Defaults to 600.
+
+    Returns:
+        Dict: Number of new rows, and the first step and first timestamp of the new events.
+    """
+    api = wandb.Api(api_key=api_key, timeout=timeout)
+    wandb.login(anonymous="allow")
+
+    run = api.run(run_path)
+    min_step = read_sync_state(run_dir)["last_step"] + 1
+    events = run.scan_history(page_size=page_size, min_step=min_step)
+    return append_history(events, run_dir, page_size=page_size, explode=explode, transform=transform)
+
+
+def parse_list_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Converts columns which hold string representations of lists (as in old CSV caches) to lists.
+
+    Values are parsed with `ast.literal_eval`, and columns which cannot be parsed are left as strings.
+    """
+    for c in df.columns:
+        values = df[c].dropna()
+        if values.empty or not is_string_dtype(values) or not values.str.startswith("[").all():
+            continue
+        try:
+            df[c] = df[c].map(ast.literal_eval, na_action="ignore")
+        except (ValueError, SyntaxError) as e:
+            print(f"Could not convert column {c!r} to lists, it is kept as strings: {e}")
+    return df
+
+
+def import_history(path: str, run_dir: str):
+    """Converts a history cache which was saved in one piece (CSV or parquet) into the first part of a synced run history.
+
+    List columns are stored as native Arrow lists and completions are interned like synced parts, so the cache is read without
+    any parsing afterwards and later parts share its schema. The old file is removed.
+    """
+    df = pd.read_csv(path) if path.endswith(".csv") else pd.read_parquet(path)
+    df = parse_list_columns(df)
+    # histories are stored with unix timestamps, but CSV caches were saved after converting them to datetimes
+    if not is_numeric_dtype(df["_timestamp"]):
+        df["_timestamp"] = (pd.to_datetime(df["_timestamp"]) - pd.Timestamp(0)).dt.total_seconds()
+
+    last_step = int(df["_step"].max())
+    os.makedirs(run_dir, exist_ok=True)
+    part = f"part-0-{last_step}.parquet"
+    write_part(df, os.path.join(run_dir, part))
+    write_sync_state({"last_step": last_step, "parts": [part]}, run_dir)
+    os.remove(path)
+
+
+def migrate_history_caches(datadir: str = "data/"):
+    """One-time migration of the history caches of the dashboard (`{datadir}/history-{run_id}.csv`) and of multistats
+    (`{datadir}/runs/history-{run_id}.parquet`) to synced run histories.
+
+    Args:
+        datadir (str, optional): Data directory. Defaults to 'data/'.
+
+    Returns:
+        int: Number of migrated caches.
+    """
+    caches = {path: os.path.join(datadir, "history") for path in glob.glob(os.path.join(datadir, "history-*.csv"))}
+    caches.update({path: os.path.join(datadir, "runs") for path in glob.glob(os.path.join(datadir, "runs", "history-*.parquet"))})
+
+    for path, history_dir in tqdm.tqdm(caches.items(), desc="Migrating history caches", unit="run"):
+        run_id = os.path.basename(path).split(".")[0][len("history-"):]
+        run_dir = os.path.join(history_dir, run_id)
+        if read_sync_state(run_dir)["parts"]:
+            print(f"Skipping {path!r} because {run_dir!r} already holds a synced history")
+            continue
+        import_history(path, run_dir)
+
+    return len(caches)
+
+
+def read_history(run_dir: str, columns: List[str] = None, min_timestamp: float = None) -> pd.DataFrame:
+    """Reads the synced history of a run, optionally only the events at or after min_timestamp (in seconds)."""
+    parts = read_sync_state(run_dir)["parts"]
+    filters = [("_timestamp", ">=", min_timestamp)] if min_timestamp is not None else None
+    frames = [pd.read_parquet(os.path.join(run_dir, part), columns=columns, filters=filters) for part in parts]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)
+
+
+def iter_history(run_dir: str, columns: List[str] = None, min_timestamp: float = None) -> Iterable[pd.DataFrame]:
+    """Reads the synced history of a run one parquet row group at a time, in step order, so memory is bounded by the row group size.
+
+    Row groups which end before min_timestamp (in seconds) are skipped using their statistics.
+    """
+    for part in read_sync_state(run_dir)["parts"]:
+        pf = pq.ParquetFile(os.path.join(run_dir, part))
+        ts_index = pf.schema_arrow.get_field_index("_timestamp")
+        for i in range(pf.num_row_groups):
+            stats = pf.metadata.row_group(i).column(ts_index).statistics if ts_index >= 0 else None
+            if min_timestamp is not None and stats is not None and stats.has_min_max and stats.max < min_timestamp:
+                continue
+            df = pf.read_row_group(i, columns=columns).to_pandas()
+            if min_timestamp is not None:
+                df = df.loc[df["_timestamp"] >= min_timestamp]
+            if not df.empty:
+                yield df
+
+
 def read_data(path: str, nrows: int = None):
     """Load data from csv."""
     df = pd.read_csv(path, nrows=nrows)
     # filter out events with missing step length
     df = df.loc[df.step_length.notna()]
 
-    # detect list columns which as stored as strings
-    list_cols = [c for c in df.columns if df[c].dtype == "object" and df[c].str.startswith("[").all()]
     # convert string representation of list to list
-    df[list_cols] = df[list_cols].applymap(eval, na_action='ignore')
-
-    return df
+    return parse_list_columns(df)
 
 def load_data(selected_runs, load=True, save=False, explode=True, datadir='data/'):
 
@@ -167,13 +673,33 @@ def load_data(selected_runs, load=True, save=False, explode=True, datadir='data/
         prog_msg = f'Loading data {i/len(selected_runs)*100:.0f}% ({successful}/{len(selected_runs)} runs, {n_events} events)'
 
         file_path = os.path.join(datadir,f'history-{run.run_id}.csv')
+        run_dir = os.path.join(datadir, 'history', run.run_id)
 
-        if (load is True and os.path.exists(file_path)) or (callable(load) and load(run.to_dict())):
-            pbar.set_description(f'{prog_msg}... **reading** `{file_path}`')
+        if os.path.exists(file_path):
+            # old CSV caches are converted once to a synced history with native list columns
+            import_history(file_path, run_dir)
+
+        # running runs are synced before they are read when saving is enabled
+        synced = read_sync_state(run_dir)['parts'] and not (run.state == 'running' and (save is True or (callable(save) and save(run.to_dict()))))
+        if (load is True or (callable(load) and load(run.to_dict()))) and synced:
+            pbar.set_description(f'{prog_msg}... **reading** `{run_dir}`')
+            try:
+                df = read_history(run_dir).assign(**run.to_dict())
+                df['_timestamp'] = pd.to_datetime(df['_timestamp'], unit='s')
+            except Exception as e:
+                print(f'Failed to load history from `{run_dir}`: {format_exc(e)}')
+                continue
+        elif save is True or (callable(save) and save(run.to_dict())):
             try:
-                df = read_data(file_path)
+                # only events after the last synced step are downloaded
+                pbar.set_description(f'{prog_msg}... **syncing** `{run.run_path}`')
+                result = sync_history(run.run_path, run_dir, explode=explode)
+                print(f'Synced {result["rows"]} new events from `{run.run_path}` to `{run_dir}`')
+
+                df = read_history(run_dir).assign(**run.to_dict())
+                df['_timestamp'] = pd.to_datetime(df['_timestamp'], unit='s')
             except Exception as e:
-                print(f'Failed to load history from `{file_path}`: {format_exc(e)}')
+                print(f'Failed to sync history for `{run.run_path}`: {e}')
                 continue
         else:
             pbar.set_description(f'{prog_msg}... **downloading** `{run.run_path}`')
@@ -185,10 +711,6 @@ def load_data(selected_runs, load=True, save=False, explode=True, datadir='data/
 
                 print(f'Downloaded {df.shape[0]} events from `{run.run_path}`. Columns: {df.columns}')
 
-                if save is True or (callable(save) and save(run.to_dict())):
-                    df.to_csv(file_path, index=False)
-                    print(f'Saved {df.shape[0]} events to `{file_path}`')
-
             except Exception as e:
                 print(f'Failed to download history for `{run.run_path}`: {e}')
                 continue
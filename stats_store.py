@@ -0,0 +1,168 @@
+import os
+import glob
+import pandas as pd
+from pandas.tseries.frequencies import to_offset
+
+import opendashboards.utils.utils as utils
+import opendashboards.utils.aggregate as aggregate
+
+
+ROOT_DIR = './data/stats/'
+# time buckets of each tier, from finest to coarsest. Each tier is built by merging the partial aggregates of the tier below
+TIERS = {'minute': 'min', 'hour': 'h', 'day': 'D'}
+# how long buckets of each tier are kept, relative to the time of the update. None keeps them forever
+RETENTION = {'minute': pd.Timedelta('2D'), 'hour': pd.Timedelta('90D'), 'day': None}
+
+
+def _duration(freq):
+    # length of a frequency alias such as '6h' or 'D'
+    return pd.Timestamp(0) + to_offset(freq) - pd.Timestamp(0)
+
+
+def tier_path(tier, run_id, root_dir=ROOT_DIR):
+    return os.path.join(root_dir, tier, f'{run_id}.parquet')
+
+
+def read_tier(tier, run_ids=None, start=None, end=None, root_dir=ROOT_DIR):
+    """Reads the partial aggregates of a tier, optionally restricted to runs and to buckets in [start, end)."""
+    if run_ids is None:
+        paths = sorted(glob.glob(os.path.join(root_dir, tier, '*.parquet')))
+    else:
+        paths = [tier_path(tier, run_id, root_dir) for run_id in run_ids if os.path.exists(tier_path(tier, run_id, root_dir))]
+
+    filters = []
+    if start is not None:
+        filters.append(('_timestamp', '>=', pd.Timestamp(start)))
+    if end is not None:
+        filters.append(('_timestamp', '<', pd.Timestamp(end)))
+    frames = [pd.read_parquet(path, filters=filters or None) for path in paths]
+    if not frames:
+        return pd.DataFrame(columns=['_timestamp', 'run_id'])
+    return pd.concat(frames, ignore_index=True)
+
+
+def _write_tier(df, tier, run_id, root_dir=ROOT_DIR):
+    path = tier_path(tier, run_id, root_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df.to_parquet(f'{path}.tmp', index=False, compression='zstd')
+    os.replace(f'{path}.tmp', path)
+
+
+def resume_timestamp(run_id, root_dir=ROOT_DIR):
+    """Start of the last bucket of the coarsest tier of a run, or None if the run has no rollups yet.
+
+    Events from this time on are needed to update the run, since every tier recomputes its buckets from it.
+    """
+    tier = list(TIERS)[-1]
+    path = tier_path(tier, run_id, root_dir)
+    if not os.path.exists(path):
+        return None
+    timestamps = pd.read_parquet(path, columns=['_timestamp'])['_timestamp']
+    return timestamps.max() if len(timestamps) else None
+
+
+def update_run(partials, run_id, since=None, now=None, root_dir=ROOT_DIR):
+    """Merges the minute partials of a run into all tiers and applies the retention of each tier.
+
+    partials must hold every minute bucket of the run from since on (all of them if since is None), which replace the stored
+    buckets from since on. Coarser tiers are rebuilt from since on by merging the tier below before its retention is applied,
+    so hourly and daily buckets keep summarizing events after their minute buckets have expired.
+    """
+    now = pd.Timestamp.utcnow().tz_localize(None) if now is None else pd.Timestamp(now)
+    lower = None
+    for tier, freq in TIERS.items():
+        if lower is None:
+            new = partials.assign(run_id=run_id)
+        else:
+            source = lower.loc[lower['_timestamp'] >= since] if since is not None else lower
+            new = aggregate.merge_partials(source.assign(_timestamp=source['_timestamp'].dt.floor(freq)), ['_timestamp', 'run_id']).reset_index()
+
+        path = tier_path(tier, run_id, root_dir)
+        if since is not None and os.path.exists(path):
+            kept = pd.read_parquet(path, filters=[('_timestamp', '<', pd.Timestamp(since))])
+            new = pd.concat([kept, new], ignore_index=True)
+        lower = new.sort_values('_timestamp', ignore_index=True)
+
+        retained = lower
+        if RETENTION[tier] is not None:
+            retained = lower.loc[lower['_timestamp'] >= now - RETENTION[tier]]
+        _write_tier(retained, tier, run_id, root_dir)
+
+
+class RollupWriter:
+    """Updates the rollups of a run from minute partials which arrive in time order, e.g. one chunk of events at a time.
+
+    Days are written as soon as partials of a later day arrive, so only the minute partials of about one day are kept in memory.
+    """
+
+    def __init__(self, run_id, since=None, now=None, root_dir=ROOT_DIR):
+        self.run_id = run_id
+        self.since = since
+        self.now = now
+        self.root_dir = root_dir
+        self.pending = []
+
+    def add(self, partials):
+        if self.since is not None:
+            partials = partials.loc[partials['_timestamp'] >= self.since]
+        if partials.empty:
+            return
+        self.pending.append(partials)
+
+        # buckets before the day of the latest partials cannot change anymore
+        day = partials['_timestamp'].max().floor(list(TIERS.values())[-1])
+        pending = pd.concat(self.pending, ignore_index=True)
+        complete = pending['_timestamp'] < day
+        if complete.any():
+            self._write(pending.loc[complete])
+            self.since = day
+            self.pending = [pending.loc[~complete]]
+
+    def close(self):
+        if self.pending:
+            self._write(pd.concat(self.pending, ignore_index=True))
+            self.pending = []
+
+    def _write(self, partials):
+        # minute buckets which span two chunks are merged first
+        partials = aggregate.merge_partials(partials, ['_timestamp']).reset_index()
+        update_run(partials, self.run_id, since=self.since, now=self.now, root_dir=self.root_dir)
+
+
+def choose_tier(start=None, resolution=None, now=None):
+    """Returns the coarsest tier which is at least as fine as resolution and still retains buckets from start on.
+
+    If no tier retains start, the coarsest tier which satisfies the resolution is used and older buckets are missing.
+    """
+    now = pd.Timestamp.utcnow().tz_localize(None) if now is None else pd.Timestamp(now)
+    candidates = [tier for tier, freq in TIERS.items() if resolution is None or _duration(freq) <= _duration(resolution)]
+    if not candidates:
+        raise ValueError(f'Resolution {resolution!r} is finer than the finest tier {list(TIERS)[0]!r}')
+
+    for tier in reversed(candidates):
+        if start is None or RETENTION[tier] is None or pd.Timestamp(start) >= now - RETENTION[tier]:
+            return tier
+    print(f'No tier with resolution {resolution!r} retains buckets from {start}, using {candidates[-1]!r}')
+    return candidates[-1]
+
+
+def query(run_ids=None, start=None, end=None, resolution=None, combine_runs=False, ntop=3, now=None, root_dir=ROOT_DIR, completions_path=utils.COMPLETIONS_PATH):
+    """Returns stats of runs (or of all runs combined) in [start, end), read from the coarsest tier which satisfies the
+    range and resolution. Buckets of the tier are merged up to resolution if it is coarser, e.g. '6h' is served from the hour tier.
+
+    Diversity and the ntop completions come from the stored sketches, and completions are looked up in the completion dictionary.
+    """
+    tier = choose_tier(start, resolution, now)
+    partials = read_tier(tier, run_ids, start, end, root_dir)
+    if partials.empty:
+        return partials
+
+    freq = resolution or TIERS[tier]
+    keys = ['_timestamp'] if combine_runs else ['_timestamp', 'run_id']
+    if freq != TIERS[tier] or combine_runs:
+        partials = aggregate.merge_partials(partials.assign(_timestamp=partials['_timestamp'].dt.floor(freq)), keys)
+    else:
+        partials = partials.set_index(keys)
+    dictionary = utils.read_completion_dictionary(completions_path)
+    texts = pd.Series(dictionary['text'].values, index=dictionary['hash'].values)
+    return aggregate.finalize_partials(partials, ntop=ntop, texts=texts).reset_index()
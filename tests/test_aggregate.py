@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from opendashboards.utils import aggregate
+
+
+def events(n=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    vocab = np.array([""] + [f"completion {i}" for i in range(50)], dtype=object)
+    return pd.DataFrame({
+        "bucket": rng.integers(0, 12, n),
+        "completions": pd.Categorical(vocab[np.minimum(rng.zipf(1.5, n), len(vocab) - 1)]),
+        "rewards": np.where(rng.random(n) < 0.4, 0, rng.random(n)),
+    })
+
+
+@pytest.mark.parametrize("dense_pairs", [aggregate.DENSE_PAIRS, 0])
+def test_vectorized_stats_match_groupby(monkeypatch, dense_pairs):
+    monkeypatch.setattr(aggregate, "DENSE_PAIRS", dense_pairs)
+    df = events()
+    stats = aggregate.completion_stats(df.completions, df.rewards, df.bucket)
+    top = aggregate.top_completions(df.completions, df.rewards, df.bucket, exclude="", ntop=3)
+
+    nonempty = df.loc[df.completions != ""]
+    grouper = df.groupby("bucket")
+    assert np.allclose(stats.completions_diversity, grouper.completions.nunique() / grouper.size())
+    assert np.allclose(stats.completions_successful_diversity, nonempty.groupby("bucket").completions.nunique() / nonempty.groupby("bucket").size())
+
+    expected = nonempty.groupby(["bucket", "completions"], observed=True).rewards.agg(["size", "mean", "std"])
+    for (bucket, rank), row in top.iterrows():
+        stats_of = expected.loc[(bucket, row.completions_top)]
+        assert row.completions_freq == stats_of["size"] == expected.loc[bucket, "size"].nlargest(3).iloc[rank]
+        assert np.isclose(row.completions_reward_mean, stats_of["mean"])
+        assert np.isclose(row.completions_reward_std, stats_of["std"], equal_nan=True)
@@ -0,0 +1,84 @@
+import pandas as pd
+import pytest
+
+import block_times
+
+GENESIS = 1_680_000_000_000
+
+
+def block_time(block):
+    return GENESIS + 12_000 * block
+
+
+class FakeCall:
+    def __init__(self, block):
+        self.value_serialized = {'call_args': [{'value': block_time(block)}]}
+
+
+class FakeSubtensor:
+    """Answers get_block like substrate, and fails for the blocks in fail."""
+
+    def __init__(self, fail=(), requested=None):
+        self.fail = set(fail)
+        self.requested = requested if requested is not None else []
+        self.substrate = self
+
+    def get_block(self, block_number):
+        self.requested.append(block_number)
+        if block_number in self.fail:
+            raise ConnectionError(f'block {block_number} is not available')
+        return {'extrinsics': [{'call': FakeCall(block_number)}]}
+
+
+def test_index_round_trip(tmp_path):
+    path = str(tmp_path / 'block_times.sqlite')
+    block_times.save_block_times({1: 10, 2: 20, 3: 30}, path)
+    block_times.save_block_times({3: 31}, path)
+
+    assert block_times.load_block_times(path=path) == {1: 10, 2: 20, 3: 31}
+    assert block_times.load_block_times([2, 3, 4], path) == {2: 20, 3: 31}
+
+
+def test_fetch_block_times_saves_every_batch(tmp_path, monkeypatch):
+    path = str(tmp_path / 'block_times.sqlite')
+    saved = []
+    save = block_times.save_block_times
+    monkeypatch.setattr(block_times, 'save_block_times', lambda timestamps, path: saved.append(len(timestamps)) or save(timestamps, path))
+
+    timestamps = block_times.fetch_block_times(range(25), FakeSubtensor, max_workers=2, batch_size=10, path=path)
+    assert saved == [10, 10, 5]
+    assert timestamps == {b: block_time(b) for b in range(25)}
+    assert block_times.load_block_times(path=path) == timestamps
+
+
+def test_failed_blocks_are_interpolated_but_not_saved(tmp_path):
+    path = str(tmp_path / 'block_times.sqlite')
+    blocks = [100, 200, 300, 300]
+    times = block_times.block_to_time(blocks, lambda: FakeSubtensor(fail={200}), max_workers=1, path=path)
+
+    assert times.tolist() == pd.to_datetime([block_time(b) for b in blocks], unit='ms').tolist()
+    assert block_times.load_block_times(path=path) == {100: block_time(100), 300: block_time(300)}
+
+
+def test_indexed_blocks_are_not_fetched(tmp_path):
+    path = str(tmp_path / 'block_times.sqlite')
+    requested = []
+    make_subtensor = lambda: FakeSubtensor(requested=requested)
+    first = block_times.block_to_time([5, 6, 7], make_subtensor, path=path)
+    assert sorted(requested) == [5, 6, 7]
+
+    requested.clear()
+    second = block_times.block_to_time([7, 6, 5], make_subtensor, path=path)
+    assert requested == []
+    assert second.tolist() == first.tolist()[::-1]
+
+
+def test_interpolate_block_times():
+    anchors = {100: 1_000, 200: 2_000, 400: 3_000}
+    times = block_times.interpolate_block_times([100, 150, 200, 300, 400], anchors)
+    assert times.tolist() == [1_000, 1_500, 2_000, 2_500, 3_000]
+    # outside of the anchors, the rate of the nearest two anchors is used
+    assert block_times.interpolate_block_times([0, 600], anchors).tolist() == [0, 4_000]
+
+    with pytest.raises(ValueError):
+        block_times.interpolate_block_times([1], {100: 1_000})
@@ -0,0 +1,25 @@
+import os
+
+from opendashboards.assets import io
+from tests.test_query import events
+import opendashboards.utils.utils as utils
+
+
+def test_run_health_of_a_run_without_events(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    run_dir = os.path.join("data", "history", "run")
+    os.makedirs(run_dir)
+    assert io.run_health("run", run_dir).empty
+    # a sync which produced no rows leaves the run without parts
+    utils.append_history(iter([]), run_dir)
+    assert io.run_health("run", run_dir).empty
+
+
+def test_run_health(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    run_dir = os.path.join("data", "history", "run")
+    utils.append_history(events(50), run_dir, page_size=10, explode=False)
+
+    health = io.run_health("run", run_dir)
+    assert set(health["run_id"]) == {"run"}
+    assert set(health["task"]) == set(io.inspect.TASK_NAMES[t] for t in ["question-answering", "summarization"])
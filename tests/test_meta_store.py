@@ -0,0 +1,50 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import meta_store
+
+
+def frame(blocks, n=4):
+    rng = np.random.default_rng(0)
+    rows = [dict(block=b, uid=u, timestamp=pd.Timestamp(0) + pd.Timedelta(seconds=12*b), hotkey=f'h{u}', coldkey=f'c{u % 2}', ip=f'ip{u}',
+                 **{c: rng.random() for c in dict.fromkeys(meta_store.MINER_COLS + meta_store.VALIDATOR_COLS)})
+            for b in blocks for u in range(n)]
+    return pd.DataFrame(rows)
+
+
+def test_rebuild_dataframe_only_replaces_the_block_range(tmp_path):
+    root_dir = str(tmp_path)
+    meta_store.append_dataframe(frame(range(0, 10)), 1, root_dir=root_dir)
+    meta_store.append_dataframe(frame(range(10, 20)), 1, root_dir=root_dir)
+    meta_store.append_dataframe(frame(range(20, 30)), 1, root_dir=root_dir)
+
+    rebuilt = frame(range(5, 15)).assign(incentive=-1.0)
+    meta_store.rebuild_dataframe(rebuilt, 1, block_min=5, block_max=14, root_dir=root_dir)
+
+    df = meta_store.read_dataframe(1, root_dir=root_dir)
+    assert meta_store.read_manifest(1, root_dir)['blocks'] == list(range(30))
+    assert sorted(df['block'].unique()) == list(range(30))
+    assert (df.loc[df['block'].between(5, 14), 'incentive'] == -1).all()
+    assert (df.loc[~df['block'].between(5, 14), 'incentive'] >= 0).all()
+    rollup = meta_store.read_rollup(1, root_dir=root_dir)
+    assert sorted(rollup['block'].unique()) == list(range(30))
+    assert rollup.groupby('block')['uid_count'].sum().eq(4).all()
+
+
+def test_read_weights_from_catalog(tmp_path):
+    root_dir = str(tmp_path)
+    rng = np.random.default_rng(0)
+    weights = {block: np.where(rng.random((8, 8)) < 0.5, 0, rng.random((8, 8))) for block in [5, 10_005, 20_005]}
+    # weights written before the weights catalog existed are found once, when the first entry is logged
+    meta_store.write_weights(weights[5], 5, 1, quantize=False, root_dir=root_dir)
+    os.remove(meta_store._catalog_paths(1, root_dir, kind='weights')[1])
+    for block in [10_005, 20_005]:
+        meta_store.write_weights(weights[block], block, 1, quantize=False, root_dir=root_dir)
+
+    assert sorted(meta_store.read_catalog(1, root_dir, kind='weights')) == [5, 10_005, 20_005]
+    matrices = meta_store.read_weights(1, block_min=0, block_max=15_000, root_dir=root_dir)
+    assert sorted(matrices) == [5, 10_005]
+    for block, matrix in matrices.items():
+        assert np.allclose(matrix.toarray(), weights[block].astype(np.float32))
@@ -0,0 +1,88 @@
+import sys
+import types
+import importlib
+
+import pytest
+
+import meta_store
+
+# blocks for which the fake subtensor always fails, and the number of attempts after which the other blocks succeed
+FAIL = set()
+FLAKY = 0
+
+
+class FakeMetagraph:
+    def __init__(self, block, attempts):
+        self.block = block
+        self.attempts = attempts
+
+
+class FakeSubtensor:
+    """Answers metagraph like bittensor.subtensor, counting the attempts for each block in the worker process."""
+
+    def __init__(self, network='archive'):
+        self.network = network
+        self.attempts = {}
+
+    def metagraph(self, block, netuid=1, lite=True):
+        self.attempts[block] = self.attempts.get(block, 0) + 1
+        if block in FAIL or self.attempts[block] <= FLAKY:
+            raise ConnectionError(f'block {block} is not available')
+        return FakeMetagraph(block, self.attempts[block])
+
+
+@pytest.fixture
+def multigraph(monkeypatch):
+    # workers are forked, so they inherit the stubbed bittensor and store
+    monkeypatch.setitem(sys.modules, 'bittensor', types.SimpleNamespace(subtensor=FakeSubtensor))
+    monkeypatch.delitem(sys.modules, 'meta2frame', raising=False)
+    monkeypatch.delitem(sys.modules, 'multigraph', raising=False)
+    monkeypatch.setattr(meta_store, 'metagraph_to_frame', lambda metagraph, netuid: metagraph.block)
+    monkeypatch.setattr(meta_store, 'write_snapshot', lambda frame, netuid: None)
+    return importlib.import_module('multigraph')
+
+
+def test_chunks_cover_blocks_once(multigraph):
+    blocks = list(range(1000, 0, -7))
+    chunks = multigraph.chunk_blocks(blocks, 10)
+    assert [block for chunk in chunks for block in chunk] == blocks
+    assert all(len(chunk) == 10 for chunk in chunks[:-1])
+
+    results, failed = multigraph.process_blocks(blocks, max_workers=3, chunk_size=10, return_graph=True)
+    assert failed == {}
+    assert sorted(metagraph.block for metagraph in results) == sorted(blocks)
+
+
+def test_retries_are_honoured(multigraph, monkeypatch):
+    monkeypatch.setattr(sys.modules[__name__], 'FLAKY', 2)
+    blocks = list(range(20))
+
+    results, failed = multigraph.process_blocks(blocks, max_workers=2, chunk_size=5, retries=2, return_graph=True)
+    assert failed == {}
+    assert sorted(metagraph.block for metagraph in results) == blocks
+    assert {metagraph.attempts for metagraph in results} == {3}
+
+    results, failed = multigraph.process_blocks(blocks, max_workers=2, chunk_size=5, retries=1, return_graph=True)
+    assert results == []
+    assert sorted(failed) == blocks
+
+
+def test_failed_blocks_are_reported(multigraph, monkeypatch, capsys):
+    monkeypatch.setattr(sys.modules[__name__], 'FAIL', {3, 11})
+    blocks = list(range(16))
+
+    results, failed = multigraph.process_blocks(blocks, max_workers=2, chunk_size=4, retries=1, return_graph=True)
+    assert sorted(metagraph.block for metagraph in results) == [b for b in blocks if b not in {3, 11}]
+    assert failed == {3: 'ConnectionError: block 3 is not available', 11: 'ConnectionError: block 11 is not available'}
+    assert '  11: ConnectionError: block 11 is not available' in capsys.readouterr().out
+
+
+def test_crashed_chunks_are_reported(multigraph, monkeypatch):
+    # an error outside of process, e.g. a worker which cannot connect, fails the whole chunk
+    def init_worker(network='archive'):
+        raise RuntimeError('cannot connect')
+    monkeypatch.setattr(multigraph, 'init_worker', init_worker)
+
+    results, failed = multigraph.process_blocks(list(range(6)), max_workers=2, chunk_size=3)
+    assert results == []
+    assert sorted(failed) == list(range(6))
@@ -0,0 +1,44 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import opendashboards.utils.utils as utils
+import multistats
+
+
+def events(n, k=8):
+    rng = np.random.default_rng(0)
+    for i in range(n):
+        yield {
+            "_step": i,
+            # six hours of events, so that hourly buckets span several row groups
+            "_timestamp": 1_699_999_200 + i * 6 * 3600 / n,
+            "step_length": rng.random(),
+            "uids": rng.integers(0, 64, k).tolist(),
+            "completions": [f"completion {j}" if j else "" for j in rng.integers(0, 20, k)],
+            "rewards": np.where(rng.random(k) < 0.3, 0, rng.random(k)).tolist(),
+            "completion_times": rng.random(k).tolist(),
+        }
+
+
+def test_calculate_stats_chunked_matches_in_memory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    run_dir = os.path.join("data", "runs", "run")
+    utils.append_history(events(600), run_dir, page_size=50, explode=False, transform=multistats.clean_page)
+
+    df = multistats.clean_chunk(utils.read_history(run_dir))
+    chunks = (multistats.clean_chunk(chunk) for chunk in utils.iter_history(run_dir))
+    stats = multistats.calculate_stats(df, freq="h", run_id="run").set_index("_timestamp")
+    chunked = multistats.calculate_stats_chunked(chunks, freq="h", run_id="run").set_index("_timestamp")
+
+    assert len(stats) == len(chunked) == 6
+    exact = [
+        "completions_count", "completions_success_rate",
+        "rewards_sum", "rewards_mean", "rewards_std", "rewards_max", "rewards_nonzero_rate", "rewards_nonzero_mean", "rewards_nonzero_std",
+        "completion_times_mean", "completion_times_std", "completion_times_min", "completion_times_max",
+    ]
+    for col in exact:
+        assert np.allclose(stats[col], chunked.loc[stats.index, col]), col
+    # unique counts are HyperLogLog estimates, which are close to exact for few completions
+    assert np.allclose(stats["completions_nunique"], chunked.loc[stats.index, "completions_nunique"], rtol=0.05)
@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+import opendashboards.utils.utils as utils
+from opendashboards.utils import query
+
+TASKS = ["question-answering", "summarization"]
+
+
+def events(n, k=4):
+    rng = np.random.default_rng(0)
+    for i in range(n):
+        task = TASKS[i % len(TASKS)]
+        event = {
+            "_step": i,
+            "_timestamp": 1.7e9 + i,
+            "task": task,
+            "uids": rng.integers(0, 16, k).tolist(),
+            "completions": [f"completion {j}" for j in rng.integers(0, 8, k)],
+            "rewards": rng.random(k).tolist(),
+        }
+        # scores which are only logged for one task, and are null on the events of the others
+        if task == "question-answering":
+            event["question-answering_nsfw_scores"] = rng.random(k).tolist()
+        yield event
+
+
+def test_explode_table_fills_task_specific_list_columns():
+    table = pa.table({
+        "uids": [[1, 2], [3, 4, 5], None, [6]],
+        "scores": [[0.1, 0.2], None, [0.3], [0.4]],
+        "step": [0, 1, 2, 3],
+    })
+    exploded = query.explode_table(table)
+    assert exploded["uids"].to_pylist() == [1, 2, 3, 4, 5, 6]
+    assert exploded["scores"].to_pylist() == [0.1, 0.2, None, None, None, 0.4]
+    assert exploded["step"].to_pylist() == [0, 0, 1, 1, 1, 3]
+
+
+def test_explode_table_drops_list_columns_of_other_lengths():
+    table = pa.table({"uids": [[1, 2], [3]], "other": [[1], [2]]})
+    assert query.explode_table(table).column_names == ["uids"]
+
+
+def test_scan_run_with_task_specific_list_columns(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    run_dir = str(tmp_path / "history" / "run")
+    utils.append_history(events(50), run_dir, page_size=10, explode=False)
+
+    df = query.scan_run(run_dir, explode=True)
+    expected = list(events(50))
+    qa_scores = df["question-answering_nsfw_scores"]
+
+    assert len(df) == 200
+    assert df["uids"].tolist() == [uid for event in expected for uid in event["uids"]]
+    assert qa_scores[df["task"] == "summarization"].isna().all()
+    assert np.allclose(qa_scores[df["task"] == "question-answering"], [s for e in expected for s in e.get("question-answering_nsfw_scores", [])])
+
+
+def test_completion_index_lookup(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    run_dir = str(tmp_path / "history" / "run")
+    utils.append_history(events(50), run_dir, page_size=10, explode=False)
+    index = query.CompletionIndex(query.scan_run(run_dir, columns=["_timestamp", "uids", "completions", "rewards"]))
+    expected = pd.Series([c for event in events(50) for c in event["completions"]]).value_counts()
+
+    counts = query.completion_counts({"run": index})
+    assert counts.to_dict() == expected.to_dict()
+    found = query.lookup_completions({"run": index}, completions=["completion 3", "missing"])
+    assert len(found) == expected["completion 3"] and (found["completions"] == "completion 3").all()
+    found = query.lookup_completions({"run": index}, regex="completion [12]$")
+    assert found["completions"].value_counts().to_dict() == expected[["completion 1", "completion 2"]].to_dict()
+
+
+def test_empty_completion_index(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    run_dir = str(tmp_path / "history" / "run")
+    columns = ["_timestamp", "uids", "completions", "rewards"]
+    assert query.scan_run(run_dir, columns=columns) is None
+    indexes = {"empty": query.CompletionIndex(query.scan_run(run_dir, columns=columns))}
+
+    utils.append_history(events(10), run_dir, page_size=10, explode=False)
+    # a task filter which leaves no events
+    indexes["filtered"] = query.CompletionIndex(query.scan_run(run_dir, columns=columns, tasks=["translation"]))
+
+    assert all(len(index.ids) == 0 for index in indexes.values())
+    assert query.completion_counts(indexes).empty
+    assert query.lookup_completions(indexes, completions=["completion 3"]).empty
+    assert query.lookup_completions(indexes, regex="completion").empty
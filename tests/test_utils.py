@@ -0,0 +1,143 @@
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import opendashboards.utils.utils as utils
+from opendashboards.utils import query
+from tests.test_query import events
+
+
+def history_texts(run_dir):
+    df = utils.read_history(run_dir).explode(["uids", "completions", "rewards"]).astype({"completions": "int32"})
+    df = utils.decode_completions(df)
+    return df["completions"].astype(str).tolist()
+
+
+def expected_texts(n):
+    return [c for event in events(n) for c in event["completions"]]
+
+
+def test_import_history_interns_completions(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    run_dir = os.path.join("data", "history", "run")
+    # old CSV caches hold string representations of the list columns
+    pd.DataFrame(list(events(20))).to_csv("history-run.csv", index=False)
+    utils.import_history("history-run.csv", run_dir)
+    utils.append_history(events(40), run_dir, page_size=10, explode=False)
+
+    state = utils.read_sync_state(run_dir)
+    assert len(state["parts"]) == 2
+    for part in state["parts"]:
+        assert pq.read_schema(os.path.join(run_dir, part)).field("completions").type == pa.list_(pa.int32())
+    assert history_texts(run_dir) == expected_texts(40)
+
+
+def test_append_history_reencodes_imported_texts(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    run_dir = os.path.join("data", "history", "run")
+    # a part which was imported before completions were interned
+    os.makedirs(run_dir)
+    pd.DataFrame(list(events(20))).to_parquet(os.path.join(run_dir, "part-0-19.parquet"), index=False)
+    utils.write_sync_state({"last_step": 19, "parts": ["part-0-19.parquet"]}, run_dir)
+    utils.append_history(events(40), run_dir, page_size=10, explode=False)
+
+    assert history_texts(run_dir) == expected_texts(40)
+
+
+def late_events(n, first=0):
+    # a score column which is only logged from step 15 on, and then only for one task
+    for event in events(n):
+        if event["_step"] < first:
+            continue
+        if event["_step"] < 15:
+            event.pop("question-answering_nsfw_scores", None)
+        yield event
+
+
+def test_write_history_adds_new_columns(tmp_path):
+    file_path = str(tmp_path / "history.parquet")
+    n_rows = utils.write_history(late_events(40), file_path, page_size=10, completions_path=str(tmp_path / "completions"))
+
+    df = pd.read_parquet(file_path)
+    scores = df["question-answering_nsfw_scores"]
+    assert n_rows == len(df) == 160
+    assert scores[df["_step"] < 15].isna().all()
+    assert scores[(df["_step"] >= 15) & (df["task"] == "question-answering")].notna().all()
+    assert scores[df["task"] == "summarization"].isna().all()
+
+
+def test_append_history_adds_columns_of_later_parts(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    run_dir = os.path.join("data", "history", "run")
+    utils.append_history(late_events(10), run_dir, page_size=10)
+    utils.append_history(late_events(40), run_dir, page_size=10)
+
+    assert len(utils.read_sync_state(run_dir)["parts"]) == 2
+    assert "question-answering_nsfw_scores" in utils.read_history_schema(run_dir).names
+    df = query.scan_run(run_dir)
+    assert df.loc[df["_step"] >= 15, "question-answering_nsfw_scores"].notna().any()
+
+
+def test_decode_completions_only_keeps_texts_of_used_ids(tmp_path):
+    path = str(tmp_path / "completions")
+    ids = utils.intern_completions([f"completion {i}" for i in range(100)], path)
+    df = utils.decode_completions(pd.DataFrame({"completions": [ids[42], -1, ids[7], ids[42]]}), path)
+
+    assert df["completions"].cat.categories.tolist() == ["completion 7", "completion 42"]
+    assert df["completions"].tolist()[::2] == ["completion 42", "completion 7"]
+    assert df["completions"].isna().tolist() == [False, True, False, False]
+
+
+def test_intern_completions_reuses_ids(tmp_path):
+    path = str(tmp_path / "completions")
+    first = utils.intern_completions(["a", "b", None, "a"], path)
+    second = utils.intern_completions(["b", "c", "a", "d"], path)
+
+    assert first.tolist() == [0, 1, -1, 0]
+    assert second.tolist() == [1, 2, 0, 3]
+    assert sorted(os.listdir(path)) == ["dictionary.lock", "part-0.parquet", "part-2.parquet"]
+    assert pd.read_parquet(os.path.join(path, "part-2.parquet"))["text"].tolist() == ["c", "d"]
+    # a page without new texts does not write a part
+    assert utils.intern_completions(["d", "a"], path).tolist() == [3, 0]
+    assert len(os.listdir(path)) == 3
+    # the index is rebuilt from the parts when it is not cached
+    utils._hash_indexes.clear()
+    assert utils.intern_completions(["c", "e"], path).tolist() == [2, 4]
+
+
+def test_completion_texts_only_reads_parts_of_the_ids(tmp_path, monkeypatch):
+    path = str(tmp_path / "completions")
+    for page in range(3):
+        utils.intern_completions([f"completion {page} {i}" for i in range(10)], path)
+
+    opened = []
+    read_table = pq.read_table
+    monkeypatch.setattr(pq, "read_table", lambda part, **kwargs: opened.append(os.path.basename(part)) or read_table(part, **kwargs))
+    texts = utils.completion_texts([25, 3, 25, 4], path)
+
+    assert texts.tolist() == ["completion 2 5", "completion 0 3", "completion 2 5", "completion 0 4"]
+    assert sorted(opened) == ["part-0.parquet", "part-20.parquet"]
+    assert utils.completion_ids(["completion 1 2", "unknown"], path).tolist() == [12, -1]
+    assert utils.match_completions([1, 11, 12, 21], r"^completion [12] 1$", path).tolist() == [11, 21]
+
+
+def test_write_history_explodes_pages_like_the_stored_schema(tmp_path):
+    file_path = str(tmp_path / "history.parquet")
+    pages = [
+        # rewards match uids and are exploded, the prompts of the first page do not and stay lists
+        {"_step": 0, "uids": [1, 2], "rewards": [0.1, 0.2], "prompts": ["a"]},
+        {"_step": 1, "uids": [3, 4], "rewards": [0.3, 0.4], "prompts": ["b", "c", "d"]},
+        # a second page where the prompts happen to match uids, and one event logs too few rewards
+        {"_step": 2, "uids": [5, 6], "rewards": [0.5, 0.6], "prompts": ["e", "f"]},
+        {"_step": 3, "uids": [7, 8], "rewards": [0.7], "prompts": ["g", "h"]},
+    ]
+    assert utils.write_history(pages, file_path, page_size=2, completions_path=None) == 8
+
+    table = pq.read_table(file_path)
+    assert table.schema.field("rewards").type == pa.float64()
+    assert table.schema.field("prompts").type == pa.list_(pa.string())
+    assert table["uids"].to_pylist() == [1, 2, 3, 4, 5, 6, 7, 8]
+    assert table["rewards"].to_pylist() == [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, None, None]
+    assert table["prompts"].to_pylist()[4:] == [["e", "f"]] * 2 + [["g", "h"]] * 2